@@ -44,11 +44,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "foodapp.queries.QueryBudgetMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "foodapp.shards.ShardMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -84,6 +86,36 @@ DATABASES = {
     }
 }
 
+# Read replicas of the default database. The ranking, history, export and
+# batch ranking reads go to a replica that has caught up with the user's
+# data version, and everything else to the default database. To try it
+# with SQLite, copy db.sqlite3 to replica.sqlite3, add
+#   "replica": {
+#       "ENGINE": "django.db.backends.sqlite3",
+#       "NAME": BASE_DIR / "replica.sqlite3",
+#       "TEST": {"MIRROR": "default"},
+#   }
+# to DATABASES and "replica" to DATABASE_REPLICAS.
+DATABASE_REPLICAS = []
+
+# Databases the users' meals, reactions and ranking state are spread over,
+# by a hash of the user id. The users stay in the default database, and the
+# catalog is copied from it to every shard. Users from before sharding keep
+# their diary in the default database, which can be a shard too, until
+# `manage.py rebalance_shards` moves them. It also moves users after shards
+# are added. To try it with SQLite, add
+#   "shard": {
+#       "ENGINE": "django.db.backends.sqlite3",
+#       "NAME": BASE_DIR / "shard.sqlite3",
+#   }
+# to DATABASES and set this to ["default", "shard"].
+DATABASE_SHARDS = []
+
+DATABASE_ROUTERS = [
+    "foodapp.shards.ShardRouter",
+    "foodapp.replicas.ReplicaRouter",
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -126,6 +158,107 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+# The ranking cache evicts the least recently used rankings once they take
+# up more than MAX_BYTES. Use foodapp.cache.MemoryCappedFileBasedCache with
+# a directory as LOCATION to share it between processes.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "fragments",
+        "OPTIONS": {"MAX_ENTRIES": 50_000},
+    },
+    "ranking": {
+        "BACKEND": "foodapp.cache.MemoryCappedLocMemCache",
+        "LOCATION": "ranking",
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": 10_000,
+            "MAX_BYTES": 64 * 1024 * 1024,
+        },
+    },
+}
+
+# Template fragments are cached per user and data version in
+# FRAGMENT_CACHE, for the seconds FRAGMENT_TIMEOUTS gives their names. Their
+# hits and misses are counted, see `manage.py fragment_stats`.
+FRAGMENT_CACHE = "fragments"
+FRAGMENT_TIMEOUTS = {
+    "dashboard": 60 * 60,
+    "ranking": 60 * 60,
+    "history-reaction": 24 * 60 * 60,
+}
+
+# Logging
+# https://docs.djangoproject.com/en/4.1/topics/logging/
+
+# QueryBudgetMiddleware logs the requests over the query budget of their
+# view at WARNING, and every request at INFO. Ranker profiles are logged at
+# INFO.
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "foodapp.queries": {
+            "handlers": ["console"],
+            "level": "WARNING",
+        },
+        "foodapp.profiling": {
+            "handlers": ["console"],
+            "level": "INFO",
+        },
+    },
+}
+
 # authentication
 LOGIN_REDIRECT_URL = "dashboard"
 LOGIN_URL = "account:login"
+
+# ranking
+# "replay" queries every reaction window separately, "window" loads the
+# diary once and slides the window over it, "vector" evaluates all windows
+# as numpy arrays, "multilag" also tries reactions up to RANKER_MAX_LAG days
+# later, "streaming" reads the diary in chunks of RANKER_CHUNK_SIZE rows and
+# "persisted" reads the suspect state that is updated as the diary changes.
+RANKER_ENGINE = "persisted"
+RANKER_MAX_LAG = 5
+RANKER_CHUNK_SIZE = 2000
+
+# Profile the ranker stages of every ranking request and log them. Without
+# it, staff (or anyone while DEBUG is on) can add ?profile to the ranking
+# page to see the profile of that request.
+RANKER_PROFILING = False
+
+# Threads the async views compute rankings in, off the event loop, and how
+# many rankings may run or wait for them before requests are turned away
+# with 503. With no workers rankings run in the thread Django keeps for
+# synchronous code.
+RANKER_WORKERS = 4
+RANKER_MAX_PENDING = 32
+
+# Serve the ranking page from the last ranking a `run_ranking_worker`
+# process stored, recomputing it in the background after the diary changes.
+# Only turn it on with at least one worker running, or the page keeps
+# showing an old ranking marked as refreshing. Off, the page ranks itself.
+# Edits are ranked RANKING_QUEUE_DELAY seconds after the last one of a
+# burst, but at most RANKING_QUEUE_MAX_DELAY seconds after the first. A job
+# a worker holds for RANKING_QUEUE_LEASE seconds is taken to be lost, and a
+# failed job is retried after RANKING_QUEUE_RETRY_DELAY seconds, doubling
+# each time, up to RANKING_QUEUE_MAX_ATTEMPTS attempts.
+RANKING_IN_BACKGROUND = False
+RANKING_QUEUE_DELAY = 2
+RANKING_QUEUE_MAX_DELAY = 30
+RANKING_QUEUE_LEASE = 300
+RANKING_QUEUE_RETRY_DELAY = 10
+RANKING_QUEUE_MAX_ATTEMPTS = 5
+
+# Cache alias for ranker output, or None to rank on every request.
+RANKING_CACHE = "ranking"
@@ -0,0 +1,16 @@
+"""Settings for `manage.py test`: the project's, with a database to shard to.
+
+The sharding tests store diaries in the `shard` database, which the test
+runner only creates for them. Sharding stays off unless a test turns it on.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+DATABASES = {
+    **DATABASES,
+    "shard": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "shard.sqlite3",
+    },
+}
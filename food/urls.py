@@ -42,6 +42,11 @@ meal_urls = (
             views.MealDeleteView.as_view(),
             name="delete",
         ),
+        path(
+            "import/",
+            views.DiaryImportView.as_view(),
+            name="import",
+        ),
     ],
     "meal",
 )
@@ -141,6 +146,22 @@ recipe_ingredient_urls = (
     "ingredients",
 )
 
+recipe_component_urls = (
+    [
+        path(
+            "create/",
+            views.RecipeComponentCreateView.as_view(),
+            name="create",
+        ),
+        path(
+            "delete/<int:pk>",
+            views.RecipeComponentDeleteView.as_view(),
+            name="delete",
+        ),
+    ],
+    "components",
+)
+
 recipe_urls = (
     [
         path("create/", views.RecipeCreateView.as_view(), name="create"),
@@ -158,11 +179,45 @@ recipe_urls = (
             name="detail",
         ),
         path("list/", views.RecipeListView.as_view(), name="list"),
+        path("lookup/", views.RecipeLookupView.as_view(), name="lookup"),
         path("<int:recipe_pk>/ingredients/", include(recipe_ingredient_urls)),
+        path("<int:recipe_pk>/components/", include(recipe_component_urls)),
     ],
     "recipe",
 )
 
+export_urls = (
+    [
+        path(
+            "diary.<str:format>",
+            views.DiaryExportView.as_view(),
+            name="diary",
+        ),
+        path(
+            "ranking.<str:format>",
+            views.RankingExportView.as_view(),
+            name="ranking",
+        ),
+    ],
+    "export",
+)
+
+api_urls = (
+    [
+        path(
+            "meals/",
+            views.BatchView.as_view(kind="meal"),
+            name="meals",
+        ),
+        path(
+            "reactions/",
+            views.BatchView.as_view(kind="reaction"),
+            name="reactions",
+        ),
+    ],
+    "api",
+)
+
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -173,9 +228,22 @@ urlpatterns = [
     path("ingredient/", include(ingredient_urls)),
     path("recipe/", include(recipe_urls)),
     path("ranking/", views.RankingView.as_view(), name="ranking"),
+    path("search/", views.SearchView.as_view(), name="search"),
+    path("export/", include(export_urls)),
+    path("api/", include(api_urls)),
+    path(
+        "fragments/stats/",
+        views.FragmentStatsView.as_view(),
+        name="fragment_stats",
+    ),
     path(
         "food/history/<str:suspect>",
         views.FoodHistoryView.as_view(),
         name="history",
     ),
+    path(
+        "food/history/<str:suspect>/series",
+        views.SuspectSeriesView.as_view(),
+        name="history_series",
+    ),
 ]
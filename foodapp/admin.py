@@ -1,4 +1,6 @@
 from django.contrib import admin
+from django.db import DEFAULT_DB_ALIAS
+from django.http import QueryDict
 from .models import (
     Ingredient,
     Meal,
@@ -8,11 +10,73 @@ from .models import (
     IngredientAllergen,
     Recipe,
 )
+from .shards import diary_databases, on_shard, shard_for, shards
+
+
+class DatabaseFilter(admin.SimpleListFilter):
+    """Choose the database the diary rows are listed from."""
+
+    title = "database"
+    parameter_name = "database"
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in diary_databases()]
+
+    def value(self):
+        return super().value() or DEFAULT_DB_ALIAS
+
+    def choices(self, changelist):
+        # There is no list of all databases, so no "All" choice.
+        return list(super().choices(changelist))[1:]
+
+    def queryset(self, request, queryset):
+        # ShardAdmin.get_queryset has read the database already.
+        return queryset
+
+
+class ShardAdmin(admin.ModelAdmin):
+    """Admin of a diary model, one shard at a time.
+
+    The database is chosen with the filter of the list and kept in the
+    change pages by the filters Django preserves. Rows are saved to and
+    deleted from the database they were read from, and added rows go to
+    the shard of their user.
+    """
+
+    def get_list_filter(self, request):
+        return [DatabaseFilter] if shards() else []
+
+    def database(self, request):
+        params = request.GET
+        if "_changelist_filters" in params:
+            params = QueryDict(params["_changelist_filters"])
+        alias = params.get(DatabaseFilter.parameter_name)
+        return alias if alias in diary_databases() else DEFAULT_DB_ALIAS
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if not shards():
+            return queryset
+        return queryset.using(self.database(request))
+
+    def save_model(self, request, obj, form, change):
+        alias = obj._state.db if change else shard_for(obj.user_id)
+        with on_shard(alias):
+            super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        with on_shard(obj._state.db):
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with on_shard(queryset.db):
+            super().delete_queryset(request, queryset)
+
 
 # Register your models here.
 admin.site.register(Ingredient)
-admin.site.register(Meal)
-admin.site.register(Reaction)
+admin.site.register(Meal, ShardAdmin)
+admin.site.register(Reaction, ShardAdmin)
 admin.site.register(RecipeIngredient)
 admin.site.register(Allergen)
 admin.site.register(IngredientAllergen)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import django
+from dataclasses import asdict
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.db import connections
+from .ranker import get_ranker
+from .replicas import replica_reads
+from .shards import user_shard
+
+
+def serialize_ranking(ranking):
+    return [asdict(suspect) for suspect in ranking]
+
+
+def init_worker():
+    """Give a pool worker its own database connections.
+
+    Forked workers inherit the parent's connections, which must not be
+    shared, and spawned workers have to set Django up first.
+    """
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def rank_users(user_ids, engine=None):
+    """Rank the users, returning the worker, the time spent and rankings."""
+    start = time.perf_counter()
+    rankings = []
+    for user in User.objects.filter(id__in=user_ids):
+        with user_shard(user.id), replica_reads(user.id):
+            ranking = get_ranker(user, engine).get_ranking()
+        rankings.append((user.id, serialize_ranking(ranking)))
+    return os.getpid(), time.perf_counter() - start, rankings
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import json
+import random
+import subprocess
+import time
+import tracemalloc
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from . import views
+from .composition import composition_of
+from .models import Meal, Reaction
+from .queries import count_queries
+from .ranker import ENGINES, get_ranker
+from .synthetic import generate_catalog, generate_diary
+
+
+def measure(function, repeats=3):
+    """Best wall time, query count and peak traced memory of `function`.
+
+    tracemalloc slows everything down, so the memory is measured in a run
+    of its own after the timed ones.
+    """
+    seconds = []
+    for _ in range(repeats):
+        with count_queries() as queries:
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "seconds": min(seconds),
+        "queries": queries.count,
+        "peak_bytes": peak,
+    }
+
+
+async def read_async(content):
+    return b"".join([chunk async for chunk in content])
+
+
+def render(view, user, **kwargs):
+    """Run a view like a request of the user would, including the template."""
+    request = RequestFactory().get("/")
+    request.user = user
+    view_func = view.as_view()
+    if view.view_is_async:
+        view_func = async_to_sync(view_func)
+    response = view_func(request, **kwargs)
+    if hasattr(response, "render"):
+        response.render()
+    if response.streaming and response.is_async:
+        return async_to_sync(read_async)(response.streaming_content)
+    if response.streaming:
+        return b"".join(response.streaming_content)
+    return response.content
+
+
+def targets(user, engines):
+    """The functions to measure for the user, by name."""
+    for engine in engines:
+        yield f"ranker:{engine}", lambda engine=engine: get_ranker(
+            user, engine
+        ).get_ranking()
+
+    ranking = get_ranker(user).get_ranking()
+    yield "view:dashboard", lambda: render(views.DashboardView, user)
+    yield "view:meals", lambda: render(views.MealAllView, user)
+    yield "view:ranking", lambda: render(views.RankingView, user)
+    if ranking:
+        yield "view:history", lambda: render(
+            views.FoodHistoryView, user, suspect=ranking[0].name
+        )
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes, engines=None, repeats=3, seed=0):
+    """Measure every target on a synthetic diary of each size in days.
+
+    The data is generated inside a transaction that is rolled back at the
+    end, so the database is left as it was, and kept out of the shards.
+    The ranking cache is disabled so every repeat computes the ranking.
+    Yields one result per target and size.
+    """
+    engines = engines or list(ENGINES)
+    rng = random.Random(seed)
+    started = timezone.now().isoformat()
+    revision = commit()
+
+    with transaction.atomic(), override_settings(
+        RANKING_CACHE=None, RANKING_IN_BACKGROUND=False, DATABASE_SHARDS=[]
+    ):
+        recipes = generate_catalog(rng, prefix="benchmark")
+        composition = composition_of(recipe.id for recipe in recipes)
+        for days in sizes:
+            user = User.objects.create(username=f"benchmark-{days}")
+            generate_diary(rng, user, composition, days)
+            size = {
+                "days": days,
+                "meals": Meal.objects.filter(user=user).count(),
+                "reactions": Reaction.objects.filter(user=user).count(),
+            }
+            for target, function in targets(user, engines):
+                yield {
+                    "started": started,
+                    "commit": revision,
+                    "target": target,
+                    **size,
+                    **measure(function, repeats),
+                }
+        transaction.set_rollback(True)
+
+
+def write_results(results, path):
+    """Append the results to a JSON lines file."""
+    with open(path, "a") as output:
+        for result in results:
+            output.write(json.dumps(result) + "\n")
+            yield result
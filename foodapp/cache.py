@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import os
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from .models import Reaction
+from .profiling import current_profile
+from .ranker import Ranker
+from .versions import data_version
+
+
+class CachedRanker(Ranker):
+    """Ranker output cached per engine and its parameters under the data
+    version of the user.
+
+    Any write to the user's diary or to the catalog gives a new version, so
+    entries never have to be invalidated, they just stop being read and are
+    evicted in time.
+
+    The exposures of rankers that do not keep them, like StreamingRanker,
+    are not cached either: they are streamed by a new ranker when asked
+    for.
+    """
+
+    def __init__(self, user, ranker_class):
+        self.user = user
+        self.ranker_class = ranker_class
+        cache = caches[settings.RANKING_CACHE]
+        user_version, catalog_version = data_version(user.id)
+        parameters = "".join(
+            f":{name}={value}"
+            for name, value in sorted(ranker_class.parameters().items())
+        )
+        key = (
+            f"ranking:{ranker_class.__name__}{parameters}:{user.id}:"
+            f"{user_version}:{catalog_version}"
+        )
+
+        profile = current_profile()
+        with profile.stage("cache"):
+            snapshot = cache.get(key)
+        profile.count("cache_misses" if snapshot is None else "cache_hits")
+        if snapshot is None:
+            ranker = ranker_class(user)
+            snapshot = {"suspects": ranker.suspects}
+            if ranker_class.cache_exposures:
+                snapshot["reactions"] = list(ranker.reactions)
+                snapshot["exposures"] = {
+                    reaction.id: suspects_in_window
+                    for reaction, suspects_in_window in (
+                        ranker.reaction_exposures().items()
+                    )
+                }
+            cache.set(key, snapshot)
+
+        self.suspects = snapshot["suspects"]
+        if "exposures" not in snapshot:
+            self.reactions = Reaction.objects.filter(user=user).order_by(
+                "-date"
+            )
+            self.exposures = None
+            return
+        self.reactions = snapshot["reactions"]
+        self.exposures = {
+            reaction: snapshot["exposures"][reaction.id]
+            for reaction in self.reactions
+        }
+
+    def reaction_exposures(self):
+        if self.exposures is None:
+            return self.ranker_class(self.user).reaction_exposures()
+        return self.exposures
+
+    def exposure_series(self, suspect_name):
+        if self.exposures is None:
+            return self.ranker_class(self.user).exposure_series(suspect_name)
+        return super().exposure_series(suspect_name)
+
+
+class CacheUsage:
+    """Sizes of the entries in a memory-capped cache."""
+
+    def __init__(self):
+        self.sizes = {}
+        self.total = 0
+
+    def add(self, key, size):
+        self.remove(key)
+        self.sizes[key] = size
+        self.total += size
+
+    def remove(self, key):
+        self.total -= self.sizes.pop(key, 0)
+
+    def clear(self):
+        self.sizes.clear()
+        self.total = 0
+
+
+_usage = {}
+
+
+class MemoryCappedLocMemCache(LocMemCache):
+    """Local-memory cache that keeps its entries under MAX_BYTES.
+
+    LocMemCache already keeps the entries in order of use, so the least
+    recently used ones are evicted first.
+    """
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        options = params.get("OPTIONS", {})
+        self._max_bytes = int(options.get("MAX_BYTES", 64 * 1024 * 1024))
+        self._usage = _usage.setdefault(name, CacheUsage())
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        super()._set(key, value, timeout)
+        self._usage.add(key, len(value))
+        while self._usage.total > self._max_bytes and len(self._cache) > 1:
+            self._delete(next(reversed(self._cache)))
+
+    def _cull(self):
+        if self._cull_frequency == 0:
+            self._cache.clear()
+            self._expire_info.clear()
+            self._usage.clear()
+        else:
+            for i in range(len(self._cache) // self._cull_frequency):
+                self._delete(next(reversed(self._cache)))
+
+    def _delete(self, key):
+        self._usage.remove(key)
+        return super()._delete(key)
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._usage.clear()
+
+
+class MemoryCappedFileBasedCache(FileBasedCache):
+    """File-based cache that keeps its files under MAX_BYTES.
+
+    Reading an entry touches its file, so the files with the oldest
+    modification time are the least recently used and are removed first.
+    """
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        options = params.get("OPTIONS", {})
+        self._max_bytes = int(options.get("MAX_BYTES", 256 * 1024 * 1024))
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, default, version)
+        try:
+            os.utime(self._key_to_file(key, version))
+        except FileNotFoundError:
+            pass
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version)
+        self._cull_bytes()
+
+    def _cull_bytes(self):
+        files = []
+        for fname in self._list_cache_files():
+            try:
+                stat = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime_ns, stat.st_size, fname))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, fname in sorted(files)[:-1]:
+            if total <= self._max_bytes:
+                break
+            if self._delete(fname):
+                total -= size
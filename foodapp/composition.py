@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+from django.db import transaction
+from django.db.models import QuerySet
+from .models import (
+    COMPOSITION_SCALE,
+    IngredientAllergen,
+    Recipe,
+    RecipeComponent,
+    RecipeComposition,
+    RecipeIngredient,
+)
+from .shards import copy_catalog
+
+
+def flatten_recipe(recipe_ingredients, components=(), composition=None):
+    """Parts of each suspect in a recipe, in the order of the recipe.
+
+    An ingredient without allergens is a suspect itself, otherwise each of
+    its allergens is, just like in `ranker.recipe_parts`. The suspects
+    of the sub-recipes follow, scaled by their percent, which is why
+    `composition` must hold the rows of every component.
+    """
+    parts_per_suspect = {}
+    for ingredient in recipe_ingredients:
+        allergens = ingredient.ingredient.ingredientallergen_set.all()
+        if allergens:
+            suspects = [
+                (
+                    allergen.allergen.name,
+                    ingredient.percent
+                    * allergen.percent
+                    * COMPOSITION_SCALE
+                    // 10_000,
+                )
+                for allergen in allergens
+            ]
+        else:
+            suspects = [
+                (
+                    ingredient.ingredient.name,
+                    ingredient.percent * COMPOSITION_SCALE // 100,
+                )
+            ]
+
+        for suspect, parts in suspects:
+            parts_per_suspect[suspect] = (
+                parts_per_suspect.get(suspect, 0) + parts
+            )
+
+    for component in components:
+        for suspect, parts in composition.get(component.component_id, ()):
+            parts_per_suspect[suspect] = (
+                parts_per_suspect.get(suspect, 0)
+                + component.percent * parts // 100
+            )
+    return parts_per_suspect
+
+
+def with_ancestors(recipe_ids):
+    """The recipes and every recipe that contains them, at any depth."""
+    recipe_ids = set(recipe_ids)
+    children = recipe_ids
+    while children:
+        children = (
+            set(
+                RecipeComponent.objects.filter(
+                    component_id__in=children
+                ).values_list("recipe_id", flat=True)
+            )
+            - recipe_ids
+        )
+        recipe_ids |= children
+    return recipe_ids
+
+
+def rebuild_composition(recipe_ids):
+    """Recompute the RecipeComposition rows of the given recipes.
+
+    The recipes that contain them are rebuilt too, sub-recipes before the
+    recipes they are part of. Returns the ids of all rebuilt recipes.
+    """
+    recipe_ids = with_ancestors(recipe_ids)
+    if not recipe_ids:
+        return recipe_ids
+
+    ingredients_per_recipe = {recipe_id: [] for recipe_id in recipe_ids}
+    recipe_ingredients = (
+        RecipeIngredient.objects.filter(recipe_id__in=recipe_ids)
+        .order_by("id")
+        .select_related("ingredient")
+        .prefetch_related("ingredient__ingredientallergen_set__allergen")
+    )
+    for ingredient in recipe_ingredients:
+        ingredients_per_recipe[ingredient.recipe_id].append(ingredient)
+
+    components_per_recipe = {recipe_id: [] for recipe_id in recipe_ids}
+    for component in RecipeComponent.objects.filter(
+        recipe_id__in=recipe_ids
+    ).order_by("id"):
+        components_per_recipe[component.recipe_id].append(component)
+
+    # Sub-recipes outside the rebuilt ones keep their stored composition.
+    composition = composition_of(
+        component.component_id
+        for components in components_per_recipe.values()
+        for component in components
+        if component.component_id not in recipe_ids
+    )
+    flattened = {}
+
+    def flatten(recipe_id, path=()):
+        if recipe_id in path:
+            raise ValueError(f"Recipe {recipe_id} contains itself")
+        if recipe_id not in flattened:
+            for component in components_per_recipe[recipe_id]:
+                if component.component_id in recipe_ids:
+                    flatten(component.component_id, path + (recipe_id,))
+            flattened[recipe_id] = flatten_recipe(
+                ingredients_per_recipe[recipe_id],
+                components_per_recipe[recipe_id],
+                composition,
+            )
+            composition[recipe_id] = list(flattened[recipe_id].items())
+
+    for recipe_id in recipe_ids:
+        flatten(recipe_id)
+
+    rows = []
+    for recipe_id, parts_per_suspect in flattened.items():
+        for suspect, parts in parts_per_suspect.items():
+            rows.append(
+                RecipeComposition(
+                    recipe_id=recipe_id, suspect=suspect, parts=parts
+                )
+            )
+
+    with transaction.atomic():
+        RecipeComposition.objects.filter(recipe_id__in=recipe_ids).delete()
+        RecipeComposition.objects.bulk_create(rows)
+    copy_catalog(RecipeComposition, recipe_id__in=recipe_ids)
+    return recipe_ids
+
+
+def rebuild_all_compositions():
+    rebuild_composition(Recipe.objects.values_list("id", flat=True))
+
+
+def recipes_with_ingredients(ingredient_ids):
+    return RecipeIngredient.objects.filter(
+        ingredient_id__in=ingredient_ids
+    ).values_list("recipe_id", flat=True)
+
+
+def recipes_with_allergen(allergen_id):
+    return recipes_with_ingredients(
+        IngredientAllergen.objects.filter(allergen_id=allergen_id).values(
+            "ingredient_id"
+        )
+    )
+
+
+def composition_of(recipe_ids):
+    """Map each recipe to its (suspect, parts) rows in recipe order.
+
+    `recipe_ids` can also be a queryset of ids, which is used as a subquery.
+    """
+    if not isinstance(recipe_ids, QuerySet):
+        recipe_ids = set(recipe_ids)
+    composition = {}
+    rows = (
+        RecipeComposition.objects.filter(recipe_id__in=recipe_ids)
+        .order_by("id")
+        .values_list("recipe_id", "suspect", "parts")
+    )
+    for recipe_id, suspect, parts in rows:
+        composition.setdefault(recipe_id, []).append((suspect, parts))
+    return composition
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+import csv
+import heapq
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from itertools import islice
+from operator import itemgetter
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from .models import Meal, Reaction, Recipe
+from .shards import current_shard
+from . import jobs, state, versions
+
+# Columns of a CSV diary. JSON diaries use the same keys.
+COLUMNS = ["type", "date", "recipe", "amount", "reaction", "diary"]
+FORMATS = ["csv", "ndjson", "json"]
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+RANKING_COLUMNS = ["rank", "name", "reactivity", "threshold", "lag"]
+
+
+class RowError(ValueError):
+    pass
+
+
+def diary_format(stream, name=""):
+    """The format of a diary from its file name, or its first character.
+
+    The first character is only looked at in seekable streams.
+    """
+    extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    if extension in FORMATS:
+        return extension
+    if stream.seekable():
+        position = stream.tell()
+        first_char = stream.read(64).lstrip()[:1]
+        stream.seek(position)
+        if first_char == "[":
+            return "json"
+        if first_char == "{":
+            return "ndjson"
+    return "csv"
+
+
+def read_json_array(stream, chunk_size=64 * 1024):
+    """Yield the objects of a JSON array without reading all of it."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip()
+            if not started:
+                if not buffer:
+                    break
+                if buffer[0] != "[":
+                    raise RowError("A JSON diary must be an array")
+                buffer, started = buffer[1:], True
+                continue
+            buffer = buffer.lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            try:
+                row, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise RowError("The JSON diary ends early")
+                break
+            buffer = buffer[end:]
+            yield row
+        if not chunk:
+            return
+
+
+def read_rows(stream, format):
+    """Yield (line or position, row) pairs of a diary file, streaming it."""
+    if format == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == "ndjson":
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except json.JSONDecodeError as error:
+                    yield number, error
+    elif format == "json":
+        yield from enumerate(read_json_array(stream), 1)
+    else:
+        raise ValueError(f"Unknown diary format {format!r}")
+
+
+def recipe_ids(names=None, ids=None):
+    """Map recipe names, also lower cased, and ids to recipe ids.
+
+    Without names or ids it maps every recipe, otherwise only those with
+    one of the names, in any case, or ids, read with one query.
+    """
+    recipes = Recipe.objects.all()
+    if names is not None or ids is not None:
+        recipes = recipes.annotate(lower_name=Lower("name")).filter(
+            Q(lower_name__in={name.lower() for name in names or ()})
+            | Q(id__in=ids or ())
+        )
+    mapping = {}
+    for recipe_id, name in recipes.values_list("id", "name"):
+        mapping.setdefault(name.lower(), recipe_id)
+        mapping[name] = recipe_id
+        mapping[recipe_id] = recipe_id
+    return mapping
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        raise RowError(f"Invalid date {value!r}")
+
+
+def parse_meal(user, row, recipes):
+    """A Meal from a diary row, resolving the recipe with `recipes`.
+
+    The recipe is given by name, or by id as "food".
+    """
+    if row.get("food") is not None:
+        recipe_id = (
+            recipes.get(row["food"]) if type(row["food"]) is int else None
+        )
+        if recipe_id is None:
+            raise RowError(f"Unknown recipe id {row['food']!r}")
+    else:
+        name = str(row.get("recipe") or "").strip()
+        recipe_id = recipes.get(name) or recipes.get(name.lower())
+        if recipe_id is None:
+            raise RowError(f"Unknown recipe {name!r}")
+    try:
+        amount = int(row.get("amount"))
+    except (TypeError, ValueError):
+        raise RowError(f"Invalid amount {row.get('amount')!r}")
+    if amount < 0:
+        raise RowError(f"Invalid amount {amount}")
+    return Meal(
+        user=user,
+        food_id=recipe_id,
+        amount=amount,
+        date=parse_date(row.get("date")),
+    )
+
+
+def parse_reaction(user, row):
+    value = row.get("reaction")
+    if isinstance(value, str):
+        value = value.strip().lower()
+    if value in (1, True, "1", "yes", "true"):
+        reaction = Reaction.YES
+    elif value in (0, False, "0", "no", "false"):
+        reaction = Reaction.NO
+    else:
+        raise RowError(f"Invalid reaction {row.get('reaction')!r}")
+    return Reaction(
+        user=user,
+        date=parse_date(row.get("date")),
+        reaction=reaction,
+        diary=row.get("diary") or "",
+    )
+
+
+def parse_row(user, row, recipes):
+    """The Meal or Reaction a diary row describes."""
+    if not isinstance(row, dict):
+        raise RowError(f"Invalid row: {row}")
+    kind = row.get("type")
+    if kind == "meal":
+        return parse_meal(user, row, recipes)
+    if kind == "reaction":
+        return parse_reaction(user, row)
+    raise RowError(f"Unknown row type {kind!r}")
+
+
+def save_meals(meals):
+    Meal.objects.bulk_create(meals)
+
+
+def save_reactions(reactions):
+    """Insert the reactions, replacing those of the same user and day."""
+    Reaction.objects.bulk_create(
+        reactions,
+        update_conflicts=True,
+        unique_fields=["user", "date"],
+        update_fields=["reaction", "diary"],
+    )
+
+
+def diary_written(user_id):
+    """Let the caches and ranking state know about bulk writes.
+
+    bulk_create does not send the signals the handlers listen to.
+    """
+    versions.bump_user(user_id)
+    state.mark_stale([user_id])
+    jobs.enqueue([user_id])
+
+
+@dataclass
+class ImportReport:
+    meals: int = 0
+    reactions: int = 0
+    rejected: list = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def rows(self):
+        return self.meals + self.reactions + len(self.rejected)
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def import_diary(user, rows, batch_size=1000):
+    """Import the (line, row) pairs of a diary into the user's diary.
+
+    Rows are saved in batches of `batch_size`, each in a transaction of
+    its own. A reaction replaces the one the user had on that day. Rows
+    that cannot be imported are reported with their line and left out.
+    """
+    report = ImportReport()
+    start = time.perf_counter()
+    recipes = recipe_ids()
+    meals = []
+    reactions = {}
+
+    def flush():
+        with transaction.atomic(using=current_shard()):
+            save_meals(meals)
+            save_reactions(list(reactions.values()))
+        report.meals += len(meals)
+        report.reactions += len(reactions)
+        meals.clear()
+        reactions.clear()
+
+    try:
+        rows = iter(rows)
+        line = 0
+        while True:
+            try:
+                line, row = next(rows)
+            except StopIteration:
+                break
+            except (RowError, csv.Error, UnicodeDecodeError) as error:
+                # The rest of the file cannot be read.
+                report.rejected.append((line + 1, str(error)))
+                break
+            try:
+                if isinstance(row, Exception):
+                    raise RowError(f"Invalid row: {row}")
+                entry = parse_row(user, row, recipes)
+            except RowError as error:
+                report.rejected.append((line, str(error)))
+                continue
+
+            if isinstance(entry, Meal):
+                meals.append(entry)
+            else:
+                # The last reaction of a day wins, like in the table.
+                reactions[entry.date] = entry
+            if len(meals) + len(reactions) >= batch_size:
+                flush()
+        flush()
+    finally:
+        # Also when a later batch fails, for the batches already saved.
+        if report.meals or report.reactions:
+            diary_written(user.id)
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def save_batch(user, kind, items):
+    """Validate and save a batch of meals or reactions of the user at once.
+
+    The recipes of all the meals are resolved with one query, and the
+    valid items are saved in one transaction. Returns a result per item,
+    in order: the id of a saved meal, the status of a saved reaction, or
+    the error that kept the item out.
+    """
+    rows = [item if isinstance(item, dict) else {} for item in items]
+    if kind == "meal":
+        recipes = recipe_ids(
+            names=[
+                str(row["recipe"])
+                for row in rows
+                if row.get("recipe") is not None
+            ],
+            ids=[row["food"] for row in rows if type(row.get("food")) is int],
+        )
+
+    entries, results = [], []
+    for item, row in zip(items, rows):
+        try:
+            if item is not row:
+                raise RowError(f"Invalid {kind}: {item!r}")
+            if kind == "meal":
+                entries.append(parse_meal(user, row, recipes))
+            else:
+                entries.append(parse_reaction(user, row))
+            results.append({"status": "saved"})
+        except RowError as error:
+            results.append({"status": "rejected", "error": str(error)})
+
+    if entries:
+        with transaction.atomic(using=current_shard()):
+            if kind == "meal":
+                save_meals(entries)
+            else:
+                # One row per day, the last reaction of a day wins.
+                save_reactions(
+                    list({entry.date: entry for entry in entries}.values())
+                )
+            diary_written(user.id)
+
+    if kind == "meal":
+        saved = iter(entries)
+        for result in results:
+            if result["status"] == "saved":
+                result["id"] = next(saved).id
+    return results
+
+
+def diary_rows(user, since=None, until=None, chunk_size=2000, using=None):
+    """Yield the user's meals and reactions as diary rows, oldest first.
+
+    Both are read with a server side cursor a chunk at a time, the meals
+    joined with their recipe names, and merged by date. `since` and
+    `until` limit the rows to a date range, both ends included. `using`
+    is the database to read them from, as they are read after the caller
+    returns.
+    """
+    meals = Meal.objects.using(using).filter(user=user)
+    reactions = Reaction.objects.using(using).filter(user=user)
+    if since is not None:
+        meals = meals.filter(date__gte=since)
+        reactions = reactions.filter(date__gte=since)
+    if until is not None:
+        meals = meals.filter(date__lte=until)
+        reactions = reactions.filter(date__lte=until)
+
+    meal_rows = (
+        {"type": "meal", "date": day, "recipe": name, "amount": amount}
+        for day, name, amount in meals.order_by("date", "id")
+        .values_list("date", "food__name", "amount")
+        .iterator(chunk_size=chunk_size)
+    )
+    reaction_rows = (
+        {
+            "type": "reaction",
+            "date": day,
+            "reaction": "yes" if reaction == Reaction.YES else "no",
+            "diary": diary,
+        }
+        for day, reaction, diary in reactions.order_by("date")
+        .values_list("date", "reaction", "diary")
+        .iterator(chunk_size=chunk_size)
+    )
+    for row in heapq.merge(meal_rows, reaction_rows, key=itemgetter("date")):
+        row["date"] = row["date"].isoformat()
+        yield row
+
+
+def ranking_rows(ranking):
+    for rank, suspect in enumerate(ranking, 1):
+        yield {
+            "rank": rank,
+            "name": suspect.name,
+            "reactivity": suspect.reactivity,
+            "threshold": suspect.threshold,
+            "lag": suspect.lag,
+        }
+
+
+class Echo:
+    """File-like object that returns what is written to it."""
+
+    def write(self, value):
+        return value
+
+
+def export_lines(rows, format, columns=COLUMNS, rows_per_chunk=500):
+    """Yield the rows as chunks of CSV or NDJSON text.
+
+    A CSV export starts with its header, before any row is read.
+    """
+    if format == "csv":
+        writer = csv.DictWriter(Echo(), columns, extrasaction="ignore")
+        yield writer.writeheader()
+        lines = map(writer.writerow, rows)
+    elif format == "ndjson":
+        lines = (json.dumps(row) + "\n" for row in rows)
+    else:
+        raise ValueError(f"Unknown export format {format!r}")
+
+    while chunk := "".join(islice(lines, rows_per_chunk)):
+        yield chunk
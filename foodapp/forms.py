@@ -0,0 +1,68 @@
+from django import forms
+from django.urls import reverse
+from .diary_io import FORMATS
+from .lookup import recent_recipes
+from .models import Meal, Recipe, RecipeComponent
+
+
+class RecipeTypeahead(forms.Widget):
+    """Recipe picker that looks the recipes up as the user types.
+
+    Unlike a select it never lists the catalog: the page only holds the
+    chosen recipe and the user's recent recipes, the rest comes from the
+    lookup endpoint a page at a time.
+    """
+
+    template_name = "widgets/recipe_typeahead.html"
+
+    class Media:
+        js = ["typeahead.js"]
+
+    def __init__(self, attrs=None, recent=()):
+        super().__init__(attrs)
+        self.recent = recent
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        try:
+            recipe = Recipe.objects.filter(id=int(value)).first()
+        except (TypeError, ValueError):
+            recipe = None
+        context["widget"].update(
+            {
+                "label": recipe.name if recipe else "",
+                "recent": self.recent,
+                "lookup_url": reverse("recipe:lookup"),
+            }
+        )
+        return context
+
+
+class MealForm(forms.ModelForm):
+    class Meta:
+        model = Meal
+        fields = ["date", "food", "amount"]
+        widgets = {"food": RecipeTypeahead}
+
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if user is not None:
+            self.fields["food"].widget.recent = recent_recipes(user.id)
+
+
+class RecipeComponentForm(forms.ModelForm):
+    class Meta:
+        model = RecipeComponent
+        fields = ["component", "percent"]
+        widgets = {"component": RecipeTypeahead}
+
+
+class DiaryImportForm(forms.Form):
+    diary = forms.FileField(
+        help_text="A CSV, NDJSON or JSON file of meals and reactions."
+    )
+    format = forms.ChoiceField(
+        choices=[("", "From the file name")]
+        + [(format, format.upper()) for format in FORMATS],
+        required=False,
+    )
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.utils import make_template_fragment_key
+from .versions import data_version
+
+# Cache keys of the hit and miss counters of a fragment.
+STATS_KEY = "fragment-stats:{}:{}"
+
+
+def fragment_cache():
+    return caches[getattr(settings, "FRAGMENT_CACHE", "default")]
+
+
+def fragment_timeout(name):
+    """The timeout of a fragment from FRAGMENT_TIMEOUTS, by default the
+    cache's own."""
+    return getattr(settings, "FRAGMENT_TIMEOUTS", {}).get(
+        name, DEFAULT_TIMEOUT
+    )
+
+
+def count(name, hits=0, misses=0):
+    """Add to the hit and miss counters of a fragment, kept in the cache
+    itself so that they are shared like the fragments."""
+    cache = fragment_cache()
+    for kind, amount in [("hits", hits), ("misses", misses)]:
+        if not amount:
+            continue
+        key = STATS_KEY.format(name, kind)
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            cache.add(key, amount, timeout=None)
+
+
+def fragment_stats():
+    """Hits, misses and hit ratio of every fragment in FRAGMENT_TIMEOUTS."""
+    names = getattr(settings, "FRAGMENT_TIMEOUTS", {})
+    counters = fragment_cache().get_many(
+        [
+            STATS_KEY.format(name, kind)
+            for name in names
+            for kind in ["hits", "misses"]
+        ]
+    )
+    stats = {}
+    for name in names:
+        hits = counters.get(STATS_KEY.format(name, "hits"), 0)
+        misses = counters.get(STATS_KEY.format(name, "misses"), 0)
+        stats[name] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else None,
+        }
+    return stats
+
+
+def cached_fragments(name, objects, vary_on, render):
+    """The HTML `render` makes of each object, reusing cached fragments.
+
+    Fragments are keyed like {% cache %} keys, on the name and what
+    `vary_on(object)` returns, which should include a data version so
+    that changes start new keys. They are read with one call to the cache
+    and the missing ones written with another.
+    """
+    cache = fragment_cache()
+    keys = [make_template_fragment_key(name, vary_on(obj)) for obj in objects]
+    cached = cache.get_many(keys)
+    missing = {
+        key: render(obj)
+        for key, obj in zip(keys, objects)
+        if key not in cached
+    }
+    if missing:
+        cache.set_many(missing, fragment_timeout(name))
+    count(name, hits=len(cached), misses=len(missing))
+    return [cached[key] if key in cached else missing[key] for key in keys]
+
+
+def user_fragment(name, user_id, vary_on, render):
+    """A fragment of one user's page, rendered by `render` unless cached.
+
+    It is keyed on the user's data version, which the signals bump when
+    the user's meals and reactions or the recipe catalog change.
+    """
+    [html] = cached_fragments(
+        name,
+        [user_id],
+        lambda user_id: [user_id, *data_version(user_id), *vary_on],
+        lambda user_id: render(),
+    )
+    return html
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import logging
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Min, Q
+from django.utils import timezone
+from .batch import serialize_ranking
+from .models import RankingJob, RankingResult
+from .ranker import get_ranker
+from .replicas import replica_reads
+from .shards import user_shard
+
+logger = logging.getLogger(__name__)
+
+
+def background_ranking():
+    return getattr(settings, "RANKING_IN_BACKGROUND", False)
+
+
+def enqueue(user_ids):
+    """Ask for the rankings of the users to be recomputed.
+
+    A user with a waiting job keeps it, pushed back by RANKING_QUEUE_DELAY
+    so a burst of edits is ranked once, but never beyond
+    RANKING_QUEUE_MAX_DELAY after the first of them.
+    """
+    if not background_ranking():
+        return
+    now = timezone.now()
+    run_after = now + timedelta(seconds=settings.RANKING_QUEUE_DELAY)
+    RankingJob.objects.bulk_create(
+        [
+            RankingJob(
+                user_id=user_id,
+                first_requested_at=now,
+                last_requested_at=now,
+                run_after=run_after,
+            )
+            for user_id in set(user_ids)
+        ],
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=[
+            "last_requested_at",
+            "run_after",
+            "attempts",
+            "failed_at",
+        ],
+    )
+
+
+def ready_jobs(now):
+    """Jobs that wait long enough and no worker holds."""
+    max_delay = timedelta(seconds=settings.RANKING_QUEUE_MAX_DELAY)
+    lease = timedelta(seconds=settings.RANKING_QUEUE_LEASE)
+    return RankingJob.objects.filter(
+        Q(run_after__lte=now) | Q(first_requested_at__lte=now - max_delay),
+        Q(started_at=None) | Q(started_at__lt=now - lease),
+        failed_at=None,
+    )
+
+
+def claim_jobs(count):
+    """Take up to `count` ready jobs, the oldest requests first.
+
+    A job is taken by an update that only succeeds if no other worker took
+    it in the meantime, so several workers can share the queue. A worker
+    that dies leaves its jobs to be taken again after RANKING_QUEUE_LEASE.
+    """
+    now = timezone.now()
+    claimed = []
+    for job in ready_jobs(now).order_by("first_requested_at")[:count]:
+        taken = RankingJob.objects.filter(
+            id=job.id, started_at=job.started_at
+        ).update(started_at=now, attempts=F("attempts") + 1)
+        if taken:
+            job.started_at = now
+            job.attempts += 1
+            claimed.append(job)
+    return claimed
+
+
+def run_job(job):
+    """Recompute and store the ranking of the job's user.
+
+    Returns the seconds from the first request to the stored ranking. A
+    job requested again while it ran stays queued, a failed one is retried
+    with a growing delay until it has had RANKING_QUEUE_MAX_ATTEMPTS.
+    """
+    try:
+        user = User.objects.get(id=job.user_id)
+        with user_shard(user.id), replica_reads(user.id):
+            ranking = serialize_ranking(get_ranker(user).get_ranking())
+    except Exception:
+        job_failed(job, traceback.format_exc())
+        raise
+
+    now = timezone.now()
+    with transaction.atomic():
+        RankingResult.objects.update_or_create(
+            user=user,
+            run=None,
+            defaults={"ranking": ranking, "computed_at": now},
+        )
+        done = RankingJob.objects.filter(
+            id=job.id, last_requested_at__lte=job.started_at
+        ).delete()[0]
+        if not done:
+            RankingJob.objects.filter(id=job.id).update(
+                started_at=None,
+                attempts=0,
+                first_requested_at=F("last_requested_at"),
+            )
+    latency = (now - job.first_requested_at).total_seconds()
+    logger.info("ranked user %s, %.2fs after the request", user.id, latency)
+    return latency
+
+
+def job_failed(job, error):
+    now = timezone.now()
+    if job.attempts >= settings.RANKING_QUEUE_MAX_ATTEMPTS:
+        changes = {"failed_at": now}
+    else:
+        delay = settings.RANKING_QUEUE_RETRY_DELAY * 2 ** (job.attempts - 1)
+        changes = {"run_after": now + timedelta(seconds=delay)}
+    RankingJob.objects.filter(id=job.id).update(
+        started_at=None, last_error=error, **changes
+    )
+
+
+def queue_metrics():
+    """How many jobs wait, run and failed, and the age in seconds of the
+    oldest request not served yet."""
+    now = timezone.now()
+    lease = timedelta(seconds=settings.RANKING_QUEUE_LEASE)
+    pending = RankingJob.objects.filter(failed_at=None)
+    running = Q(started_at__gte=now - lease)
+    oldest = pending.aggregate(oldest=Min("first_requested_at"))["oldest"]
+    return {
+        "depth": pending.exclude(running).count(),
+        "running": pending.filter(running).count(),
+        "failed": RankingJob.objects.exclude(failed_at=None).count(),
+        "oldest_seconds": (now - oldest).total_seconds() if oldest else 0.0,
+    }
+
+
+def latest_ranking(user):
+    """The last ranking stored for the user, when it was computed, and
+    whether a newer one is on its way.
+
+    Without a stored ranking or job, a job is queued for one.
+    """
+    result = (
+        RankingResult.objects.filter(user=user, run=None)
+        .only("ranking", "computed_at")
+        .first()
+    )
+    refreshing = RankingJob.objects.filter(user=user, failed_at=None).exists()
+    if result is None:
+        if not refreshing:
+            enqueue([user.id])
+            refreshing = True
+        return [], None, refreshing
+    return result.ranking, result.computed_at, refreshing
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+from django.conf import settings
+from django.core.cache import caches
+from .models import Meal, Recipe
+from .search import search, tokens
+from .versions import catalog_version, data_version
+
+
+def lookup_cache():
+    return caches[getattr(settings, "LOOKUP_CACHE", "default")]
+
+
+def lookup_recipes(query, page=1, size=10):
+    """One page of the recipes matching the query, as (id, name) pairs.
+
+    Pages are cached under the catalog version, so a change to any recipe
+    starts a new set of entries. Returns the page and whether there are
+    more matches after it.
+    """
+    words = " ".join(tokens(query))
+    key = f"lookup:{catalog_version()}:{page}:{size}:{words}"
+    cached = lookup_cache().get(key)
+    if cached is not None:
+        return cached
+
+    matches = search(Recipe, words, limit=page * size + 1)
+    start = (page - 1) * size
+    result = (
+        [
+            (recipe.id, recipe.name)
+            for recipe in matches[start : start + size]
+        ],
+        len(matches) > page * size,
+    )
+    lookup_cache().set(key, result)
+    return result
+
+
+def recent_recipes(user_id, count=8):
+    """The recipes the user ate last, most recent first, as (id, name).
+
+    Only the latest meals are read, from the (user, date, id) index, and
+    the result is cached until the user's diary or the catalog changes.
+    """
+    user_version, catalog = data_version(user_id)
+    key = f"recent:{user_id}:{user_version}:{catalog}:{count}"
+    cached = lookup_cache().get(key)
+    if cached is not None:
+        return cached
+
+    recent = {}
+    meals = (
+        Meal.objects.filter(user=user_id)
+        .order_by("-date", "-id")
+        .select_related("food")
+    )
+    for meal in meals[: count * 10]:
+        recent.setdefault(meal.food_id, meal.food.name)
+        if len(recent) == count:
+            break
+    result = list(recent.items())
+    lookup_cache().set(key, result)
+    return result
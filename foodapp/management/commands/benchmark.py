@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from foodapp.benchmark import run_benchmark, write_results
+from foodapp.ranker import ENGINES
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the rankers and the diary views on synthetic diaries. The "
+        "data is rolled back afterwards, the results are appended to a JSON "
+        "lines file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="30,365,1095",
+            help="Comma separated diary lengths in days.",
+        )
+        parser.add_argument(
+            "--engine",
+            action="append",
+            choices=list(ENGINES),
+            dest="engines",
+            help="Ranker engine to measure, by default all of them.",
+        )
+        parser.add_argument("--repeats", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", default="benchmark.jsonl")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        results = run_benchmark(
+            sizes,
+            engines=options["engines"],
+            repeats=options["repeats"],
+            seed=options["seed"],
+        )
+        for result in write_results(results, options["output"]):
+            self.stdout.write(
+                f"{result['target']:<20} {result['days']:>6} days "
+                f"{result['seconds'] * 1000:>9.1f} ms "
+                f"{result['queries']:>5} queries "
+                f"{result['peak_bytes'] / 1024:>9.0f} KiB"
+            )
+        self.stdout.write(f"Results appended to {options['output']}.")
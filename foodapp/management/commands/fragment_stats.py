@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from foodapp.fragments import fragment_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the hits and misses of the cached template fragments. The "
+        "counters live in FRAGMENT_CACHE, so only a cache shared between "
+        "processes shows those of the web server; /fragments/stats/ shows "
+        "them to staff from within it."
+    )
+
+    def handle(self, *args, **options):
+        for name, stats in fragment_stats().items():
+            ratio = stats["hit_ratio"]
+            self.stdout.write(
+                f"{name}: {stats['hits']} hits, {stats['misses']} misses"
+                + (f", {ratio:.0%} hit ratio" if ratio is not None else "")
+            )
@@ -0,0 +1,52 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from foodapp.synthetic import generate
+
+
+class Command(BaseCommand):
+    help = (
+        "Create a synthetic catalog and synthetic users with a diary, "
+        "for load testing and benchmarks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument(
+            "--days", type=int, default=365, help="Diary length per user."
+        )
+        parser.add_argument(
+            "--meals-per-day",
+            type=int,
+            default=3,
+            help="Average meals per day.",
+        )
+        parser.add_argument("--allergens", type=int, default=14)
+        parser.add_argument("--ingredients", type=int, default=200)
+        parser.add_argument("--recipes", type=int, default=500)
+        parser.add_argument(
+            "--seed", type=int, help="Seed for a reproducible diary."
+        )
+        parser.add_argument(
+            "--prefix",
+            default="synthetic",
+            help="Prefix of the generated names.",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        with transaction.atomic():
+            users = generate(
+                users=options["users"],
+                days=options["days"],
+                meals_per_day=options["meals_per_day"],
+                allergens=options["allergens"],
+                ingredients=options["ingredients"],
+                recipes=options["recipes"],
+                seed=options["seed"],
+                prefix=options["prefix"],
+            )
+        self.stdout.write(
+            f"Created {len(users)} users with {options['days']} days of "
+            f"diary in {time.perf_counter() - start:.1f}s."
+        )
@@ -0,0 +1,59 @@
+import sys
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from foodapp.diary_io import FORMATS, diary_format, import_diary, read_rows
+from foodapp.shards import user_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Import meals and reactions into a user's diary from a CSV, "
+        "NDJSON or JSON file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("path", help="Diary file, or - for stdin.")
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            help="Format of the file, by default from its name or content.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rows saved per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError(f"No user {options['username']!r}")
+
+        with user_shard(user.id):
+            if options["path"] == "-":
+                report = self.import_file(user, sys.stdin, "", options)
+            else:
+                with open(options["path"], encoding="utf-8-sig") as diary:
+                    report = self.import_file(
+                        user, diary, options["path"], options
+                    )
+
+        for line, reason in report.rejected:
+            self.stderr.write(f"Line {line}: {reason}")
+        self.stdout.write(
+            f"Imported {report.meals} meals and {report.reactions} "
+            f"reactions in {report.seconds:.1f}s "
+            f"({report.rows_per_second:.0f} rows/s), "
+            f"rejected {len(report.rejected)} rows."
+        )
+
+    def import_file(self, user, diary, name, options):
+        format = options["format"] or diary_format(diary, name)
+        return import_diary(
+            user,
+            read_rows(diary, format),
+            batch_size=options["batch_size"],
+        )
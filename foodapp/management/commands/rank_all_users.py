@@ -0,0 +1,116 @@
+import multiprocessing
+import time
+from functools import partial
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from foodapp.batch import init_worker, rank_users
+from foodapp.models import RankingResult, RankingRun
+from foodapp.ranker import ENGINES
+
+
+class Command(BaseCommand):
+    help = (
+        "Rank every user and store the rankings. An interrupted run can be "
+        "resumed with --resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help="Number of worker processes, 1 ranks in this process.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=50,
+            help="Users per task, and per bulk insert of the results.",
+        )
+        parser.add_argument(
+            "--engine",
+            choices=list(ENGINES),
+            default="vector",
+            help=(
+                "Ranker engine. The persisted engine writes the state it "
+                "rebuilds, which SQLite cannot do from several workers."
+            ),
+        )
+        parser.add_argument(
+            "--resume",
+            nargs="?",
+            type=int,
+            const=0,
+            metavar="RUN",
+            help="Continue a run, by default the last unfinished one.",
+        )
+
+    def get_run(self, options):
+        if options["resume"] is None:
+            return RankingRun.objects.create(engine=options["engine"])
+
+        runs = RankingRun.objects.filter(finished=None)
+        if options["resume"]:
+            runs = runs.filter(id=options["resume"])
+        run = runs.order_by("-started").first()
+        if run is None:
+            raise CommandError("There is no unfinished run to resume.")
+        return run
+
+    def handle(self, *args, **options):
+        run = self.get_run(options)
+        user_ids = list(
+            User.objects.exclude(rankingresult__run=run)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        chunk_size = options["chunk_size"]
+        chunks = [
+            user_ids[i : i + chunk_size]
+            for i in range(0, len(user_ids), chunk_size)
+        ]
+        self.stdout.write(
+            f"Ranking {len(user_ids)} users in run {run.id} "
+            f"with {options['workers']} workers."
+        )
+
+        rank = partial(rank_users, engine=run.engine)
+        workers = {}
+        start = time.perf_counter()
+        if options["workers"] > 1:
+            # Forked workers must not share the parent's connections.
+            connections.close_all()
+            with multiprocessing.Pool(
+                options["workers"], initializer=init_worker
+            ) as pool:
+                for result in pool.imap_unordered(rank, chunks):
+                    self.save(run, result, workers)
+        else:
+            for chunk in chunks:
+                self.save(run, rank(chunk), workers)
+        elapsed = time.perf_counter() - start
+
+        run.finished = timezone.now()
+        run.save()
+
+        self.stdout.write(
+            f"Ranked {len(user_ids)} users in {elapsed:.2f}s "
+            f"({len(user_ids) / max(elapsed, 1e-9):.1f} users/s)."
+        )
+        for pid, (users, busy) in sorted(workers.items()):
+            self.stdout.write(
+                f"  worker {pid}: {users} users in {busy:.2f}s "
+                f"({users / max(busy, 1e-9):.1f} users/s)"
+            )
+
+    def save(self, run, result, workers):
+        pid, busy, rankings = result
+        with transaction.atomic():
+            RankingResult.objects.bulk_create(
+                RankingResult(run=run, user_id=user_id, ranking=ranking)
+                for user_id, ranking in rankings
+            )
+        users, total = workers.get(pid, (0, 0))
+        workers[pid] = (users + len(rankings), total + busy)
@@ -0,0 +1,54 @@
+from collections import Counter
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from foodapp.jobs import enqueue
+from foodapp.models import UserShard
+from foodapp.shards import hash_shard, move_user, shards, sync_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the catalog to every shard in DATABASE_SHARDS and move each "
+        "user's diary to the shard the user hashes to."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only show how many users would move where.",
+        )
+
+    def handle(self, *args, **options):
+        if not shards():
+            raise CommandError("DATABASE_SHARDS is empty.")
+
+        current = dict(UserShard.objects.values_list("user_id", "database"))
+        moves = []
+        for user_id in User.objects.order_by("id").values_list(
+            "id", flat=True
+        ):
+            source = current.get(user_id, DEFAULT_DB_ALIAS)
+            target = hash_shard(user_id)
+            if source != target:
+                moves.append((user_id, source, target))
+
+        for (source, target), users in sorted(
+            Counter((source, target) for _, source, target in moves).items()
+        ):
+            self.stdout.write(f"  {source} -> {target}: {users} users")
+        if options["dry_run"]:
+            return
+
+        sync_catalog()
+        meals = reactions = 0
+        for user_id, source, target in moves:
+            moved = move_user(user_id, source, target)
+            meals += moved[0]
+            reactions += moved[1]
+        enqueue(user_id for user_id, _, _ in moves)
+        self.stdout.write(
+            f"Moved {len(moves)} users with {meals} meals and "
+            f"{reactions} reactions."
+        )
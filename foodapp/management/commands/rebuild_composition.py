@@ -0,0 +1,24 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from foodapp.composition import rebuild_all_compositions
+from foodapp.jobs import enqueue
+from foodapp.models import RankingState, RecipeComposition
+from foodapp.shards import diary_databases
+from foodapp.versions import bump_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the flattened composition of every recipe, and with it the "
+        "stored ranking state of every user."
+    )
+
+    def handle(self, *args, **options):
+        rebuild_all_compositions()
+        for alias in diary_databases():
+            RankingState.objects.using(alias).update(is_stale=True)
+        bump_catalog()
+        enqueue(User.objects.values_list("id", flat=True))
+        self.stdout.write(
+            f"Rebuilt {RecipeComposition.objects.count()} composition rows."
+        )
@@ -0,0 +1,94 @@
+import logging
+import statistics
+import time
+from collections import deque
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from foodapp.jobs import claim_jobs, queue_metrics, run_job
+
+logger = logging.getLogger("foodapp.jobs")
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the rankings queued as users edit their diary. Any "
+        "number of workers can share the queue."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10,
+            help="Jobs taken from the queue at a time.",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=1.0,
+            help="Seconds to wait when the queue is empty.",
+        )
+        parser.add_argument(
+            "--metrics-every",
+            type=float,
+            default=60.0,
+            help="Seconds between reports of the queue metrics.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Stop once no job is ready instead of waiting for more.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.RANKING_IN_BACKGROUND:
+            self.stderr.write(
+                "RANKING_IN_BACKGROUND is off, nothing will be queued."
+            )
+        self.latencies = deque(maxlen=1000)
+        self.ranked = self.failures = 0
+        reported = time.monotonic()
+        try:
+            while True:
+                jobs = claim_jobs(options["batch_size"])
+                for job in jobs:
+                    self.run(job)
+                if time.monotonic() - reported >= options["metrics_every"]:
+                    self.report()
+                    reported = time.monotonic()
+                if not jobs:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll"])
+        except KeyboardInterrupt:
+            pass
+        self.report()
+
+    def run(self, job):
+        try:
+            self.latencies.append(run_job(job))
+            self.ranked += 1
+        except Exception:
+            self.failures += 1
+            logger.exception(
+                "ranking user %s failed, attempt %d",
+                job.user_id,
+                job.attempts,
+            )
+
+    def report(self):
+        metrics = queue_metrics()
+        line = (
+            f"queue depth {metrics['depth']}, running {metrics['running']}, "
+            f"failed {metrics['failed']}, oldest request "
+            f"{metrics['oldest_seconds']:.1f}s; ranked "
+            f"{self.ranked} users, {self.failures} failures"
+        )
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            line += (
+                f", latency median {statistics.median(latencies):.2f}s "
+                f"p95 {p95:.2f}s"
+            )
+        self.stdout.write(line)
@@ -1,3 +1,4 @@
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from django.db import models
@@ -53,12 +54,21 @@ class Recipe(models.Model):
     )
 
     def get_sum_ingredients(self):
-        ingredients = self.ingredientrecipe_set.all()
+        ingredients = self.recipeingredient_set.all()
         total = 0
         for ingredient in ingredients:
             total += ingredient.percent
+        for component in self.components.all():
+            total += component.percent
         return total
 
+    def ancestor_ids(self):
+        """Ids of the recipes that contain this one, at any depth."""
+        # The same walk decides which recipes a change rebuilds.
+        from .composition import with_ancestors
+
+        return with_ancestors([self.id]) - {self.id}
+
     def is_percent_possible(self, percent):
         if self.get_sum_ingredients() + percent <= 100:
             return True
@@ -82,9 +92,80 @@ class RecipeIngredient(models.Model):
         return reverse("recipe:update", kwargs={"pk": self.recipe.id})
 
 
+class RecipeComponent(models.Model):
+    """A recipe used as an ingredient of another recipe."""
+
+    recipe = models.ForeignKey(
+        Recipe, on_delete=models.CASCADE, related_name="components"
+    )
+    component = models.ForeignKey(
+        Recipe, on_delete=models.CASCADE, related_name="used_in"
+    )
+    percent = models.PositiveIntegerField(
+        validators=[MinValueValidator(1), MaxValueValidator(100)]
+    )
+
+    def creates_cycle(self):
+        return (
+            self.component_id == self.recipe_id
+            or self.component_id in self.recipe.ancestor_ids()
+        )
+
+    def clean(self):
+        if self.recipe_id is not None and self.creates_cycle():
+            raise ValidationError(
+                {
+                    "component": f"{self.component} already contains "
+                    f"{self.recipe}"
+                }
+            )
+
+    def get_absolute_url(self):
+        return reverse("recipe:update", kwargs={"pk": self.recipe.id})
+
+    class Meta:
+        unique_together = ("recipe", "component")
+
+
+# RecipeComposition stores fractions as parts per COMPOSITION_SCALE. A
+# percent of a percent of a percent of a percent is a part per 10**8, so
+# allergens stay exact through two levels of sub-recipes.
+COMPOSITION_SCALE = 10**8
+
+
+class RecipeComposition(models.Model):
+    """How much of each suspect one gram of a recipe contains.
+
+    The rows are derived from RecipeIngredient, IngredientAllergen and the
+    compositions of the sub-recipes, and rebuilt by the signal handlers
+    whenever those change.
+    """
+
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
+    suspect = models.CharField(max_length=100)
+    parts = models.PositiveIntegerField()
+
+    @property
+    def fraction(self):
+        return self.parts / COMPOSITION_SCALE
+
+    def __str__(self):
+        return f"{self.recipe} contains {self.fraction:.4f} {self.suspect}"
+
+    class Meta:
+        unique_together = ("recipe", "suspect")
+
+
+# The diary tables can be on a shard while the users are in the default
+# database, so their user columns are not foreign key constraints.
+
+
 class Meal(models.Model):
     user = models.ForeignKey(
-        User, on_delete=models.CASCADE, verbose_name="user"
+        User,
+        on_delete=models.CASCADE,
+        verbose_name="user",
+        db_constraint=False,
     )
     food = models.ForeignKey(Recipe, on_delete=models.CASCADE)
     amount = models.PositiveIntegerField()
@@ -98,9 +179,14 @@ class Meal(models.Model):
             f"{self.user} ate {self.amount}g of {self.food.name} {self.date}"
         )
 
+    class Meta:
+        indexes = [models.Index(fields=["user", "date", "id"])]
+
 
 class Reaction(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, db_constraint=False
+    )
     date = models.DateField(default=timezone.now)
     NO = 0
     YES = 1
@@ -120,3 +206,119 @@ class Reaction(models.Model):
 
     class Meta:
         unique_together = ("user", "date")
+
+
+class ReactionExposure(models.Model):
+    """How much of a suspect the user ate in the window of a reaction."""
+
+    reaction = models.ForeignKey(Reaction, on_delete=models.CASCADE)
+    suspect = models.CharField(max_length=100)
+    parts = models.PositiveBigIntegerField()
+
+    @property
+    def amount(self):
+        return self.parts / COMPOSITION_SCALE
+
+    class Meta:
+        unique_together = ("reaction", "suspect")
+
+
+class SuspectState(models.Model):
+    """A suspect as the ranker left it after the user's last reaction."""
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, db_constraint=False
+    )
+    name = models.CharField(max_length=100)
+    threshold_parts = models.PositiveBigIntegerField()
+    reactivity = models.PositiveIntegerField()
+    position = models.PositiveIntegerField()
+
+    @property
+    def threshold(self):
+        return self.threshold_parts / COMPOSITION_SCALE
+
+    class Meta:
+        unique_together = ("user", "name")
+        ordering = ["position"]
+
+
+class RankingState(models.Model):
+    """Bookkeeping of the suspect state stored for a user.
+
+    The ranker goes through the reactions newest first, so the last
+    processed reaction is the oldest one.
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, db_constraint=False
+    )
+    last_reaction_date = models.DateField(null=True)
+    is_stale = models.BooleanField(default=False)
+
+
+class UserShard(models.Model):
+    """The database of the user's diary, see foodapp.shards.
+
+    Users without one have their diary in the default database.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    database = models.CharField(max_length=100)
+
+    def __str__(self):
+        return f"{self.user} is on {self.database}"
+
+
+class DataVersion(models.Model):
+    """Version of some data, changed by every write to it.
+
+    The scope is "catalog" for recipes, ingredients and allergens, and
+    "user:<id>" for the meals and reactions of a user.
+    """
+
+    scope = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField()
+
+
+class RankingRun(models.Model):
+    """A run of `manage.py rank_all_users`."""
+
+    engine = models.CharField(max_length=20)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"Ranking run {self.id} started {self.started}"
+
+
+class RankingResult(models.Model):
+    """The ranking of a user, as a list of suspects."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    run = models.ForeignKey(RankingRun, on_delete=models.CASCADE, null=True)
+    ranking = models.JSONField()
+    computed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("run", "user")
+
+
+class RankingJob(models.Model):
+    """A request to recompute the ranking of a user in the background.
+
+    There is at most one job per user: edits made while the job waits are
+    coalesced into it, and edits made while it runs make it run again.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    first_requested_at = models.DateTimeField()
+    last_requested_at = models.DateTimeField()
+    run_after = models.DateTimeField()
+    started_at = models.DateTimeField(null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    failed_at = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Ranking job of {self.user}"
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+from datetime import date
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+
+
+def cursor_of(row):
+    return f"{row.date.isoformat()}.{row.id}"
+
+
+def parse_cursor(cursor):
+    """The (date, id) of a cursor made by `cursor_of`."""
+    try:
+        day, row_id = cursor.split(".")
+        return date.fromisoformat(day), int(row_id)
+    except ValueError:
+        raise BadRequest(f"Invalid page cursor {cursor!r}")
+
+
+def keyset_page(queryset, size, before=None, after=None):
+    """One page of rows sorted newest first by (date, id).
+
+    Without a cursor it is the newest page. `before` gives the page of rows
+    older than the cursor and `after` the page of rows newer than it. Every
+    page is read with one query on (date, id), however deep it is, and
+    comes with the cursors of the pages before and after it, or None at
+    either end.
+    """
+    if after is not None:
+        day, row_id = parse_cursor(after)
+        rows = list(
+            queryset.filter(Q(date__gt=day) | Q(date=day, id__gt=row_id))
+            .order_by("date", "id")[: size + 1]
+        )
+        has_newer, has_older = len(rows) > size, True
+        rows = rows[:size][::-1]
+    else:
+        if before is not None:
+            day, row_id = parse_cursor(before)
+            queryset = queryset.filter(
+                Q(date__lt=day) | Q(date=day, id__lt=row_id)
+            )
+        rows = list(queryset.order_by("-date", "-id")[: size + 1])
+        has_older, has_newer = len(rows) > size, before is not None
+        rows = rows[:size]
+
+    if not rows:
+        return rows, None, None
+    return (
+        rows,
+        cursor_of(rows[-1]) if has_older else None,
+        cursor_of(rows[0]) if has_newer else None,
+    )
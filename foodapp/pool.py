@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, connections
+
+
+class RankerBusy(Exception):
+    """More rankings are pending than RANKER_MAX_PENDING allows."""
+
+
+_lock = threading.Lock()
+_pending = 0
+_pool = None
+
+
+def ranker_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=settings.RANKER_WORKERS,
+                thread_name_prefix="ranker",
+            )
+        return _pool
+
+
+def run_closing(function, *args):
+    """Call the function, then close the database connections it opened."""
+    try:
+        return function(*args)
+    finally:
+        connections.close_all()
+
+
+async def run_ranker(function, *args):
+    """Run a blocking ranker function without blocking the event loop.
+
+    It runs in the pool of RANKER_WORKERS threads, so slow rankings only
+    wait for each other and not for the rest of the requests. At most
+    RANKER_MAX_PENDING of them run or wait at once, more raise RankerBusy.
+
+    Without workers, or inside a transaction whose writes other
+    connections could not see, it runs in the thread Django keeps for
+    synchronous code instead.
+    """
+    global _pending
+    in_transaction = await sync_to_async(lambda: connection.in_atomic_block)()
+    if not settings.RANKER_WORKERS or in_transaction:
+        return await sync_to_async(function)(*args)
+
+    with _lock:
+        if _pending >= settings.RANKER_MAX_PENDING:
+            raise RankerBusy
+        _pending += 1
+    try:
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            ranker_pool(), context.run, run_closing, function, *args
+        )
+    finally:
+        with _lock:
+            _pending -= 1
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from .queries import count_queries
+
+logger = logging.getLogger(__name__)
+
+
+class NullProfile:
+    """Profile that records nothing, used while no profile is active."""
+
+    enabled = False
+
+    def stage(self, name):
+        return nullcontext()
+
+    def count(self, name, amount=1):
+        pass
+
+
+class RankerProfile:
+    """Time and queries per ranker stage, and counters.
+
+    The stages are "fetch" (reading the diary), "windows" (summing the
+    suspects in the reaction windows), "update" (updating the suspects with
+    each window) and "sort" (ranking them).
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.seconds = {}
+        self.queries = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with count_queries() as queries:
+                yield
+        finally:
+            self.seconds[name] = (
+                self.seconds.get(name, 0.0) + time.perf_counter() - start
+            )
+            self.queries[name] = self.queries.get(name, 0) + queries.count
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        return {
+            "stages": {
+                name: {
+                    "seconds": seconds,
+                    "queries": self.queries[name],
+                }
+                for name, seconds in self.seconds.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+
+NULL_PROFILE = NullProfile()
+_current = ContextVar("ranker_profile", default=NULL_PROFILE)
+
+
+def current_profile():
+    """The active profile, or a NullProfile when not profiling."""
+    return _current.get()
+
+
+@contextmanager
+def profile_ranking(label=""):
+    """Profile the rankers used inside the block and log the result."""
+    profile = RankerProfile()
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+        logger.info("ranker profile %s: %s", label, profile.as_dict())
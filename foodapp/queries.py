@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+from asgiref.sync import (
+    iscoroutinefunction,
+    markcoroutinefunction,
+    sync_to_async,
+)
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    """Database execute wrapper that counts the queries and their time.
+
+    Unlike CaptureQueriesContext it does not keep the queries, so it has no
+    limit on how many it can count and works without DEBUG.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def wrap_connections(wrapper):
+    """Install the execute wrapper on every database until the stack closes."""
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(wrapper))
+    return stack
+
+
+@contextmanager
+def count_queries():
+    """Count the queries on every database inside the block."""
+    counter = QueryCounter()
+    with wrap_connections(counter):
+        yield counter
+
+
+def query_budget(queries):
+    """Declare how many queries a view may make per request.
+
+    The budget includes the session and user lookups of the middleware.
+    Other middleware adds the queries it makes to `request.extra_queries`.
+    It is checked by QueryBudgetMiddleware at runtime and by the tests.
+    """
+
+    def decorate(view):
+        view.query_budget = queries
+        return view
+
+    return decorate
+
+
+def budget_of(view_func):
+    view = getattr(view_func, "view_class", view_func)
+    return getattr(view, "query_budget", None)
+
+
+class QueryBudgetMiddleware:
+    """Log the query count and SQL time of every request.
+
+    Requests over the budget of their view are logged as warnings. Queries
+    made while a streaming response is consumed, or by the ranker pool, are
+    not counted. It works in both sync and async stacks, so it does not
+    make Django run async views in its sync thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with count_queries() as queries:
+            response = self.get_response(request)
+        self.log(request, queries)
+        return response
+
+    async def __acall__(self, request):
+        # The connections of the sync thread are the ones the ORM uses.
+        queries = QueryCounter()
+        stack = await sync_to_async(wrap_connections)(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        self.log(request, queries)
+        return response
+
+    def log(self, request, queries):
+        budget = getattr(request, "query_budget", None)
+        if budget is not None:
+            budget += getattr(request, "extra_queries", 0)
+        if budget is not None and queries.count > budget:
+            log = logger.warning
+        else:
+            log = logger.info
+        log(
+            "%s %s: %d queries (budget %s) in %.1f ms",
+            request.method,
+            request.path,
+            queries.count,
+            budget,
+            queries.seconds * 1000,
+        )
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = budget_of(view_func)
@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
-from dataclasses import dataclass
-from .models import Meal, Reaction
+import numpy as np
+from collections import deque
+from dataclasses import dataclass, field
+from functools import cached_property
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from .composition import composition_of, flatten_recipe
+from .models import COMPOSITION_SCALE, Meal, Reaction
+from .profiling import current_profile
 from datetime import timedelta
 
 
@@ -10,109 +18,591 @@ class Suspect:
     name: str
     threshold: int = 0
     reactivity: int = 0
+    lag: int = 0
+
+
+@dataclass
+class LaggedSuspect(Suspect):
+    reactivity_per_lag: list = field(default_factory=list)
 
 
 class Ranker:
+    # Whether CachedRanker keeps the exposures of every reaction window.
+    cache_exposures = True
+
+    @classmethod
+    def parameters(cls):
+        """The settings the ranking depends on, by name, so that
+        CachedRanker keeps the rankings of each setting apart."""
+        return {}
+
     def __init__(self, user):
         self.user = user
-        self.meals = Meal.objects.filter(user=user).order_by("-date")
+        self.meals = Meal.objects.filter(user=user).order_by("-date", "id")
         self.reactions = Reaction.objects.filter(user=user).order_by("-date")
         self.suspects = {}
         self.analyse_reactions()
 
     def suspects_in_reaction_window(self, reaction_date):
         """How much of each suspect the user ate before the reaction."""
+        profile = current_profile()
         day_before = reaction_date - timedelta(days=1)
-        relevant_meals = self.meals.filter(
-            date__range=[day_before, reaction_date]
-        )
+        with profile.stage("fetch"):
+            relevant_meals = list(
+                self.meals.filter(date__range=[day_before, reaction_date])
+            )
+        profile.count("meals", len(relevant_meals))
 
-        suspects_in_window = {}
-
-        def log_suspect(suspect_key, amount):
-            if suspect_key in suspects_in_window.keys():
-                suspects_in_window[suspect_key] += amount
-            else:
-                suspects_in_window[suspect_key] = amount
-
-        for meal in relevant_meals:
-            for ingredient in meal.food.recipeingredient_set.all():
-                allergens = ingredient.ingredient.ingredientallergen_set.all()
-                if allergens:
-                    for allergen in allergens:
-                        log_suspect(
-                            allergen.allergen.name,
-                            amount_allergen(
-                                meal.amount,
-                                ingredient.percent,
-                                allergen.percent,
-                            ),
-                        )
-                else:
-                    log_suspect(
-                        ingredient.ingredient.name,
-                        amount_ingredient(meal.amount, ingredient.percent),
-                    )
-        return suspects_in_window
+        with profile.stage("windows"):
+            return suspects_in_meals(relevant_meals)
 
     def analyse_reactions(self):
-        for reaction in self.reactions:
+        profile = current_profile()
+        self.exposures = {}
+        with profile.stage("fetch"):
+            reactions = list(self.reactions)
+        for reaction in reactions:
             suspects_in_window = self.suspects_in_reaction_window(
                 reaction.date
             )
-            for suspect_name, amount in suspects_in_window.items():
-                if suspect_name in self.suspects.keys():
-                    if self.suspects[suspect_name].threshold <= amount:
-                        if reaction.reaction:
-                            self.suspects[suspect_name].reactivity += 1
-                        else:
-                            self.suspects[suspect_name].reactivity = 0
+            self.exposures[reaction] = suspects_in_window
+            with profile.stage("update"):
+                self.update_suspects(reaction, suspects_in_window)
+
+    def update_suspects(self, reaction, suspects_in_window):
+        """Update thresholds and reactivity with one reaction window."""
+        profile = current_profile()
+        profile.count("windows")
+        profile.count("suspects", len(suspects_in_window))
+        for suspect_name, amount in suspects_in_window.items():
+            if suspect_name in self.suspects.keys():
+                if self.suspects[suspect_name].threshold <= amount:
+                    if reaction.reaction:
+                        self.suspects[suspect_name].reactivity += 1
                     else:
-                        if reaction.reaction:
-                            self.suspects[suspect_name].reactivity += 1
-                            self.suspects[suspect_name].threshold = amount
+                        self.suspects[suspect_name].reactivity = 0
                 else:
-                    self.suspects[suspect_name] = Suspect(
-                        suspect_name,
-                        amount,
-                    )
+                    if reaction.reaction:
+                        self.suspects[suspect_name].reactivity += 1
+                        self.suspects[suspect_name].threshold = amount
+            else:
+                self.suspects[suspect_name] = Suspect(
+                    suspect_name,
+                    amount,
+                )
 
     def get_ranking(self):
         ranking = []
 
-        for food, suspect in self.suspects.items():
-            if suspect.reactivity != 0:
-                ranking.append(suspect)
+        with current_profile().stage("sort"):
+            for food, suspect in self.suspects.items():
+                if suspect.reactivity != 0:
+                    ranking.append(suspect)
 
-        ranking.sort(key=lambda x: x.reactivity, reverse=True)
+            ranking.sort(key=lambda x: x.reactivity, reverse=True)
 
         return ranking
 
+    def reaction_exposures(self):
+        """How much of each suspect the user ate before each reaction.
+
+        These are the windows the analysis went through, kept as they were.
+        """
+        return self.exposures
+
+    @cached_property
+    def exposure_index(self):
+        """The exposures by suspect, then by reaction."""
+        index = {}
+        for reaction, suspects_in_window in self.reaction_exposures().items():
+            for suspect_name, amount in suspects_in_window.items():
+                index.setdefault(suspect_name, {})[reaction] = amount
+        return index
+
+    def exposure_series(self, suspect_name):
+        """Amount of the suspect eaten before each reaction, newest first."""
+        amounts = self.exposure_index.get(suspect_name, {})
+        return [
+            (reaction, amounts.get(reaction, 0))
+            for reaction in self.reactions
+        ]
+
     def suspect_amount_per_reaction(self, suspect_name):
-        amount_per_reaction = {}
-        for reaction in self.reactions:
-            suspects_in_window = self.suspects_in_reaction_window(
-                reaction.date
+        return dict(self.exposure_series(suspect_name))
+
+
+class SlidingWindowRanker(Ranker):
+    """Ranker that loads the diary once and slides the window over it.
+
+    Meals, reactions and the flattened composition of the recipes eaten are
+    fetched up front, so the number of queries stays the same however long
+    the diary is. Amounts are summed in exact parts per COMPOSITION_SCALE.
+    """
+
+    def __init__(self, user):
+        profile = current_profile()
+        self.user = user
+        with profile.stage("fetch"):
+            self.meals = list(
+                Meal.objects.filter(user=user).order_by("-date", "id")
+            )
+            self.reactions = list(
+                Reaction.objects.filter(user=user).order_by("-date")
+            )
+            self.composition = composition_of(
+                meal.food_id for meal in self.meals
+            )
+        profile.count("meals", len(self.meals))
+        self.suspects = {}
+        self.analyse_reactions()
+
+    def reaction_windows(self):
+        return reaction_windows(self.reactions, self.meals)
+
+    def suspects_in_meals(self, meals):
+        return {
+            suspect_name: parts / COMPOSITION_SCALE
+            for suspect_name, parts in parts_in_meals(
+                meals, self.composition
+            ).items()
+        }
+
+    def suspects_in_reaction_window(self, reaction_date):
+        day_before = reaction_date - timedelta(days=1)
+        return self.suspects_in_meals(
+            meal
+            for meal in self.meals
+            if day_before <= meal.date <= reaction_date
+        )
+
+    def analyse_reactions(self):
+        profile = current_profile()
+        self.exposures = {}
+        for reaction, meals in self.reaction_windows():
+            with profile.stage("windows"):
+                suspects_in_window = self.suspects_in_meals(meals)
+            self.exposures[reaction] = suspects_in_window
+            with profile.stage("update"):
+                self.update_suspects(reaction, suspects_in_window)
+
+
+class StreamingRanker(SlidingWindowRanker):
+    """Ranker that streams the diary instead of loading it.
+
+    Meals and reactions are read newest first in chunks of
+    RANKER_CHUNK_SIZE rows, and only the meals of the current window are
+    kept, so memory depends on the window and not on the length of the
+    diary. The windows are not kept either: exposures are streamed again
+    when asked for.
+    """
+
+    cache_exposures = False
+
+    def __init__(self, user, chunk_size=None):
+        self.user = user
+        self.chunk_size = chunk_size or getattr(
+            settings, "RANKER_CHUNK_SIZE", 2000
+        )
+        self.reactions = Reaction.objects.filter(user=user).order_by("-date")
+        with current_profile().stage("fetch"):
+            # The diary can be on a shard, so its recipes are read before
+            # the catalog rather than in a subquery.
+            self.composition = composition_of(
+                list(
+                    Meal.objects.filter(user=user)
+                    .values_list("food_id", flat=True)
+                    .distinct()
+                )
+            )
+        self.suspects = {}
+        self.analyse_reactions()
+
+    def reaction_windows(self):
+        profile = current_profile()
+        meals = (
+            Meal.objects.filter(user=self.user)
+            .order_by("-date", "id")
+            .only("date", "food_id", "amount")
+            .iterator(chunk_size=self.chunk_size)
+        )
+        upcoming = next(meals, None)
+        window = deque()
+
+        for reaction in self.reactions.iterator(chunk_size=self.chunk_size):
+            day_before = reaction.date - timedelta(days=1)
+            while window and window[0].date > reaction.date:
+                window.popleft()
+            while upcoming is not None and upcoming.date >= day_before:
+                if upcoming.date <= reaction.date:
+                    window.append(upcoming)
+                profile.count("meals")
+                upcoming = next(meals, None)
+            yield reaction, window
+
+    def analyse_reactions(self):
+        profile = current_profile()
+        for reaction, meals in self.reaction_windows():
+            with profile.stage("windows"):
+                suspects_in_window = self.suspects_in_meals(meals)
+            with profile.stage("update"):
+                self.update_suspects(reaction, suspects_in_window)
+
+    def reaction_exposures(self):
+        return {
+            reaction: self.suspects_in_meals(meals)
+            for reaction, meals in self.reaction_windows()
+        }
+
+    def exposure_series(self, suspect_name):
+        return [
+            (reaction, self.suspects_in_meals(meals).get(suspect_name, 0))
+            for reaction, meals in self.reaction_windows()
+        ]
+
+
+class VectorRanker(SlidingWindowRanker):
+    """Ranker that evaluates the reaction windows as numpy arrays.
+
+    The diary becomes a day x suspect matrix of exposures, every reaction
+    window is read from its cumulative sum, and each reaction updates the
+    thresholds and reactivity of all suspects at once. Only the reactions
+    that introduce new suspects walk their meals, to keep the order in which
+    `SlidingWindowRanker` discovers suspects.
+    """
+
+    def exposure_matrix(self, days_before=1):
+        """Exposures per day (rows) and suspect (columns) of the diary.
+
+        The first row is `days_before` days before the first entry, so that
+        every window starts inside the matrix.
+        """
+        columns = {}
+        for rows in self.composition.values():
+            for suspect_name, parts in rows:
+                columns.setdefault(suspect_name, len(columns))
+
+        dates = [meal.date for meal in self.meals]
+        dates += [reaction.date for reaction in self.reactions]
+        first_day = min(dates) - timedelta(days=days_before)
+        days = (max(dates) - first_day).days + 1
+
+        # Lay the composition rows of all recipes end to end, then expand
+        # every meal into the rows of its recipe.
+        recipes = {}
+        row_columns = []
+        row_parts = []
+        for recipe_id, rows in self.composition.items():
+            recipes[recipe_id] = (len(row_columns), len(rows))
+            for suspect_name, parts in rows:
+                row_columns.append(columns[suspect_name])
+                row_parts.append(parts)
+
+        meals = [meal for meal in self.meals if meal.food_id in recipes]
+        start, length = (
+            np.array(
+                [recipes[meal.food_id] for meal in meals], dtype=np.int64
+            )
+            .reshape(-1, 2)
+            .T
+        )
+        meal_day = np.array(
+            [(meal.date - first_day).days for meal in meals], dtype=np.int64
+        )
+        meal_amount = np.array(
+            [meal.amount for meal in meals], dtype=np.int64
+        )
+
+        meal_of_row = np.repeat(np.arange(len(meals)), length)
+        row = (
+            np.arange(len(meal_of_row))
+            - np.repeat(np.cumsum(length) - length, length)
+            + start[meal_of_row]
+        )
+        day = meal_day[meal_of_row]
+        column = np.array(row_columns, dtype=np.int64)[row]
+        parts = np.array(row_parts, dtype=np.int64)[row]
+
+        exposure = np.zeros((days, len(columns)), dtype=np.int64)
+        eaten = np.zeros((days, len(columns)), dtype=np.int32)
+        np.add.at(exposure, (day, column), meal_amount[meal_of_row] * parts)
+        np.add.at(eaten, (day, column), 1)
+        return columns, first_day, exposure, eaten
+
+    def analyse_reactions(self):
+        self.columns = {}
+        self.amounts = np.zeros((len(self.reactions), 0), dtype=np.int64)
+        self.present = np.zeros((len(self.reactions), 0), dtype=bool)
+        if not self.reactions:
+            return
+
+        profile = current_profile()
+        with profile.stage("windows"):
+            columns, first_day, exposure, eaten = self.exposure_matrix()
+            names = list(columns)
+
+            # Row d + 1 of the cumulative sums holds the total up to day d,
+            # so the window of day d (the day before and the day itself) is
+            # total[d + 1] - total[d - 1].
+            def windows(daily):
+                total = np.zeros(
+                    (len(daily) + 1, len(columns)), dtype=np.int64
+                )
+                np.cumsum(daily, axis=0, out=total[1:])
+                days = np.array(
+                    [
+                        (reaction.date - first_day).days
+                        for reaction in self.reactions
+                    ]
+                )
+                return total[days + 1] - total[days - 1]
+
+            amounts = windows(exposure)
+            present = windows(eaten) > 0
+        self.columns, self.amounts, self.present = columns, amounts, present
+        profile.count("windows", len(self.reactions))
+        profile.count("suspects", int(present.sum()))
+
+        known = np.zeros(len(columns), dtype=bool)
+        threshold = np.zeros(len(columns), dtype=np.int64)
+        reactivity = np.zeros(len(columns), dtype=np.int64)
+        order = []
+
+        with profile.stage("update"):
+            for i, (reaction, meals) in enumerate(self.reaction_windows()):
+                amount = amounts[i]
+                seen = present[i] & known
+                new = present[i] & ~known
+
+                if reaction.reaction:
+                    reactivity[seen] += 1
+                    lower = seen & (amount < threshold)
+                    threshold[lower] = amount[lower]
+                else:
+                    reactivity[seen & (threshold <= amount)] = 0
+
+                if new.any():
+                    threshold[new] = amount[new]
+                    known |= new
+                    for suspect_name in self.suspects_in_meals(meals):
+                        if new[columns[suspect_name]]:
+                            order.append(columns[suspect_name])
+                            new[columns[suspect_name]] = False
+
+        for column in order:
+            self.suspects[names[column]] = Suspect(
+                names[column],
+                int(threshold[column]) / COMPOSITION_SCALE,
+                int(reactivity[column]),
             )
 
-            if suspect_name in suspects_in_window.keys():
-                amount_per_reaction[reaction] = suspects_in_window[
-                    suspect_name
+    def reaction_exposures(self):
+        names = list(self.columns)
+        return {
+            reaction: {
+                names[column]: int(self.amounts[i, column])
+                / COMPOSITION_SCALE
+                for column in np.flatnonzero(self.present[i])
+            }
+            for i, reaction in enumerate(self.reactions)
+        }
+
+    def exposure_series(self, suspect_name):
+        if suspect_name not in self.columns:
+            return [(reaction, 0) for reaction in self.reactions]
+        amounts = self.amounts[:, self.columns[suspect_name]]
+        return [
+            (reaction, int(amount) / COMPOSITION_SCALE)
+            for reaction, amount in zip(self.reactions, amounts)
+        ]
+
+
+class MultiLagRanker(VectorRanker):
+    """Ranker that tries every delay between eating and reacting.
+
+    With a lag of k days the window of a reaction is the day k days before
+    it and the day before that, so lag 0 is the window of the other engines.
+    All lags up to RANKER_MAX_LAG are read from the same cumulative sums
+    and analysed together, and each suspect is ranked with the lag at which
+    it is most reactive (the shortest one on ties).
+    """
+
+    @classmethod
+    def parameters(cls):
+        return {"max_lag": getattr(settings, "RANKER_MAX_LAG", 5)}
+
+    def __init__(self, user, max_lag=None):
+        if max_lag is None:
+            max_lag = self.parameters()["max_lag"]
+        self.max_lag = max_lag
+        self.lags = np.arange(max_lag + 1)
+        super().__init__(user)
+
+    def analyse_reactions(self):
+        self.columns = {}
+        self.amounts = np.zeros((len(self.reactions), 0), dtype=np.int64)
+        self.present = np.zeros((len(self.reactions), 0), dtype=bool)
+        if not self.reactions:
+            return
+
+        profile = current_profile()
+        with profile.stage("windows"):
+            columns, first_day, exposure, eaten = self.exposure_matrix(
+                days_before=self.max_lag + 1
+            )
+            days = np.array(
+                [
+                    (reaction.date - first_day).days
+                    for reaction in self.reactions
                 ]
-            else:
-                amount_per_reaction[reaction] = 0
-        return amount_per_reaction
+            )
+            # Indexed [lag, reaction, suspect], see VectorRanker for the
+            # sums.
+            ends = days[np.newaxis, :] - self.lags[:, np.newaxis]
+
+            def windows(daily):
+                total = np.zeros(
+                    (len(daily) + 1, len(columns)), dtype=np.int64
+                )
+                np.cumsum(daily, axis=0, out=total[1:])
+                return total[ends + 1] - total[ends - 1]
+
+            amounts = windows(exposure)
+            present = windows(eaten) > 0
+        profile.count("windows", present.shape[0] * present.shape[1])
+        profile.count("suspects", int(present.sum()))
+
+        shape = (len(self.lags), len(columns))
+        known = np.zeros(shape, dtype=bool)
+        threshold = np.zeros(shape, dtype=np.int64)
+        reactivity = np.zeros(shape, dtype=np.int64)
+        first_seen = np.full(len(columns), len(self.reactions))
+
+        with profile.stage("update"):
+            for i, reaction in enumerate(self.reactions):
+                amount = amounts[:, i]
+                seen = present[:, i] & known
+                new = present[:, i] & ~known
+
+                if reaction.reaction:
+                    reactivity[seen] += 1
+                    lower = seen & (amount < threshold)
+                    threshold[lower] = amount[lower]
+                else:
+                    reactivity[seen & (threshold <= amount)] = 0
+
+                threshold[new] = amount[new]
+                known |= new
+                first_seen[new.any(axis=0)] = np.minimum(
+                    first_seen[new.any(axis=0)], i
+                )
+
+        best = np.argmax(np.where(known, reactivity, -1), axis=0)
+        suspects = np.arange(len(columns))
+        self.columns = columns
+        self.amounts = amounts[best, :, suspects].T
+        self.present = present[best, :, suspects].T
+
+        names = list(columns)
+        for column in np.argsort(first_seen, kind="stable"):
+            if not known[:, column].any():
+                continue
+            lag = best[column]
+            self.suspects[names[column]] = LaggedSuspect(
+                names[column],
+                int(threshold[lag, column]) / COMPOSITION_SCALE,
+                int(reactivity[lag, column]),
+                int(lag),
+                [int(r) for r in reactivity[:, column]],
+            )
 
 
-def amount_ingredient(meal_amount, ingredient_percent):
-    """Amount of ingredient in meal."""
-    return meal_amount * ingredient_percent / 100
+ENGINES = {
+    "replay": "foodapp.ranker.Ranker",
+    "window": "foodapp.ranker.SlidingWindowRanker",
+    "vector": "foodapp.ranker.VectorRanker",
+    "multilag": "foodapp.ranker.MultiLagRanker",
+    "streaming": "foodapp.ranker.StreamingRanker",
+    "persisted": "foodapp.state.PersistedRanker",
+}
 
 
-def amount_allergen(meal_amount, ingredient_percent, allergen_percent):
-    """Amount of allergen in ingredient in meal."""
-    return (
-        amount_ingredient(meal_amount, ingredient_percent)
-        * allergen_percent
-        / 100
+def get_ranker(user, engine=None):
+    """Rank the user's suspects with the engine chosen in the settings."""
+    if engine is None:
+        engine = getattr(settings, "RANKER_ENGINE", "window")
+    try:
+        ranker_class = import_string(ENGINES[engine])
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown RANKER_ENGINE {engine!r}, "
+            f"choose one of {', '.join(ENGINES)}"
+        )
+
+    if getattr(settings, "RANKING_CACHE", None):
+        from .cache import CachedRanker
+
+        return CachedRanker(user, ranker_class)
+    return ranker_class(user)
+
+
+def reaction_windows(reactions, meals):
+    """Yield each reaction with the meals eaten in its window.
+
+    Both meals and reactions are sorted newest first, so the window only
+    moves backwards: `start` skips the meals eaten after the reaction and
+    `end` advances past the meals eaten the day before it.
+    """
+    start = end = 0
+    for reaction in reactions:
+        day_before = reaction.date - timedelta(days=1)
+        while start < len(meals) and meals[start].date > reaction.date:
+            start += 1
+        end = max(start, end)
+        while end < len(meals) and meals[end].date >= day_before:
+            end += 1
+        yield reaction, meals[start:end]
+
+
+def parts_in_meals(meals, composition):
+    """Composition parts of each suspect the meals contain."""
+    parts_in_window = {}
+    for meal in meals:
+        for suspect_name, parts in composition.get(meal.food_id, ()):
+            parts_in_window[suspect_name] = (
+                parts_in_window.get(suspect_name, 0) + meal.amount * parts
+            )
+    return parts_in_window
+
+
+def suspects_in_meals(meals):
+    """How much of each suspect the meals contain.
+
+    The recipes are flattened as they are now, the same way as their
+    stored composition, and the amounts summed in exact parts per
+    COMPOSITION_SCALE, so that every engine finds the same suspects.
+    """
+    meals = list(meals)
+    composition = {}
+    for meal in meals:
+        if meal.food_id not in composition:
+            composition[meal.food_id] = list(recipe_parts(meal.food).items())
+    return {
+        suspect_name: parts / COMPOSITION_SCALE
+        for suspect_name, parts in parts_in_meals(meals, composition).items()
+    }
+
+
+def recipe_parts(recipe):
+    """Parts of each suspect in a recipe, read from its ingredients and
+    sub-recipes instead of RecipeComposition."""
+    components = list(recipe.components.order_by("id"))
+    return flatten_recipe(
+        recipe.recipeingredient_set.order_by("id"),
+        components,
+        {
+            component.component_id: list(
+                recipe_parts(component.component).items()
+            )
+            for component in components
+        },
     )
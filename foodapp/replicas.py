@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+from .versions import data_version
+
+# The database the reads of the current replica_reads block go to.
+_reading_from = ContextVar("reading_from", default=None)
+
+
+def replicas():
+    return list(getattr(settings, "DATABASE_REPLICAS", []))
+
+
+def replica_for(user_id):
+    """A replica that has caught up with the user's diary and the catalog.
+
+    The signals bump the user's data version on the primary with every
+    change, so a replica with the primary's versions has the changes. With
+    no replica that far, or no replicas at all, it is the primary.
+    """
+    aliases = replicas()
+    if not aliases:
+        return DEFAULT_DB_ALIAS
+    primary = data_version(user_id, using=DEFAULT_DB_ALIAS)
+    random.shuffle(aliases)
+    for alias in aliases:
+        try:
+            version = data_version(user_id, using=alias)
+        except DatabaseError:
+            continue
+        if all(seen >= wanted for seen, wanted in zip(version, primary)):
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def replica_reads(user_id):
+    """Read from a replica that is up to date with the user's data.
+
+    Writes still go to the primary, and after the first of them the rest
+    of the block reads from the primary too, so that it sees them.
+    """
+    token = _reading_from.set(replica_for(user_id))
+    try:
+        yield
+    finally:
+        _reading_from.reset(token)
+
+
+class ReplicaRouter:
+    """Route the reads of replica_reads blocks to their replica.
+
+    Everything else uses the primary, the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _reading_from.get()
+
+    def db_for_write(self, model, **hints):
+        if _reading_from.get() is not None:
+            _reading_from.set(DEFAULT_DB_ALIAS)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary.
+        return True
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import re
+import sqlite3
+from functools import cache
+from django.db import connection
+from django.db.models import Case, IntegerField, Value, When
+from .models import Ingredient, Recipe
+
+# Models searchable by name. On SQLite each gets an FTS5 table named after
+# its own table, whose rowids are the ids of the objects.
+SEARCH_MODELS = {"ingredient": Ingredient, "recipe": Recipe}
+
+
+@cache
+def sqlite_has_fts5():
+    try:
+        sqlite3.connect(":memory:").execute(
+            "CREATE VIRTUAL TABLE test USING fts5(name)"
+        )
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def fts_enabled():
+    return connection.vendor == "sqlite" and sqlite_has_fts5()
+
+
+def search_table(model):
+    return f"{model._meta.db_table}_search"
+
+
+def create_search_tables(**kwargs):
+    """Create and fill the FTS5 tables, connected to post_migrate."""
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        for model in SEARCH_MODELS.values():
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {search_table(model)} "
+                "USING fts5(name, tokenize='unicode61 remove_diacritics 2', "
+                "prefix='2 3')"
+            )
+    rebuild_index()
+
+
+def rebuild_index(models=None):
+    """Index every object of the models, all searchable ones by default."""
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        for model in models or SEARCH_MODELS.values():
+            table = search_table(model)
+            cursor.execute(f"DELETE FROM {table}")
+            cursor.execute(
+                f"INSERT INTO {table} (rowid, name) "
+                f"SELECT id, name FROM {model._meta.db_table}"
+            )
+
+
+def index_object(instance):
+    if not fts_enabled():
+        return
+    table = search_table(type(instance))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table} WHERE rowid = %s", [instance.id])
+        cursor.execute(
+            f"INSERT INTO {table} (rowid, name) VALUES (%s, %s)",
+            [instance.id, instance.name],
+        )
+
+
+def unindex_object(instance):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {search_table(type(instance))} WHERE rowid = %s",
+            [instance.id],
+        )
+
+
+def tokens(query):
+    return re.findall(r"\w+", query.lower())
+
+
+def search(model, query, limit=None):
+    """Objects whose name has every word of the query, best match first.
+
+    On SQLite the words are looked up in the FTS5 index as word prefixes
+    and the matches ranked by bm25. Other databases fall back to matching
+    substrings, names that start with the first word first.
+    """
+    words = tokens(query)
+    if not words:
+        return []
+
+    if fts_enabled():
+        match = " ".join(f'"{word}"*' for word in words)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {search_table(model)} "
+                f"WHERE {search_table(model)} MATCH %s "
+                "ORDER BY rank LIMIT %s",
+                [match, -1 if limit is None else limit],
+            )
+            ids = [row_id for row_id, in cursor.fetchall()]
+        objects = model.objects.in_bulk(ids)
+        return [objects[i] for i in ids if i in objects]
+
+    results = model.objects.all()
+    for word in words:
+        results = results.filter(name__icontains=word)
+    results = results.annotate(
+        starts=Case(
+            When(name__istartswith=words[0], then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+        )
+    ).order_by("starts", "name")
+    return list(results if limit is None else results[:limit])
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+import zlib
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from asgiref.sync import (
+    iscoroutinefunction,
+    markcoroutinefunction,
+    sync_to_async,
+)
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from .models import (
+    Allergen,
+    Ingredient,
+    IngredientAllergen,
+    Meal,
+    RankingState,
+    Reaction,
+    ReactionExposure,
+    Recipe,
+    RecipeComponent,
+    RecipeComposition,
+    RecipeIngredient,
+    SuspectState,
+    UserShard,
+)
+from .versions import bump_user, data_version
+
+# The per-user tables, stored on the shard of their user.
+SHARDED_MODELS = {
+    Meal,
+    Reaction,
+    ReactionExposure,
+    SuspectState,
+    RankingState,
+}
+
+# The catalog, written to the default database and copied to every shard so
+# that the diary can be joined with it there. Referenced models come first.
+CATALOG_MODELS = [
+    Allergen,
+    Ingredient,
+    IngredientAllergen,
+    Recipe,
+    RecipeIngredient,
+    RecipeComponent,
+    RecipeComposition,
+]
+
+# Rows per insert or delete when copying between databases.
+BATCH_SIZE = 500
+
+# The shard of the user whose diary the current block works on.
+_shard = ContextVar("shard", default=None)
+
+
+def shards():
+    return list(getattr(settings, "DATABASE_SHARDS", []))
+
+
+def hash_shard(user_id, aliases=None):
+    """The shard the user belongs on.
+
+    Each shard gets a score from a hash of its alias and the user id, and
+    the highest score wins, so adding a shard only moves the users it wins
+    and the choice is the same in every process.
+    """
+    return max(
+        aliases if aliases is not None else shards(),
+        key=lambda alias: zlib.crc32(f"{alias}:{user_id}".encode()),
+    )
+
+
+def shard_for(user_id):
+    """The database of the user's diary, or None without sharding."""
+    if not shards():
+        return None
+    return (
+        UserShard.objects.using(DEFAULT_DB_ALIAS)
+        .filter(user=user_id)
+        .values_list("database", flat=True)
+        .first()
+        or DEFAULT_DB_ALIAS
+    )
+
+
+def current_shard():
+    return _shard.get()
+
+
+@contextmanager
+def on_shard(alias):
+    """Send the diary queries of the block to the alias."""
+    token = _shard.set(alias)
+    try:
+        yield
+    finally:
+        _shard.reset(token)
+
+
+def user_shard(user_id):
+    """Send the diary queries of the block to the user's shard."""
+    return on_shard(shard_for(user_id))
+
+
+def diary_atomic(function):
+    """Run the function in a transaction on the current shard."""
+
+    @wraps(function)
+    def atomic(*args, **kwargs):
+        with transaction.atomic(using=current_shard()):
+            return function(*args, **kwargs)
+
+    return atomic
+
+
+def diary_databases():
+    """Every database that can hold diaries."""
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *shards()]))
+
+
+def copy_catalog(model, **filters):
+    """Copy the model's rows matching the filters from the default database
+    to the shards, deleting the ones it no longer has there."""
+    aliases = [alias for alias in shards() if alias != DEFAULT_DB_ALIAS]
+    if not aliases:
+        return
+    rows = list(model.objects.using(DEFAULT_DB_ALIAS).filter(**filters))
+    ids = {row.pk for row in rows}
+    fields = [
+        field.name
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+    ]
+    for alias in aliases:
+        copies = model.objects.using(alias).filter(**filters)
+        gone = list(set(copies.values_list("pk", flat=True)) - ids)
+        # Diary rows deleted with the catalog rows are on this shard.
+        with on_shard(alias), transaction.atomic(using=alias):
+            for start in range(0, len(gone), BATCH_SIZE):
+                copies.filter(
+                    pk__in=gone[start : start + BATCH_SIZE]
+                ).delete()
+            model.objects.using(alias).bulk_create(
+                rows,
+                batch_size=BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=[model._meta.pk.name],
+                update_fields=fields,
+            )
+
+
+def sync_catalog():
+    for model in CATALOG_MODELS:
+        copy_catalog(model)
+
+
+def delete_rows(user_id, alias, models):
+    """Delete the user's rows of the models from the database, in order.
+
+    The rows are deleted with plain SQL, without the signals that would
+    update the ranking state row by row.
+    """
+    exposures = ReactionExposure._meta.db_table
+    reactions = Reaction._meta.db_table
+    with transaction.atomic(using=alias):
+        with connections[alias].cursor() as cursor:
+            for model in models:
+                if model is ReactionExposure:
+                    cursor.execute(
+                        f"DELETE FROM {exposures} WHERE reaction_id IN "
+                        f"(SELECT id FROM {reactions} WHERE user_id = %s)",
+                        [user_id],
+                    )
+                else:
+                    cursor.execute(
+                        f"DELETE FROM {model._meta.db_table} "
+                        "WHERE user_id = %s",
+                        [user_id],
+                    )
+
+
+def delete_state(user_id, alias):
+    """Delete the user's ranking state, to be rebuilt when it is needed."""
+    delete_rows(
+        user_id, alias, [ReactionExposure, SuspectState, RankingState]
+    )
+
+
+def delete_diary(user_id, alias):
+    """Delete the user's diary and ranking state from the database."""
+    delete_rows(
+        user_id,
+        alias,
+        [ReactionExposure, SuspectState, RankingState, Meal, Reaction],
+    )
+
+
+def diary_fields(model):
+    return [
+        field.attname
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+    ]
+
+
+def read_diary(user_id, alias):
+    """The user's meals and reactions in the database, as counts of rows."""
+    return {
+        model: Counter(
+            model.objects.using(alias)
+            .filter(user=user_id)
+            .values_list(*diary_fields(model))
+        )
+        for model in [Meal, Reaction]
+    }
+
+
+def copy_changes(user_id, target, copied, diary):
+    """Turn the user's diary in the target from `copied` into `diary`.
+
+    Both are diaries as read by read_diary. The rows `diary` no longer
+    has, including the old values of changed rows, are deleted and the
+    new ones inserted, without signals. Returns whether anything changed.
+    """
+    changed = False
+    with transaction.atomic(using=target):
+        for model in [Meal, Reaction]:
+            fields = diary_fields(model)
+            gone = copied[model] - diary[model]
+            if gone:
+                ids = defaultdict(list)
+                for id, *row in (
+                    model.objects.using(target)
+                    .filter(user=user_id)
+                    .values_list("pk", *fields)
+                ):
+                    ids[tuple(row)].append(id)
+                gone_ids = [
+                    ids[row].pop() for row in gone.elements() if ids[row]
+                ]
+                with connections[target].cursor() as cursor:
+                    for start in range(0, len(gone_ids), BATCH_SIZE):
+                        batch = gone_ids[start : start + BATCH_SIZE]
+                        cursor.execute(
+                            f"DELETE FROM {model._meta.db_table} WHERE id IN "
+                            f"({', '.join(['%s'] * len(batch))})",
+                            batch,
+                        )
+            new = diary[model] - copied[model]
+            model.objects.using(target).bulk_create(
+                [model(**dict(zip(fields, row))) for row in new.elements()],
+                batch_size=BATCH_SIZE,
+            )
+            changed = changed or bool(gone or new)
+    return changed
+
+
+def move_user(user_id, source, target):
+    """Move the user's meals and reactions from the source to the target.
+
+    They are copied, and their changes copied again as long as the user's
+    data version changes meanwhile, before the user is switched to the
+    target. Edits that still reach the source after that, from requests
+    that started before the switch, are copied the same way before the
+    diary is deleted from the source. The ranking state is rebuilt on the
+    target when it is needed. Returns the number of meals and reactions
+    moved.
+    """
+    # Leftovers of an interrupted move are replaced.
+    delete_diary(user_id, target)
+    copied = {Meal: Counter(), Reaction: Counter()}
+    switched = False
+    while True:
+        version = data_version(user_id, using=DEFAULT_DB_ALIAS)
+        diary = read_diary(user_id, source)
+        if copy_changes(user_id, target, copied, diary) and switched:
+            # The target's state may be from before the copied changes.
+            delete_state(user_id, target)
+        copied = diary
+        if data_version(user_id, using=DEFAULT_DB_ALIAS) != version:
+            continue
+        if switched:
+            break
+        UserShard.objects.update_or_create(
+            user_id=user_id, defaults={"database": target}
+        )
+        switched = True
+
+    delete_diary(user_id, source)
+    bump_user(user_id)
+    return sum(diary[Meal].values()), sum(diary[Reaction].values())
+
+
+class ShardRouter:
+    """Route the diary tables to the shard of the current user.
+
+    Outside a user_shard block the shard is taken from the user or diary
+    row the query is about, if any. Everything else is left to the next
+    router.
+    """
+
+    def db_for(self, model, hints):
+        instance = hints.get("instance")
+        if model not in SHARDED_MODELS:
+            # Users and recipes of rows read from a shard.
+            if type(instance) in SHARDED_MODELS:
+                return DEFAULT_DB_ALIAS
+            return None
+        shard = current_shard()
+        if shard is None and shards():
+            if isinstance(instance, User):
+                shard = shard_for(instance.pk)
+            elif isinstance(instance, (Meal, Reaction)):
+                shard = shard_for(instance.user_id)
+        return shard
+
+    def db_for_read(self, model, **hints):
+        return self.db_for(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.db_for(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+class ShardMiddleware:
+    """Send the diary queries of a request to the shard of its user."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with on_shard(self.shard(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with on_shard(await sync_to_async(self.shard)(request)):
+            return await self.get_response(request)
+
+    def shard(self, request):
+        if not shards() or not request.user.is_authenticated:
+            return None
+        request.extra_queries = getattr(request, "extra_queries", 0) + 1
+        return shard_for(request.user.id)
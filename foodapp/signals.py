@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import (
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+from .composition import (
+    rebuild_composition,
+    recipes_with_allergen,
+    recipes_with_ingredients,
+)
+from .models import (
+    Allergen,
+    Ingredient,
+    IngredientAllergen,
+    Meal,
+    Reaction,
+    Recipe,
+    RecipeComponent,
+    RecipeIngredient,
+    UserShard,
+)
+from . import jobs, search, shards, state, versions
+
+
+def composition_changed(recipe_ids):
+    changed = rebuild_composition(recipe_ids)
+    state.recipes_changed(changed)
+    for alias in shards.diary_databases():
+        jobs.enqueue(
+            Meal.objects.using(alias)
+            .filter(food_id__in=changed)
+            .values_list("user_id", flat=True)
+            .distinct()
+        )
+
+
+def catalog_written(sender, instance, using, **kwargs):
+    versions.bump_catalog()
+    if using == DEFAULT_DB_ALIAS:
+        shards.copy_catalog(sender, pk=instance.pk)
+
+
+for catalog_model in [
+    Allergen,
+    Ingredient,
+    IngredientAllergen,
+    Recipe,
+    RecipeComponent,
+    RecipeIngredient,
+]:
+    post_save.connect(catalog_written, sender=catalog_model)
+    post_delete.connect(catalog_written, sender=catalog_model)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, **kwargs):
+    rebuild_composition([instance.id])
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_changed(sender, instance, **kwargs):
+    composition_changed([instance.recipe_id])
+
+
+@receiver(post_save, sender=RecipeComponent)
+@receiver(post_delete, sender=RecipeComponent)
+def recipe_component_changed(sender, instance, **kwargs):
+    composition_changed([instance.recipe_id])
+
+
+@receiver(pre_save, sender=IngredientAllergen)
+def ingredient_allergen_saving(sender, instance, raw, **kwargs):
+    instance.previous_ingredient_id = None
+    if instance.id and not raw:
+        instance.previous_ingredient_id = (
+            IngredientAllergen.objects.filter(id=instance.id)
+            .values_list("ingredient_id", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=IngredientAllergen)
+@receiver(post_delete, sender=IngredientAllergen)
+def ingredient_allergen_changed(sender, instance, **kwargs):
+    # An allergen moved to another ingredient leaves the recipes of both.
+    ingredients = {
+        instance.ingredient_id,
+        getattr(instance, "previous_ingredient_id", None),
+    } - {None}
+    composition_changed(recipes_with_ingredients(ingredients))
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_saved(sender, instance, created, **kwargs):
+    if not created:
+        composition_changed(recipes_with_ingredients([instance.id]))
+
+
+@receiver(post_save, sender=Allergen)
+def allergen_saved(sender, instance, created, **kwargs):
+    if not created:
+        composition_changed(recipes_with_allergen(instance.id))
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Recipe)
+def searchable_saved(sender, instance, **kwargs):
+    search.index_object(instance)
+
+
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Recipe)
+def searchable_deleted(sender, instance, **kwargs):
+    search.unindex_object(instance)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw and shards.shards():
+        UserShard.objects.create(
+            user=instance, database=shards.hash_shard(instance.id)
+        )
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # The diary on a shard is not deleted with the user.
+    shard = shards.shard_for(instance.id)
+    if shard not in [None, DEFAULT_DB_ALIAS]:
+        shards.delete_diary(instance.id, shard)
+
+
+@receiver(pre_save, sender=Meal)
+def meal_saving(sender, instance, raw, **kwargs):
+    instance.previous_date = None
+    if instance.id and not raw:
+        instance.previous_date = (
+            Meal.objects.filter(id=instance.id)
+            .values_list("date", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=Meal)
+def meal_saved(sender, instance, raw, **kwargs):
+    versions.bump_user(instance.user_id)
+    jobs.enqueue([instance.user_id])
+    if raw:
+        state.mark_stale([instance.user_id])
+    else:
+        dates = {instance.date, instance.previous_date} - {None}
+        state.meals_changed(instance.user_id, dates)
+
+
+@receiver(post_delete, sender=Meal)
+def meal_deleted(sender, instance, **kwargs):
+    versions.bump_user(instance.user_id)
+    jobs.enqueue([instance.user_id])
+    state.meals_changed(instance.user_id, [instance.date])
+
+
+@receiver(post_save, sender=Reaction)
+def reaction_saved(sender, instance, created, raw, **kwargs):
+    versions.bump_user(instance.user_id)
+    jobs.enqueue([instance.user_id])
+    if raw:
+        state.mark_stale([instance.user_id])
+    else:
+        state.reaction_saved(instance, created)
+
+
+@receiver(post_delete, sender=Reaction)
+def reaction_deleted(sender, instance, **kwargs):
+    versions.bump_user(instance.user_id)
+    jobs.enqueue([instance.user_id])
+    state.reaction_deleted(instance)
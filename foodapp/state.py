@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
+from .composition import composition_of
+from .models import (
+    COMPOSITION_SCALE,
+    Meal,
+    RankingState,
+    Reaction,
+    ReactionExposure,
+    SuspectState,
+)
+from .profiling import current_profile
+from .ranker import Ranker, Suspect, parts_in_meals, reaction_windows
+from .shards import diary_atomic, diary_databases
+
+
+class PersistedRanker(Ranker):
+    """Ranker that reads the suspect state stored for the user.
+
+    The signal handlers keep the state up to date as the diary changes, so
+    ranking only reads one row per suspect. A missing or stale state is
+    rebuilt from the whole diary first.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.reactions = Reaction.objects.filter(user=user).order_by("-date")
+        profile = current_profile()
+        if not RankingState.objects.filter(
+            user=user, is_stale=False
+        ).exists():
+            with profile.stage("rebuild"):
+                rebuild_state(user.id)
+        with profile.stage("fetch"):
+            self.suspects = {
+                state.name: Suspect(
+                    state.name, state.threshold, state.reactivity
+                )
+                for state in SuspectState.objects.filter(user=user)
+            }
+
+    def reaction_exposures(self):
+        exposures = {}
+        rows = (
+            ReactionExposure.objects.filter(reaction__user=self.user)
+            .order_by("id")
+            .values_list("reaction_id", "suspect", "parts")
+        )
+        for reaction_id, suspect, parts in rows:
+            exposures.setdefault(reaction_id, {})[suspect] = (
+                parts / COMPOSITION_SCALE
+            )
+        return {
+            reaction: exposures.get(reaction.id, {})
+            for reaction in self.reactions
+        }
+
+    def exposure_series(self, suspect_name):
+        parts_per_reaction = dict(
+            ReactionExposure.objects.filter(
+                reaction__user=self.user, suspect=suspect_name
+            ).values_list("reaction_id", "parts")
+        )
+        return [
+            (
+                reaction,
+                parts_per_reaction.get(reaction.id, 0) / COMPOSITION_SCALE,
+            )
+            for reaction in self.reactions
+        ]
+
+
+class StoredWindowRanker(Ranker):
+    """Ranker that goes through the stored windows of the reactions.
+
+    The reactions must be sorted newest first. It starts from `suspects` if
+    given, and keeps the thresholds in composition parts like the stored
+    state does.
+    """
+
+    def __init__(self, user, reactions, suspects=None):
+        self.user = user
+        self.reactions = reactions
+        self.suspects = suspects or {}
+        self.analyse_reactions()
+
+    def analyse_reactions(self):
+        self.exposures = {}
+        if not self.reactions:
+            return
+
+        exposures = (
+            ReactionExposure.objects.filter(
+                reaction__user=self.user,
+                reaction__date__range=[
+                    self.reactions[-1].date,
+                    self.reactions[0].date,
+                ],
+            )
+            .order_by("reaction_id", "id")
+            .values_list("reaction_id", "suspect", "parts")
+        )
+        windows = {
+            reaction_id: {suspect: parts for _, suspect, parts in rows}
+            for reaction_id, rows in groupby(exposures, key=itemgetter(0))
+        }
+        for reaction in self.reactions:
+            suspects_in_window = windows.get(reaction.id, {})
+            self.exposures[reaction] = suspects_in_window
+            self.update_suspects(reaction, suspects_in_window)
+
+
+def store_windows(reactions, meals):
+    """Store the exposures in the windows of the reactions.
+
+    Both reactions and meals must be sorted newest first, and the meals
+    must include every meal in those windows. The old exposures of the
+    reactions must be deleted first.
+    """
+    composition = composition_of(meal.food_id for meal in meals)
+    exposures = []
+    for reaction, window in reaction_windows(reactions, meals):
+        for suspect, parts in parts_in_meals(window, composition).items():
+            exposures.append(
+                ReactionExposure(
+                    reaction=reaction, suspect=suspect, parts=parts
+                )
+            )
+    ReactionExposure.objects.bulk_create(exposures)
+
+
+def refresh_windows(user_id, reactions):
+    """Recompute the stored exposures of some of the user's reactions."""
+    reactions = sorted(reactions, key=lambda r: r.date, reverse=True)
+    window_days = set()
+    for reaction in reactions:
+        window_days |= {reaction.date, reaction.date - timedelta(days=1)}
+    meals = Meal.objects.filter(user=user_id, date__in=window_days)
+    ReactionExposure.objects.filter(reaction__in=reactions).delete()
+    store_windows(reactions, list(meals.order_by("-date", "id")))
+
+
+def save_state(user_id, suspects, last_reaction_date):
+    SuspectState.objects.filter(user=user_id).delete()
+    SuspectState.objects.bulk_create(
+        SuspectState(
+            user_id=user_id,
+            name=suspect.name,
+            threshold_parts=suspect.threshold,
+            reactivity=suspect.reactivity,
+            position=position,
+        )
+        for position, suspect in enumerate(suspects.values())
+    )
+    RankingState.objects.update_or_create(
+        user_id=user_id,
+        defaults={
+            "last_reaction_date": last_reaction_date,
+            "is_stale": False,
+        },
+    )
+
+
+def replay_state(user_id):
+    """Go through every stored window of the user and save the suspects."""
+    reactions = list(
+        Reaction.objects.filter(user=user_id).order_by("-date", "id")
+    )
+    ranker = StoredWindowRanker(user_id, reactions)
+    last_reaction_date = reactions[-1].date if reactions else None
+    save_state(user_id, ranker.suspects, last_reaction_date)
+
+
+@diary_atomic
+def rebuild_state(user_id):
+    """Recompute every window of the user's diary and replay them."""
+    reactions = list(
+        Reaction.objects.filter(user=user_id).order_by("-date", "id")
+    )
+    meals = Meal.objects.filter(user=user_id).order_by("-date", "id")
+    ReactionExposure.objects.filter(reaction__user=user_id).delete()
+    store_windows(reactions, list(meals))
+    replay_state(user_id)
+
+
+def current_state(user_id):
+    """The user's ranking state, or None if it has to be rebuilt anyway."""
+    return RankingState.objects.filter(user=user_id, is_stale=False).first()
+
+
+@diary_atomic
+def meals_changed(user_id, dates):
+    """Update the state after meals on the given dates changed."""
+    if current_state(user_id) is None:
+        return
+
+    affected_days = set(dates) | {date + timedelta(days=1) for date in dates}
+    reactions = Reaction.objects.filter(user=user_id, date__in=affected_days)
+    if reactions:
+        refresh_windows(user_id, reactions)
+        replay_state(user_id)
+
+
+@diary_atomic
+def reaction_saved(reaction, created):
+    """Update the state after a reaction was written.
+
+    The ranker goes through the reactions newest first, so a new reaction
+    older than all the others only continues from the stored suspects.
+    Anything else replays the stored windows.
+    """
+    state = current_state(reaction.user_id)
+    if state is None:
+        return
+
+    refresh_windows(reaction.user_id, [reaction])
+    if (
+        created
+        and state.last_reaction_date is not None
+        and reaction.date < state.last_reaction_date
+    ):
+        suspects = {
+            suspect.name: Suspect(
+                suspect.name, suspect.threshold_parts, suspect.reactivity
+            )
+            for suspect in SuspectState.objects.filter(user=reaction.user_id)
+        }
+        ranker = StoredWindowRanker(reaction.user_id, [reaction], suspects)
+        save_state(reaction.user_id, ranker.suspects, reaction.date)
+    else:
+        replay_state(reaction.user_id)
+
+
+@diary_atomic
+def reaction_deleted(reaction):
+    if current_state(reaction.user_id) is not None:
+        replay_state(reaction.user_id)
+
+
+def mark_stale(users):
+    RankingState.objects.filter(user__in=users).update(is_stale=True)
+
+
+def recipes_changed(recipe_ids):
+    """Mark the state of everyone who ate the recipes as stale, on every
+    shard."""
+    for alias in diary_databases():
+        RankingState.objects.using(alias).filter(
+            user__in=Meal.objects.using(alias)
+            .filter(food_id__in=recipe_ids)
+            .values("user_id")
+        ).update(is_stale=True)
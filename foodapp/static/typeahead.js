@@ -0,0 +1,67 @@
+// Recipe picker of the meal form, see foodapp.forms.RecipeTypeahead.
+document.addEventListener("DOMContentLoaded", function () {
+    document.querySelectorAll(".recipe-typeahead").forEach(function (picker) {
+        var id = picker.querySelector("input[type=hidden]");
+        var text = picker.querySelector("input[type=text]");
+        var menu = picker.querySelector(".dropdown-menu");
+        var timer = null;
+
+        function choose(recipeId, name) {
+            id.value = recipeId;
+            text.value = name;
+            picker.classList.remove("open");
+        }
+
+        function item(label, onClick) {
+            var li = document.createElement("li");
+            var a = document.createElement("a");
+            a.href = "#";
+            a.textContent = label;
+            a.addEventListener("click", function (event) {
+                event.preventDefault();
+                onClick();
+            });
+            li.appendChild(a);
+            menu.appendChild(li);
+        }
+
+        function load(page) {
+            var url = picker.dataset.lookupUrl +
+                "?q=" + encodeURIComponent(text.value) + "&page=" + page;
+            fetch(url, { credentials: "same-origin" })
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    if (page === 1) {
+                        menu.innerHTML = "";
+                    } else if (menu.lastChild) {
+                        menu.removeChild(menu.lastChild);
+                    }
+                    data.results.forEach(function (recipe) {
+                        item(recipe.name, function () {
+                            choose(recipe.id, recipe.name);
+                        });
+                    });
+                    if (data.has_more) {
+                        item("More…", function () { load(page + 1); });
+                    }
+                    picker.classList.toggle("open", data.results.length > 0);
+                });
+        }
+
+        text.addEventListener("input", function () {
+            id.value = "";
+            clearTimeout(timer);
+            timer = setTimeout(function () { load(1); }, 200);
+        });
+        text.addEventListener("focus", function () {
+            if (!text.value) {
+                load(1);
+            }
+        });
+        picker.querySelectorAll("button[data-id]").forEach(function (button) {
+            button.addEventListener("click", function () {
+                choose(button.dataset.id, button.dataset.name);
+            });
+        });
+    });
+});
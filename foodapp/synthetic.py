@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import random
+import uuid
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.utils import timezone
+from .composition import composition_of, rebuild_composition
+from .models import (
+    Allergen,
+    Ingredient,
+    IngredientAllergen,
+    Meal,
+    Reaction,
+    Recipe,
+    RecipeIngredient,
+)
+from .search import rebuild_index
+from .shards import sync_catalog
+from .versions import bump_catalog, bump_user
+
+
+def split_percent(rng, parts, total):
+    """Split `total` percent into `parts` random shares of at least 1."""
+    cuts = sorted(rng.sample(range(1, total), parts - 1))
+    return [b - a for a, b in zip([0] + cuts, cuts + [total])]
+
+
+def generate_catalog(
+    rng, allergens=14, ingredients=200, recipes=500, prefix="synthetic"
+):
+    """Create allergens, ingredients and recipes with random compositions.
+
+    Everything is bulk inserted, so the shard copies, the recipe
+    compositions and the search index are updated here instead of by the
+    signal handlers. Returns the recipes.
+    """
+    batch = uuid.uuid4().hex[:6]
+
+    allergen_objects = Allergen.objects.bulk_create(
+        Allergen(name=f"{prefix} allergen {batch}-{i}")
+        for i in range(allergens)
+    )
+    ingredient_objects = Ingredient.objects.bulk_create(
+        Ingredient(name=f"{prefix} ingredient {batch}-{i}")
+        for i in range(ingredients)
+    )
+
+    ingredient_allergens = []
+    for ingredient in ingredient_objects:
+        if rng.random() < 0.4:
+            count = rng.randint(1, 2)
+            shares = split_percent(rng, count + 1, 100)[:count]
+            for allergen, share in zip(
+                rng.sample(allergen_objects, count), shares
+            ):
+                ingredient_allergens.append(
+                    IngredientAllergen(
+                        ingredient=ingredient,
+                        allergen=allergen,
+                        percent=share,
+                    )
+                )
+    IngredientAllergen.objects.bulk_create(ingredient_allergens)
+
+    recipe_objects = Recipe.objects.bulk_create(
+        Recipe(name=f"{prefix} recipe {batch}-{i}") for i in range(recipes)
+    )
+    recipe_ingredients = []
+    for recipe in recipe_objects:
+        count = rng.randint(2, min(6, len(ingredient_objects)))
+        shares = split_percent(rng, count, rng.randint(60, 100))
+        for ingredient, share in zip(
+            rng.sample(ingredient_objects, count), shares
+        ):
+            recipe_ingredients.append(
+                RecipeIngredient(
+                    recipe=recipe, ingredient=ingredient, percent=share
+                )
+            )
+    RecipeIngredient.objects.bulk_create(recipe_ingredients)
+
+    sync_catalog()
+    rebuild_composition(recipe.id for recipe in recipe_objects)
+    rebuild_index()
+    bump_catalog()
+    return recipe_objects
+
+
+def generate_diary(rng, user, composition, days, meals_per_day=3):
+    """Fill the last `days` days of the user's diary.
+
+    `composition` maps the recipes to eat to their suspects, as returned by
+    `composition_of`. The user reacts to one suspect: a reaction is likely
+    on days where it was eaten that day or the day before, and unlikely
+    otherwise.
+    """
+    recipe_ids = sorted(composition)
+    culprit = rng.choice(
+        [suspect for rows in composition.values() for suspect, _ in rows]
+    )
+
+    meals = []
+    reactions = []
+    today = timezone.now().date()
+    exposed = False
+    for day in range(days - 1, -1, -1):
+        date = today - timedelta(days=day)
+        exposed_today = False
+        for _ in range(
+            rng.randint(max(meals_per_day - 2, 0), meals_per_day + 2)
+        ):
+            recipe_id = rng.choice(recipe_ids)
+            meals.append(
+                Meal(
+                    user=user,
+                    food_id=recipe_id,
+                    amount=rng.randrange(50, 500, 10),
+                    date=date,
+                )
+            )
+            exposed_today |= any(
+                suspect == culprit for suspect, _ in composition[recipe_id]
+            )
+
+        if rng.random() < 0.7:
+            chance = 0.8 if exposed or exposed_today else 0.1
+            reactions.append(
+                Reaction(
+                    user=user,
+                    date=date,
+                    reaction=int(rng.random() < chance),
+                    diary="",
+                )
+            )
+        exposed = exposed_today
+
+    Meal.objects.bulk_create(meals, batch_size=1000)
+    Reaction.objects.bulk_create(reactions, batch_size=1000)
+    bump_user(user.id)
+    return len(meals), len(reactions)
+
+
+def generate(
+    users=10,
+    days=365,
+    meals_per_day=3,
+    allergens=14,
+    ingredients=200,
+    recipes=500,
+    seed=None,
+    prefix="synthetic",
+):
+    """Create a catalog and `users` users with `days` days of diary each."""
+    rng = random.Random(seed)
+    recipe_objects = generate_catalog(
+        rng, allergens, ingredients, recipes, prefix
+    )
+    batch = uuid.uuid4().hex[:6]
+    user_objects = User.objects.bulk_create(
+        User(username=f"{prefix}-{batch}-{i}") for i in range(users)
+    )
+    composition = composition_of(recipe.id for recipe in recipe_objects)
+    for user in user_objects:
+        generate_diary(rng, user, composition, days, meals_per_day)
+    return user_objects
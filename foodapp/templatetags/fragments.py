@@ -0,0 +1,45 @@
+from django import template
+from ..fragments import user_fragment
+
+register = template.Library()
+
+
+class UserFragmentNode(template.Node):
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        return user_fragment(
+            self.name.resolve(context),
+            context["request"].user.id,
+            [value.resolve(context) for value in self.vary_on],
+            lambda: self.nodelist.render(context),
+        )
+
+
+@register.tag
+def userfragment(parser, token):
+    """Cache a fragment of the user's page until their data changes.
+
+        {% userfragment "name" [vary_on ...] %} ... {% enduserfragment %}
+
+    Like {% cache %}, but keyed on the user and their data version, and
+    with the timeout FRAGMENT_TIMEOUTS gives the name. Values the fragment
+    shows that the data version does not cover, like today's date, go in
+    vary_on. The variables of the fragment are only resolved when it is
+    not cached, so querysets passed to it are not evaluated otherwise.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(
+            f"{bits[0]!r} tag requires a fragment name."
+        )
+    nodelist = parser.parse(("enduserfragment",))
+    parser.delete_first_token()
+    return UserFragmentNode(
+        nodelist,
+        parser.compile_filter(bits[1]),
+        [parser.compile_filter(bit) for bit in bits[2:]],
+    )
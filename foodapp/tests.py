@@ -1,6 +1,64 @@
-from django.test import TestCase
+import asyncio
+from datetime import date, timedelta
+import json
+import os
+import tempfile
+import threading
+from functools import partial
+from io import StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
-from .ranker import Ranker
+from .models import (
+    Allergen,
+    Ingredient,
+    IngredientAllergen,
+    Meal,
+    RankingJob,
+    RankingResult,
+    RankingRun,
+    RankingState,
+    Reaction,
+    Recipe,
+    RecipeComponent,
+    RecipeComposition,
+    RecipeIngredient,
+    UserShard,
+)
+from . import diary_io, replicas, shards, versions, views
+from .diary_io import (
+    diary_rows,
+    export_lines,
+    import_diary,
+    read_json_array,
+    read_rows,
+)
+from .cache import MemoryCappedFileBasedCache, MemoryCappedLocMemCache
+from .fragments import fragment_stats
+from .jobs import claim_jobs, queue_metrics, run_job
+from .pool import RankerBusy, run_ranker
+from .profiling import current_profile, profile_ranking
+from .queries import budget_of
+from .search import search
+from .replicas import replica_for, replica_reads
+from .ranker import (
+    MultiLagRanker,
+    Ranker,
+    SlidingWindowRanker,
+    StreamingRanker,
+    VectorRanker,
+    get_ranker,
+)
+from .state import PersistedRanker
+from .synthetic import generate
 
 
 class TestRanker(TestCase):
@@ -31,3 +89,1546 @@ class TestRanker(TestCase):
         self.assertEqual(results[6].reactivity, 2)
         self.assertEqual(results[7].name, "salmon")
         self.assertEqual(results[7].reactivity, 1)
+
+    @override_settings(RANKING_CACHE=None)
+    def test_engines_sum_amounts_exactly(self):
+        # 0.1 + 0.2 > 0.3 in floats, which made the replay engine differ.
+        user = User.objects.create_user("exact")
+        ingredient = Ingredient.objects.create(name="exactium")
+        recipes = {}
+        for percent in [10, 20, 30]:
+            recipes[percent] = Recipe.objects.create(name=f"exact {percent}")
+            RecipeIngredient.objects.create(
+                recipe=recipes[percent],
+                ingredient=ingredient,
+                percent=percent,
+            )
+        day = date(2023, 1, 1)
+        for days, percents, reaction in [
+            (6, [10, 20], Reaction.NO),
+            (3, [10, 20], Reaction.YES),
+            (0, [30], Reaction.NO),
+        ]:
+            for percent in percents:
+                Meal.objects.create(
+                    user=user,
+                    food=recipes[percent],
+                    amount=1,
+                    date=day + timedelta(days=days),
+                )
+            Reaction.objects.create(
+                user=user, date=day + timedelta(days=days), reaction=reaction
+            )
+
+        for engine in [
+            "replay",
+            "window",
+            "vector",
+            "streaming",
+            "persisted",
+        ]:
+            with self.subTest(engine=engine):
+                self.assertEqual(get_ranker(user, engine).get_ranking(), [])
+
+
+class TestSlidingWindowRanker(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+
+    def test_same_suspects_as_ranker(self):
+        expected = Ranker(self.user)
+        ranker = SlidingWindowRanker(self.user)
+
+        self.assertEqual(
+            list(ranker.suspects.values()), list(expected.suspects.values())
+        )
+        self.assertEqual(ranker.get_ranking(), expected.get_ranking())
+        self.assertEqual(
+            ranker.suspect_amount_per_reaction("gluten"),
+            expected.suspect_amount_per_reaction("gluten"),
+        )
+
+    def test_query_count_independent_of_history(self):
+        with self.assertNumQueries(3):
+            SlidingWindowRanker(self.user)
+
+        recipe = Recipe.objects.first()
+        for meal in Meal.objects.filter(user=self.user):
+            for days in range(1, 30):
+                Meal.objects.create(
+                    user=self.user,
+                    food=recipe,
+                    amount=meal.amount,
+                    date=meal.date - timedelta(days=days),
+                )
+
+        with self.assertNumQueries(3):
+            SlidingWindowRanker(self.user)
+
+
+class TestVectorRanker(TestCase):
+    fixtures = ["testdata.json"]
+
+    def test_same_ranking_as_ranker(self):
+        for user in User.objects.all():
+            expected = Ranker(user)
+            ranker = VectorRanker(user)
+
+            self.assertEqual(
+                list(ranker.suspects.values()),
+                list(expected.suspects.values()),
+            )
+            self.assertEqual(ranker.get_ranking(), expected.get_ranking())
+
+    def test_reactions_without_meals(self):
+        user = User.objects.create(username="fasting")
+        Reaction.objects.create(user=user, reaction=Reaction.YES)
+
+        self.assertEqual(VectorRanker(user).get_ranking(), [])
+
+
+class TestMultiLagRanker(TestCase):
+    fixtures = ["testdata.json"]
+
+    def test_lag_zero_is_the_usual_window(self):
+        user = User.objects.get(username="testuser")
+        expected = VectorRanker(user)
+        ranker = MultiLagRanker(user)
+
+        for name, suspect in expected.suspects.items():
+            self.assertEqual(
+                ranker.suspects[name].reactivity_per_lag[0],
+                suspect.reactivity,
+            )
+
+    def test_finds_delayed_reactions(self):
+        user = User.objects.create(username="slow")
+        for day in [date(2023, 1, 1), date(2023, 1, 11), date(2023, 1, 21)]:
+            Meal.objects.create(
+                user=user,
+                food=Recipe.objects.get(name="salmon"),
+                amount=100,
+                date=day,
+            )
+            Reaction.objects.create(
+                user=user, date=day + timedelta(days=3), reaction=Reaction.YES
+            )
+
+        salmon = MultiLagRanker(user, max_lag=5).suspects["salmon"]
+        self.assertEqual(salmon.reactivity_per_lag, [0, 0, 2, 2, 0, 0])
+        self.assertEqual(salmon.lag, 2)
+        self.assertEqual(salmon.reactivity, 2)
+
+
+class TestStreamingRanker(TestCase):
+    fixtures = ["testdata.json"]
+
+    def test_same_ranking_as_ranker(self):
+        for user in User.objects.all():
+            expected = Ranker(user)
+            ranker = StreamingRanker(user, chunk_size=2)
+
+            self.assertEqual(
+                list(ranker.suspects.values()),
+                list(expected.suspects.values()),
+            )
+            self.assertEqual(
+                ranker.exposure_series("gluten"),
+                expected.exposure_series("gluten"),
+            )
+
+    def test_cache_keeps_no_exposures(self):
+        user = User.objects.get(username="testuser")
+        expected = StreamingRanker(user)
+        with mock.patch.object(
+            StreamingRanker,
+            "reaction_exposures",
+            side_effect=AssertionError("exposures materialized"),
+        ):
+            ranker = get_ranker(user, "streaming")
+            self.assertEqual(ranker.get_ranking(), expected.get_ranking())
+            self.assertIsNone(ranker.exposures)
+            self.assertEqual(
+                ranker.exposure_series("gluten"),
+                expected.exposure_series("gluten"),
+            )
+
+
+class TestRecipeComposition(TestCase):
+    fixtures = ["testdata.json"]
+
+    def composition(self, recipe):
+        return dict(
+            RecipeComposition.objects.filter(recipe=recipe).values_list(
+                "suspect", "parts"
+            )
+        )
+
+    def test_follows_allergen_changes(self):
+        allergen = IngredientAllergen.objects.first()
+        recipe = allergen.ingredient.recipe_set.first()
+        name = allergen.allergen.name
+        before = self.composition(recipe)[name]
+
+        allergen.percent += 1
+        allergen.save()
+        self.assertGreater(self.composition(recipe)[name], before)
+
+        allergen.delete()
+        self.assertNotIn(name, self.composition(recipe))
+
+    def test_follows_allergen_moved_to_another_ingredient(self):
+        seed = Ingredient.objects.create(name="mustard seed")
+        cress = Ingredient.objects.create(name="cress")
+        recipes = []
+        for ingredient in [seed, cress]:
+            recipe = Recipe.objects.create(name=f"{ingredient.name} sauce")
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=ingredient, percent=10
+            )
+            recipes.append(recipe)
+        allergen = IngredientAllergen.objects.create(
+            allergen=Allergen.objects.create(name="mustard"),
+            ingredient=seed,
+            percent=50,
+        )
+        self.assertIn("mustard", self.composition(recipes[0]))
+
+        allergen.ingredient = cress
+        allergen.save()
+        self.assertNotIn("mustard", self.composition(recipes[0]))
+        self.assertIn("mustard", self.composition(recipes[1]))
+
+
+def summary(ranker):
+    return [
+        (suspect.name, suspect.threshold, suspect.reactivity)
+        for suspect in ranker.suspects.values()
+    ]
+
+
+class TestPersistedRanker(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+
+    def test_same_ranking_as_ranker(self):
+        for user in User.objects.all():
+            self.assertEqual(
+                summary(PersistedRanker(user)), summary(Ranker(user))
+            )
+
+    def test_follows_diary_changes(self):
+        PersistedRanker(self.user)
+        recipe = Recipe.objects.get(name="pizza")
+        oldest = Reaction.objects.filter(user=self.user).earliest("date")
+        newest = Reaction.objects.filter(user=self.user).latest("date")
+
+        changes = [
+            lambda: Meal.objects.create(
+                user=self.user, food=recipe, amount=400, date=newest.date
+            ),
+            lambda: Reaction.objects.create(
+                user=self.user,
+                date=oldest.date - timedelta(days=1),
+                reaction=Reaction.YES,
+            ),
+            lambda: Reaction.objects.create(
+                user=self.user,
+                date=newest.date + timedelta(days=1),
+                reaction=Reaction.NO,
+            ),
+            lambda: Meal.objects.filter(user=self.user, date=oldest.date)
+            .first()
+            .delete(),
+            lambda: newest.delete(),
+            lambda: IngredientAllergen.objects.first().delete(),
+        ]
+        for change in changes:
+            change()
+            with self.subTest(change=change):
+                self.assertEqual(
+                    summary(PersistedRanker(self.user)),
+                    summary(Ranker(self.user)),
+                )
+
+    def test_ranking_reads_stored_state(self):
+        PersistedRanker(self.user)
+        for day in range(100):
+            Reaction.objects.create(
+                user=self.user, date=date(2020, 1, 1) + timedelta(days=day)
+            )
+
+        with self.assertNumQueries(2):
+            PersistedRanker(self.user).get_ranking()
+
+
+class TestRankingCache(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+
+    def test_served_from_cache(self):
+        ranking = get_ranker(self.user).get_ranking()
+
+        with self.assertNumQueries(1):
+            ranker = get_ranker(self.user)
+            self.assertEqual(ranker.get_ranking(), ranking)
+            ranker.suspect_amount_per_reaction("gluten")
+
+    def test_cached_per_engine(self):
+        get_ranker(self.user, "window").get_ranking()
+
+        with CaptureQueriesContext(connection) as queries:
+            get_ranker(self.user, "streaming")
+        self.assertGreater(len(queries), 1)
+        with self.assertNumQueries(1):
+            get_ranker(self.user, "window")
+
+    def test_cached_per_max_lag(self):
+        get_ranker(self.user, "multilag")
+
+        with override_settings(RANKER_MAX_LAG=1):
+            ranker = get_ranker(self.user, "multilag")
+        self.assertEqual(
+            {
+                len(suspect.reactivity_per_lag)
+                for suspect in ranker.suspects.values()
+            },
+            {2},
+        )
+
+    def test_writes_change_the_version(self):
+        get_ranker(self.user)
+        Meal.objects.create(
+            user=self.user,
+            food=Recipe.objects.get(name="salmon"),
+            amount=1000,
+            date=Reaction.objects.filter(user=self.user).latest("date").date,
+        )
+
+        self.assertEqual(
+            summary(get_ranker(self.user)), summary(Ranker(self.user))
+        )
+
+    def check_evicts_least_recently_used(self, cache):
+        cache.set("a", os.urandom(400))
+        cache.set("b", os.urandom(400))
+        cache.get("a")
+        cache.set("c", os.urandom(400))
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_locmem_evicts_least_recently_used(self):
+        self.check_evicts_least_recently_used(
+            MemoryCappedLocMemCache(
+                "test-capped", {"OPTIONS": {"MAX_BYTES": 1000}}
+            )
+        )
+
+    def test_file_based_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_evicts_least_recently_used(
+                MemoryCappedFileBasedCache(
+                    directory, {"OPTIONS": {"MAX_BYTES": 1000}}
+                )
+            )
+
+
+class TestExposureSeries(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+
+    def test_same_series_in_every_engine(self):
+        expected = Ranker(self.user)
+        for ranker in [
+            SlidingWindowRanker(self.user),
+            VectorRanker(self.user),
+            PersistedRanker(self.user),
+            get_ranker(self.user),
+        ]:
+            for suspect in expected.suspects:
+                self.assertEqual(
+                    ranker.exposure_series(suspect),
+                    expected.exposure_series(suspect),
+                )
+
+    def test_series_endpoint(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("history_series", kwargs={"suspect": "gluten"})
+        )
+        series = response.json()["series"]
+
+        self.assertEqual(
+            [entry["amount"] for entry in series],
+            [
+                amount
+                for reaction, amount in Ranker(self.user).exposure_series(
+                    "gluten"
+                )
+            ],
+        )
+        self.assertEqual(
+            self.client.get(
+                reverse("history_series", kwargs={"suspect": "nothing"})
+            ).status_code,
+            404,
+        )
+
+
+class TestRankAllUsers(TestCase):
+    fixtures = ["testdata.json"]
+
+    def test_ranks_every_user(self):
+        call_command("rank_all_users", workers=1, stdout=StringIO())
+
+        run = RankingRun.objects.get()
+        self.assertIsNotNone(run.finished)
+        for user in User.objects.all():
+            result = RankingResult.objects.get(run=run, user=user)
+            self.assertEqual(
+                [suspect["name"] for suspect in result.ranking],
+                [suspect.name for suspect in Ranker(user).get_ranking()],
+            )
+
+    def test_resumes_unfinished_run(self):
+        run = RankingRun.objects.create(engine="window")
+        done = User.objects.first()
+        RankingResult.objects.create(run=run, user=done, ranking=[])
+
+        call_command("rank_all_users", workers=1, resume=0, stdout=StringIO())
+
+        run.refresh_from_db()
+        self.assertIsNotNone(run.finished)
+        self.assertEqual(RankingResult.objects.get(user=done).ranking, [])
+        self.assertEqual(
+            RankingResult.objects.filter(run=run).count(),
+            User.objects.count(),
+        )
+
+
+class TestSyntheticData(TestCase):
+    def test_generated_diary_ranks_the_same_everywhere(self):
+        call_command(
+            "generate_diary_data",
+            users=2,
+            days=20,
+            recipes=20,
+            ingredients=30,
+            seed=1,
+            stdout=StringIO(),
+        )
+
+        for user in User.objects.all():
+            self.assertTrue(Meal.objects.filter(user=user).exists())
+            self.assertEqual(
+                summary(SlidingWindowRanker(user)), summary(Ranker(user))
+            )
+
+    def test_benchmark_leaves_database_unchanged(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.jsonl")
+            call_command(
+                "benchmark",
+                sizes="5",
+                engine=["window"],
+                repeats=1,
+                output=output,
+                stdout=StringIO(),
+            )
+            with open(output) as results:
+                targets = [json.loads(line)["target"] for line in results]
+
+        self.assertIn("ranker:window", targets)
+        self.assertIn("view:meals", targets)
+        self.assertFalse(User.objects.exists())
+
+
+class QueryBudgetTestCase(TestCase):
+    """Test case for views that declare a query budget.
+
+    The second request is checked, so the ranking state and caches filled by
+    the first one are not counted.
+    """
+
+    def assertWithinQueryBudget(self, url):
+        budget = budget_of(resolve(url).func)
+        self.assertIsNotNone(budget, f"{url} has no query budget")
+
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries),
+            budget,
+            "\n".join(query["sql"] for query in queries),
+        )
+
+
+class TestQueryBudgets(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = generate(
+            users=1, days=60, recipes=30, ingredients=40, seed=2
+        )[0]
+        self.client.force_login(self.user)
+
+    def test_views_within_budget(self):
+        suspect = get_ranker(self.user).get_ranking()[0].name
+        recipe = Recipe.objects.last().id
+        ingredient = IngredientAllergen.objects.last().ingredient_id
+
+        for url in [
+            reverse("dashboard"),
+            reverse("meal:all"),
+            reverse("reaction:all"),
+            reverse("ingredient:list"),
+            reverse("ingredient:detail", args=[ingredient]),
+            reverse("ingredient:update", args=[ingredient]),
+            reverse("recipe:list"),
+            reverse("recipe:detail", args=[recipe]),
+            reverse("recipe:update", args=[recipe]),
+            reverse("ranking"),
+            reverse("history", args=[suspect]),
+            reverse("history_series", args=[suspect]),
+        ]:
+            with self.subTest(url=url):
+                self.assertWithinQueryBudget(url)
+
+    def test_logs_requests_over_budget(self):
+        with mock.patch.object(views.MealAllView, "query_budget", 1):
+            with self.assertLogs("foodapp.queries", "WARNING") as logs:
+                self.client.get(reverse("meal:all"))
+
+        self.assertIn("GET /meal/all/", logs.output[0])
+
+
+class TestRankerProfile(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+
+    def test_profiles_stages(self):
+        with self.assertLogs("foodapp.profiling", "INFO"):
+            with profile_ranking() as profile:
+                SlidingWindowRanker(self.user).get_ranking()
+        stages = profile.as_dict()["stages"]
+
+        self.assertEqual(list(stages), ["fetch", "windows", "update", "sort"])
+        self.assertEqual(stages["fetch"]["queries"], 3)
+        self.assertEqual(
+            profile.counters["windows"],
+            Reaction.objects.filter(user=self.user).count(),
+        )
+        self.assertEqual(
+            profile.counters["meals"],
+            Meal.objects.filter(user=self.user).count(),
+        )
+        self.assertFalse(current_profile().enabled)
+
+    def test_ranking_page_shows_profile_to_staff(self):
+        get_ranker(self.user).get_ranking()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("ranking") + "?profile")
+        self.assertNotIn("profile", response.context)
+
+        self.user.is_staff = True
+        self.user.save()
+        with self.assertLogs("foodapp.profiling", "INFO"):
+            response = self.client.get(reverse("ranking") + "?profile")
+        self.assertIn("stages", response.context["profile"])
+        self.assertContains(response, 'id="ranker-profile"')
+
+
+class TestMealHistoryPages(TestCase):
+    def setUp(self):
+        self.user = generate(
+            users=1, days=60, recipes=10, ingredients=20, seed=3
+        )[0]
+        self.client.force_login(self.user)
+
+    def get_page(self, **params):
+        response = self.client.get(reverse("meal:all"), params)
+        meals = [
+            meal
+            for day, meals in response.context["daylist"]
+            for meal in meals
+        ]
+        return meals, response.context["older"], response.context["newer"]
+
+    def test_pages_cover_every_meal_newest_first(self):
+        seen = []
+        meals, older, newer = self.get_page()
+        self.assertIsNone(newer)
+        while True:
+            seen += meals
+            if older is None:
+                break
+            meals, older, newer = self.get_page(before=older)
+            self.assertIsNotNone(newer)
+
+        self.assertEqual(
+            [meal.id for meal in seen],
+            list(
+                Meal.objects.filter(user=self.user)
+                .order_by("-date", "-id")
+                .values_list("id", flat=True)
+            ),
+        )
+
+    def test_newer_page_goes_back(self):
+        first, older, _ = self.get_page()
+        second, _, newer = self.get_page(before=older)
+
+        self.assertEqual(self.get_page(after=newer)[0], first)
+
+    def test_days_are_grouped(self):
+        response = self.client.get(reverse("meal:all"))
+        days = [day for day, meals in response.context["daylist"]]
+
+        self.assertEqual(days, sorted(set(days), reverse=True))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("meal:all"), {"before": "x"})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestSearch(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.client.force_login(User.objects.get(username="testuser"))
+
+    def names(self, model, query):
+        return [match.name for match in search(model, query)]
+
+    def test_prefix_and_token_matching(self):
+        self.assertEqual(self.names(Ingredient, "sal"), ["salt", "salmon"])
+        self.assertEqual(
+            self.names(Ingredient, "chee"),
+            ["cheese", "mozzarella cheese"],
+        )
+        self.assertEqual(
+            self.names(Ingredient, "mozz chee"), ["mozzarella cheese"]
+        )
+        self.assertEqual(self.names(Ingredient, "  "), [])
+
+    def test_fallback_without_fts(self):
+        with mock.patch("foodapp.search.fts_enabled", return_value=False):
+            self.assertEqual(
+                self.names(Ingredient, "chee"),
+                ["cheese", "mozzarella cheese"],
+            )
+            self.assertEqual(
+                self.names(Ingredient, "ozz"), ["mozzarella cheese"]
+            )
+
+    def test_index_follows_saves(self):
+        salmon = Ingredient.objects.get(name="salmon")
+        salmon.name = "trout"
+        salmon.save()
+        Ingredient.objects.get(name="salt").delete()
+        Ingredient.objects.create(name="saffron")
+
+        self.assertEqual(self.names(Ingredient, "sa"), ["saffron"])
+        self.assertEqual(self.names(Ingredient, "trout"), ["trout"])
+
+    def test_list_view(self):
+        response = self.client.get(reverse("recipe:list"), {"recipe": "piz"})
+        self.assertEqual(
+            [recipe.name for recipe in response.context["object_list"]],
+            ["pizza"],
+        )
+
+    def test_autocomplete(self):
+        response = self.client.get(
+            reverse("search"), {"q": "salm", "kind": "recipe"}
+        )
+        self.assertEqual(
+            [result["name"] for result in response.json()["results"]],
+            ["salmon"],
+        )
+
+        response = self.client.get(reverse("search"), {"q": "salm"})
+        self.assertEqual(
+            [result["kind"] for result in response.json()["results"]],
+            ["ingredient", "recipe"],
+        )
+        self.assertEqual(
+            self.client.get(
+                reverse("search"), {"q": "salm", "kind": "meal"}
+            ).status_code,
+            404,
+        )
+
+
+class TestRecipeLookup(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.client.force_login(self.user)
+
+    def test_meal_form_does_not_list_recipes(self):
+        response = self.client.get(reverse("meal:create"))
+
+        self.assertNotContains(response, "<option")
+        self.assertContains(response, 'class="recipe-typeahead')
+
+    def test_meal_form_saves_chosen_recipe(self):
+        pizza = Recipe.objects.get(name="pizza")
+        self.client.post(
+            reverse("meal:create"),
+            {"date": "2023-05-01", "food": pizza.id, "amount": 100},
+        )
+
+        self.assertTrue(
+            Meal.objects.filter(
+                user=self.user, food=pizza, date=date(2023, 5, 1)
+            ).exists()
+        )
+
+    def test_lookup_pages_are_cached(self):
+        Recipe.objects.create(name="salad")
+        url = reverse("recipe:lookup")
+        with mock.patch("foodapp.views.RecipeLookupView.size", 1):
+            first = self.client.get(url, {"q": "s"}).json()
+            with self.assertNumQueries(3):
+                self.assertEqual(
+                    self.client.get(url, {"q": "s"}).json(), first
+                )
+            second = self.client.get(url, {"q": "s", "page": 2}).json()
+
+        self.assertEqual(len(first["results"]), 1)
+        self.assertTrue(first["has_more"])
+        self.assertNotEqual(first["results"], second["results"])
+
+    def test_recent_recipes(self):
+        latest = Meal.objects.filter(user=self.user).latest("date", "id")
+        oatmeal = Recipe.objects.get(name="oatmeal")
+        response = self.client.get(reverse("recipe:lookup"))
+        self.assertEqual(response.json()["results"][0]["id"], latest.food_id)
+
+        Meal.objects.create(
+            user=self.user,
+            food=oatmeal,
+            amount=50,
+            date=latest.date + timedelta(days=1),
+        )
+        response = self.client.get(reverse("recipe:lookup"))
+        self.assertEqual(
+            response.json()["results"][0],
+            {"id": oatmeal.id, "name": "oatmeal"},
+        )
+
+
+class TestNestedRecipes(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.dough = Recipe.objects.create(name="dough")
+        self.flour = RecipeIngredient.objects.create(
+            recipe=self.dough,
+            ingredient=Ingredient.objects.get(name="flour"),
+            percent=80,
+        )
+        self.pie = Recipe.objects.create(name="pie")
+        RecipeIngredient.objects.create(
+            recipe=self.pie,
+            ingredient=Ingredient.objects.get(name="salmon"),
+            percent=50,
+        )
+        RecipeComponent.objects.create(
+            recipe=self.pie, component=self.dough, percent=50
+        )
+
+    def composition(self, recipe):
+        return dict(
+            RecipeComposition.objects.filter(recipe=recipe).values_list(
+                "suspect", "parts"
+            )
+        )
+
+    def test_composition_goes_through_sub_recipes(self):
+        dough = self.composition(self.dough)
+        pie = self.composition(self.pie)
+
+        self.assertEqual(list(pie)[0], "salmon")
+        for suspect, parts in dough.items():
+            self.assertEqual(pie[suspect], parts // 2)
+
+    def test_follows_sub_recipe_changes(self):
+        before = self.composition(self.pie)
+        self.flour.percent = 40
+        self.flour.save()
+
+        for suspect, parts in self.composition(self.dough).items():
+            self.assertEqual(self.composition(self.pie)[suspect], parts // 2)
+        self.assertNotEqual(self.composition(self.pie), before)
+
+    def test_rankers_agree(self):
+        latest = Reaction.objects.filter(user=self.user).latest("date")
+        Meal.objects.create(
+            user=self.user, food=self.pie, amount=300, date=latest.date
+        )
+
+        self.assertEqual(
+            summary(SlidingWindowRanker(self.user)),
+            summary(Ranker(self.user)),
+        )
+
+    def test_prevents_cycles(self):
+        cake = Recipe.objects.create(name="cake")
+        RecipeComponent.objects.create(
+            recipe=cake, component=self.pie, percent=10
+        )
+
+        for recipe in [self.dough, self.pie]:
+            self.assertTrue(
+                RecipeComponent(
+                    recipe=recipe, component=cake, percent=10
+                ).creates_cycle()
+            )
+
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse("recipe:components:create", args=[self.dough.id]),
+            {"component": cake.id, "percent": 10},
+        )
+        self.assertContains(response, "already contains")
+        self.assertFalse(
+            RecipeComponent.objects.filter(recipe=self.dough).exists()
+        )
+
+
+class TestDiaryImport(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.latest = Reaction.objects.filter(user=self.user).latest("date")
+
+    def test_command_imports_csv(self):
+        meals = Meal.objects.filter(user=self.user, date=self.latest.date)
+        before = meals.count()
+        day = self.latest.date.isoformat()
+        rows = [
+            "type,date,recipe,amount,reaction,diary",
+            f"meal,{day},Egg,120,,",
+            f"meal,{day},PIZZA,300,,",
+            f"meal,{day},unknown,100,,",
+            f"meal,yesterday,Egg,100,,",
+            f"reaction,{day},,,yes,itchy",
+        ]
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as diary:
+            diary.write("\n".join(rows))
+            diary.flush()
+            out, err = StringIO(), StringIO()
+            call_command(
+                "import_diary",
+                "testuser",
+                diary.name,
+                batch_size=2,
+                stdout=out,
+                stderr=err,
+            )
+
+        self.assertIn("2 meals and 1 reactions", out.getvalue())
+        self.assertIn("rows/s", out.getvalue())
+        self.assertIn("Line 4: Unknown recipe 'unknown'", err.getvalue())
+        self.assertIn("Line 5: Invalid date 'yesterday'", err.getvalue())
+        self.assertEqual(meals.count(), before + 2)
+        reaction = Reaction.objects.get(id=self.latest.id)
+        self.assertEqual(reaction.reaction, Reaction.YES)
+        self.assertEqual(reaction.diary, "itchy")
+
+    def test_reads_json_array_in_chunks(self):
+        rows = [
+            {"type": "meal", "date": "2023-01-01", "recipe": "Egg"},
+            {"type": "reaction", "diary": "[not] {the} end]"},
+        ]
+        stream = StringIO(json.dumps(rows, indent=2))
+        self.assertEqual(list(read_json_array(stream, chunk_size=7)), rows)
+
+    def test_failed_batch_keeps_ranking_up_to_date(self):
+        PersistedRanker(self.user)
+        version = versions.data_version(self.user.id)
+        day = (self.latest.date + timedelta(days=1)).isoformat()
+        rows = [
+            (1, {"type": "meal", "date": day, "recipe": "milk", "amount": 9}),
+            (2, {"type": "meal", "date": day, "recipe": "Egg", "amount": 9}),
+        ]
+        save_meals = diary_io.save_meals
+        calls = []
+
+        def fail_second(meals):
+            calls.append(meals)
+            if len(calls) == 2:
+                raise RuntimeError("Connection lost")
+            save_meals(meals)
+
+        with mock.patch.object(diary_io, "save_meals", fail_second):
+            with self.assertRaises(RuntimeError):
+                import_diary(self.user, rows, batch_size=1)
+
+        self.assertNotEqual(versions.data_version(self.user.id), version)
+        self.assertEqual(
+            summary(PersistedRanker(self.user)), summary(Ranker(self.user))
+        )
+
+    def test_upload_keeps_ranking_up_to_date(self):
+        PersistedRanker(self.user)
+        day = (self.latest.date + timedelta(days=1)).isoformat()
+        diary = "\n".join(
+            json.dumps(row)
+            for row in [
+                {"type": "meal", "date": day, "recipe": "milk", "amount": 9},
+                {"type": "reaction", "date": day, "reaction": 1},
+                {"type": "reaction", "date": day, "reaction": "maybe"},
+            ]
+        )
+        upload = SimpleUploadedFile("diary.ndjson", diary.encode())
+
+        self.client.force_login(self.user)
+        response = self.client.post(reverse("meal:import"), {"diary": upload})
+
+        self.assertContains(response, "Imported 1 meals and 1 reactions")
+        self.assertContains(response, "Line 3: Invalid reaction")
+        self.assertEqual(
+            summary(PersistedRanker(self.user)), summary(Ranker(self.user))
+        )
+
+
+class TestDiaryExport(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    def download(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_export_imports_back(self):
+        exported = self.download(reverse("export:diary", args=["csv"]))
+        meals = Meal.objects.filter(user=self.user).count()
+        reactions = Reaction.objects.filter(user=self.user).count()
+
+        rows = list(read_rows(StringIO(exported), "csv"))
+        self.assertEqual(len(rows), meals + reactions)
+        dates = [row["date"] for line, row in rows]
+        self.assertEqual(dates, sorted(dates))
+
+        report = import_diary(self.user, rows)
+        self.assertEqual((report.meals, report.rejected), (meals, []))
+        self.assertEqual(
+            Reaction.objects.filter(user=self.user).count(), reactions
+        )
+        self.assertEqual(
+            Meal.objects.filter(user=self.user).count(), 2 * meals
+        )
+
+    async def test_streams_under_asgi(self):
+        read = []
+
+        def rows(*args, **kwargs):
+            for row in diary_rows(*args, **kwargs):
+                read.append(row)
+                yield row
+
+        with mock.patch.object(views, "diary_rows", rows), mock.patch.object(
+            views, "export_lines", partial(export_lines, rows_per_chunk=1)
+        ):
+            response = await self.async_client.get(
+                reverse("export:diary", args=["ndjson"])
+            )
+            chunks = aiter(response)
+            await anext(chunks)
+            self.assertEqual(len(read), 1)
+            rest = [chunk async for chunk in chunks]
+
+        self.assertGreater(len(rest), 1)
+        self.assertEqual(len(read), 1 + len(rest))
+
+    def test_resumes_by_date_range(self):
+        days = sorted(
+            {meal.date for meal in Meal.objects.filter(user=self.user)}
+        )
+        since, until = days[1], days[-2]
+        exported = self.download(
+            reverse("export:diary", args=["ndjson"])
+            + f"?since={since}&until={until}"
+        )
+
+        rows = [json.loads(line) for line in exported.splitlines()]
+        self.assertEqual(
+            len(rows),
+            Meal.objects.filter(
+                user=self.user, date__range=(since, until)
+            ).count()
+            + Reaction.objects.filter(
+                user=self.user, date__range=(since, until)
+            ).count(),
+        )
+        self.assertEqual(rows[0]["date"], since.isoformat())
+
+        response = self.client.get(
+            reverse("export:diary", args=["csv"]) + "?since=soon"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_exports_ranking(self):
+        exported = self.download(reverse("export:ranking", args=["csv"]))
+
+        names = [
+            row["name"] for line, row in read_rows(StringIO(exported), "csv")
+        ]
+        self.assertEqual(
+            names,
+            [suspect.name for suspect in Ranker(self.user).get_ranking()],
+        )
+        response = self.client.get(reverse("export:ranking", args=["xml"]))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestBatchApi(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.client.force_login(self.user)
+        self.day = date(2030, 1, 1)
+
+    def post(self, name, items):
+        return self.client.post(
+            reverse(name), items, content_type="application/json"
+        )
+
+    def meals(self, count):
+        return [
+            {"date": str(self.day), "recipe": "Egg", "amount": amount}
+            for amount in range(1, count + 1)
+        ]
+
+    def test_logs_meals(self):
+        egg = Recipe.objects.get(name="Egg")
+        response = self.post(
+            "api:meals",
+            [
+                {"date": str(self.day), "recipe": "egg", "amount": 50},
+                {"date": str(self.day), "food": egg.id, "amount": 60},
+                {"date": str(self.day), "recipe": "stone", "amount": 1},
+                "Egg",
+            ],
+        )
+
+        results = response.json()["results"]
+        self.assertEqual(
+            [result["status"] for result in results],
+            ["saved", "saved", "rejected", "rejected"],
+        )
+        self.assertIn("Unknown recipe 'stone'", results[2]["error"])
+        meal = Meal.objects.get(id=results[1]["id"])
+        self.assertEqual((meal.food, meal.amount), (egg, 60))
+        self.assertEqual(
+            Meal.objects.filter(user=self.user, date=self.day).count(), 2
+        )
+
+    def test_queries_do_not_grow_with_batch_size(self):
+        counts = []
+        for size in [1, 50]:
+            with CaptureQueriesContext(connection) as queries:
+                self.post("api:meals", self.meals(size))
+            counts.append(len(queries))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertLessEqual(
+            counts[1], budget_of(resolve("/api/meals/").func)
+        )
+
+    def test_upserts_reactions(self):
+        latest = Reaction.objects.filter(user=self.user).latest("date")
+        response = self.post(
+            "api:reactions",
+            [
+                {"date": str(latest.date), "reaction": "yes", "diary": "a"},
+                {"date": str(self.day), "reaction": 0, "diary": "b"},
+                {"date": "tomorrow", "reaction": 1},
+            ],
+        )
+
+        self.assertEqual(
+            [result["status"] for result in response.json()["results"]],
+            ["saved", "saved", "rejected"],
+        )
+        latest.refresh_from_db()
+        self.assertEqual((latest.reaction, latest.diary), (Reaction.YES, "a"))
+        self.assertTrue(
+            Reaction.objects.filter(user=self.user, date=self.day).exists()
+        )
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.post("api:meals", {"a": 1}).status_code, 400)
+        with mock.patch.object(views.BatchView, "max_items", 2):
+            self.assertEqual(
+                self.post("api:meals", self.meals(3)).status_code, 400
+            )
+        self.client.logout()
+        self.assertEqual(self.post("api:meals", []).status_code, 403)
+
+
+class TestRankerPool(SimpleTestCase):
+    @override_settings(RANKER_WORKERS=1, RANKER_MAX_PENDING=1)
+    def test_turns_away_rankings_over_the_limit(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_ranking():
+            started.set()
+            release.wait(5)
+            return threading.current_thread().name
+
+        async def rank_twice():
+            first = asyncio.ensure_future(run_ranker(slow_ranking))
+            await asyncio.get_running_loop().run_in_executor(
+                None, started.wait, 5
+            )
+            with self.assertRaises(RankerBusy):
+                await run_ranker(slow_ranking)
+            release.set()
+            return await first
+
+        self.assertTrue(async_to_sync(rank_twice)().startswith("ranker"))
+
+    def test_busy_ranker_answers_503(self):
+        user = User(id=1, username="busy")
+        with mock.patch.object(views, "run_ranker", side_effect=RankerBusy):
+            for view in [views.RankingView, views.FoodHistoryView]:
+                request = RequestFactory().get("/")
+                request.user = user
+                response = async_to_sync(view.as_view())(
+                    request, suspect="egg"
+                )
+                self.assertEqual(response.status_code, 503)
+
+
+@override_settings(RANKING_IN_BACKGROUND=True, RANKING_QUEUE_DELAY=0)
+class TestRankingQueue(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.client.force_login(self.user)
+        self.egg = Recipe.objects.get(name="Egg")
+
+    def work(self):
+        call_command("run_ranking_worker", once=True, stdout=StringIO())
+
+    def test_coalesces_edits(self):
+        self.work()
+        for amount in [10, 20, 30]:
+            Meal.objects.create(user=self.user, food=self.egg, amount=amount)
+
+        job = RankingJob.objects.get(user=self.user)
+        self.assertLess(job.first_requested_at, job.last_requested_at)
+        self.assertEqual(queue_metrics()["depth"], 1)
+
+    def test_serves_last_ranking_while_refreshing(self):
+        response = self.client.get(reverse("ranking"))
+        self.assertContains(response, "being computed")
+
+        self.work()
+        response = self.client.get(reverse("ranking"))
+        self.assertNotContains(response, "ranking-refreshing")
+        self.assertEqual(
+            [suspect["name"] for suspect in response.context["ranking"]],
+            [suspect.name for suspect in Ranker(self.user).get_ranking()],
+        )
+
+        Meal.objects.create(user=self.user, food=self.egg, amount=10)
+        self.assertContains(
+            self.client.get(reverse("ranking")), "ranking-refreshing"
+        )
+
+    def test_requeues_edits_made_while_running(self):
+        self.work()
+        Meal.objects.create(user=self.user, food=self.egg, amount=10)
+        [job] = claim_jobs(10)
+        Meal.objects.create(user=self.user, food=self.egg, amount=20)
+        run_job(job)
+
+        job = RankingJob.objects.get(user=self.user)
+        self.assertIsNone(job.started_at)
+        self.assertEqual(job.first_requested_at, job.last_requested_at)
+
+    @override_settings(RANKING_QUEUE_MAX_ATTEMPTS=2)
+    def test_retries_failed_jobs(self):
+        with mock.patch("foodapp.jobs.get_ranker", side_effect=ValueError):
+            with self.assertLogs("foodapp.jobs", "ERROR"):
+                self.work()
+            job = RankingJob.objects.get(user=self.user)
+            self.assertEqual(job.attempts, 1)
+            self.assertIn("ValueError", job.last_error)
+            self.assertIsNone(job.failed_at)
+
+            RankingJob.objects.update(run_after=timezone.now())
+            with self.assertLogs("foodapp.jobs", "ERROR"):
+                self.work()
+        job.refresh_from_db()
+        self.assertIsNotNone(job.failed_at)
+        self.assertEqual(queue_metrics()["failed"], 2)
+
+        Meal.objects.create(user=self.user, food=self.egg, amount=10)
+        self.work()
+        self.assertFalse(RankingJob.objects.filter(user=self.user).exists())
+
+
+class TestFoodHistory(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.client.force_login(self.user)
+        self.url = reverse("history", args=["gluten"])
+        self.reactions = Reaction.objects.filter(user=self.user).order_by(
+            "-date"
+        )
+        self.warm()
+
+    def warm(self):
+        """Rank, so the pages only read the stored state."""
+        get_ranker(self.user).get_ranking()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # Served chunk by chunk under WSGI too.
+        self.assertFalse(response.is_async)
+        return b"".join(response.streaming_content).decode()
+
+    def test_pages_by_date(self):
+        second = self.reactions[1]
+        with mock.patch.object(views.FoodHistoryView, "paginate_by", 2):
+            page = self.get(self.url)
+            older = self.get(f"{self.url}?before={second.date}")
+
+        self.assertEqual(page.count("Amount of gluten consumed"), 2)
+        self.assertIn(f"?before={second.date}", page)
+        self.assertEqual(
+            older.count("Amount of gluten consumed"),
+            min(2, self.reactions.count() - 2),
+        )
+        self.assertEqual(
+            self.client.get(f"{self.url}?before=later").status_code, 400
+        )
+
+    def test_escapes_the_diary(self):
+        Reaction.objects.filter(id=self.reactions[0].id).update(
+            diary="<script>alert(1)</script>"
+        )
+        versions.bump_user(self.user.id)
+        self.warm()
+
+        page = self.get(self.url)
+        self.assertIn("&lt;script&gt;", page)
+        self.assertNotIn("<script>alert", page)
+
+    def test_caches_reactions_per_data_version(self):
+        first = self.get(self.url)
+        with mock.patch("foodapp.views.get_template") as get_template:
+            self.assertEqual(self.get(self.url), first)
+            get_template.return_value.render.assert_not_called()
+
+            get_template.return_value.render.return_value = ""
+            Meal.objects.create(
+                user=self.user,
+                food=Recipe.objects.get(name="Bread"),
+                amount=10,
+                date=self.reactions[0].date,
+            )
+            self.warm()
+            self.get(self.url)
+            get_template.return_value.render.assert_called()
+
+
+class TestFragmentCache(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        self.client.force_login(self.user)
+
+    def test_dashboard_reads_the_diary_after_changes_only(self):
+        self.client.get(reverse("dashboard"))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("dashboard"))
+        self.assertFalse(
+            [query for query in queries if "foodapp_meal" in query["sql"]]
+        )
+
+        Meal.objects.create(
+            user=self.user, food=Recipe.objects.get(name="salmon"), amount=7
+        )
+        self.assertContains(
+            self.client.get(reverse("dashboard")), "7 g of salmon"
+        )
+
+    def test_fragments_are_per_user(self):
+        self.client.get(reverse("dashboard"))
+        Meal.objects.create(
+            user=self.user, food=Recipe.objects.get(name="salmon"), amount=7
+        )
+        self.client.get(reverse("dashboard"))
+
+        self.client.force_login(User.objects.get(username="grande"))
+        self.assertNotContains(
+            self.client.get(reverse("dashboard")), "7 g of salmon"
+        )
+
+    def test_counts_hits_and_misses(self):
+        before = fragment_stats()["ranking"]
+        for _ in range(3):
+            self.client.get(reverse("ranking"))
+        after = fragment_stats()["ranking"]
+
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 2)
+
+        url = reverse("fragment_stats")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(
+            self.client.get(url).json()["ranking"]["hits"], after["hits"]
+        )
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class TestReadReplicas(TestCase):
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+
+    def versions(self, replica):
+        """Patch the data versions the primary and the replica report."""
+        return mock.patch.object(
+            replicas,
+            "data_version",
+            lambda user_id, using: replica if using == "replica" else (5, 1),
+        )
+
+    def test_reads_go_to_up_to_date_replica(self):
+        with self.versions((5, 1)), replica_reads(self.user.id):
+            self.assertEqual(Meal.objects.all().db, "replica")
+        self.assertEqual(Meal.objects.all().db, "default")
+
+    def test_lagging_replica_is_skipped(self):
+        for version in [(4, 1), (5, 0)]:
+            with self.versions(version), replica_reads(self.user.id):
+                self.assertEqual(Meal.objects.all().db, "default")
+
+    def test_without_replicas_reads_stay_on_primary(self):
+        with override_settings(DATABASE_REPLICAS=[]):
+            with self.assertNumQueries(0):
+                self.assertEqual(replica_for(self.user.id), "default")
+
+    def test_reads_after_a_write_go_to_primary(self):
+        with self.versions((5, 1)), replica_reads(self.user.id):
+            self.assertEqual(Meal.objects.all().db, "replica")
+            Meal.objects.create(
+                user=self.user,
+                food=Recipe.objects.using("default").get(name="Egg"),
+                date=date(2023, 5, 1),
+                amount=1,
+            )
+            self.assertEqual(Meal.objects.all().db, "default")
+
+    def test_ranking_and_export_read_from_replica(self):
+        self.client.force_login(self.user)
+        get_ranker(self.user).get_ranking()
+        with mock.patch.object(
+            replicas, "replica_for", return_value="default"
+        ) as replica_for:
+            self.client.get(reverse("ranking"))
+            self.client.get(reverse("export:ranking", args=["csv"]))
+        self.assertEqual(
+            replica_for.call_args_list, [mock.call(self.user.id)] * 2
+        )
+
+        with mock.patch.object(
+            views, "replica_for", return_value="default"
+        ) as replica_for:
+            response = self.client.get(reverse("export:diary", args=["csv"]))
+            b"".join(response.streaming_content)
+        replica_for.assert_called_once_with(self.user.id)
+
+
+@override_settings(DATABASE_SHARDS=["default", "shard"])
+class TestSharding(TestCase):
+    databases = {"default", "shard"}
+    fixtures = ["testdata.json"]
+
+    def setUp(self):
+        self.user = User.objects.get(username="testuser")
+        # The fixtures are loaded into the shard too.
+        shards.delete_diary(self.user.id, "shard")
+
+    def diary(self, alias):
+        return (
+            Meal.objects.using(alias).filter(user=self.user).count(),
+            Reaction.objects.using(alias).filter(user=self.user).count(),
+        )
+
+    def test_hash_is_stable_and_moves_few_users(self):
+        two = [
+            shards.hash_shard(user_id, ["a", "b"]) for user_id in range(1000)
+        ]
+        self.assertEqual(
+            two,
+            [
+                shards.hash_shard(user_id, ["a", "b"])
+                for user_id in range(1000)
+            ],
+        )
+        self.assertTrue(300 < two.count("a") < 700)
+        three = [
+            shards.hash_shard(user_id, ["a", "b", "c"])
+            for user_id in range(1000)
+        ]
+        moved = [new for old, new in zip(two, three) if old != new]
+        self.assertEqual(set(moved), {"c"})
+        self.assertTrue(200 < len(moved) < 450)
+
+    def test_new_users_are_placed_by_hash(self):
+        user = User.objects.create_user("sharded")
+        self.assertEqual(
+            shards.shard_for(user.id), shards.hash_shard(user.id)
+        )
+        self.assertEqual(shards.shard_for(self.user.id), "default")
+
+    def test_requests_use_the_users_shard(self):
+        UserShard.objects.create(user=self.user, database="shard")
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse("api:meals"),
+            json.dumps(
+                [{"date": "2023-05-01", "recipe": "Egg", "amount": 2}]
+            ),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["results"][0]["status"], "saved")
+        self.assertEqual(self.diary("shard"), (1, 0))
+
+        with shards.on_shard("shard"):
+            get_ranker(self.user).get_ranking()
+        response = self.client.get(reverse("ranking"))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            RankingState.objects.using("default")
+            .filter(user=self.user)
+            .exists()
+        )
+
+    def test_streaming_engine_reads_the_shard(self):
+        expected = summary(Ranker(self.user))
+        shards.move_user(self.user.id, "default", "shard")
+
+        with shards.user_shard(self.user.id):
+            ranker = StreamingRanker(self.user)
+        self.assertTrue(expected)
+        self.assertEqual(summary(ranker), expected)
+
+    def test_move_keeps_writes_before_the_switch(self):
+        before = self.diary("default")
+        reaction = Reaction.objects.filter(user=self.user).latest("date")
+        data_version = shards.data_version
+        calls = []
+
+        def write_after_check(*args, **kwargs):
+            version = data_version(*args, **kwargs)
+            calls.append(version)
+            if len(calls) == 2:
+                # After the copy was checked, before the user is switched.
+                Meal.objects.create(
+                    user=self.user,
+                    food=Recipe.objects.get(name="Egg"),
+                    amount=7,
+                    date=reaction.date,
+                )
+                reaction.diary = "late"
+                reaction.save()
+            return version
+
+        with mock.patch.object(shards, "data_version", write_after_check):
+            shards.move_user(self.user.id, "default", "shard")
+
+        self.assertEqual(self.diary("shard"), (before[0] + 1, before[1]))
+        self.assertEqual(self.diary("default"), (0, 0))
+        self.assertTrue(
+            Meal.objects.using("shard").filter(user=self.user, amount=7)
+        )
+        self.assertEqual(
+            Reaction.objects.using("shard")
+            .get(user=self.user, date=reaction.date)
+            .diary,
+            "late",
+        )
+
+    def test_admin_lists_and_deletes_on_a_shard(self):
+        shards.move_user(self.user.id, "default", "shard")
+        meal = Meal.objects.using("shard").filter(user=self.user).first()
+        admin = User.objects.create_superuser("admin")
+        self.client.force_login(admin)
+
+        changelist = reverse("admin:foodapp_meal_changelist")
+        response = self.client.get(changelist + "?database=shard")
+        self.assertContains(response, f"/{meal.id}/change/")
+        response = self.client.get(changelist)
+        self.assertNotContains(response, f"/{meal.id}/change/")
+
+        delete = reverse("admin:foodapp_meal_delete", args=[meal.id])
+        response = self.client.post(
+            delete + "?_changelist_filters=database%3Dshard", {"post": "yes"}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Meal.objects.using("shard").filter(id=meal.id))
+
+    def test_catalog_is_copied_to_shards(self):
+        recipe = Recipe.objects.create(name="sharded soup")
+        self.assertTrue(
+            Recipe.objects.using("shard").filter(id=recipe.id).exists()
+        )
+        recipe.delete()
+        self.assertFalse(
+            Recipe.objects.using("shard").filter(id=recipe.id).exists()
+        )
+
+    def test_rebalance_moves_users_to_the_only_shard(self):
+        before = self.diary("default")
+        version = versions.data_version(self.user.id)
+
+        with override_settings(DATABASE_SHARDS=["shard"]):
+            call_command("rebalance_shards", stdout=StringIO())
+
+        self.assertEqual(self.diary("shard"), before)
+        self.assertEqual(self.diary("default"), (0, 0))
+        self.assertEqual(
+            UserShard.objects.get(user=self.user).database, "shard"
+        )
+        self.assertNotEqual(versions.data_version(self.user.id), version)
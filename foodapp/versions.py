@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import time
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from .models import DataVersion
+
+CATALOG = "catalog"
+
+
+def user_scope(user_id):
+    return f"user:{user_id}"
+
+
+def bump(scope):
+    """Give the scope a version it never had before.
+
+    Versions follow the clock rather than counting from zero, so a version
+    is not reused after a rolled back transaction or a recreated database
+    and cannot match an old cache entry.
+    """
+    now = time.time_ns()
+    updated = DataVersion.objects.filter(scope=scope).update(
+        version=Greatest(F("version") + 1, Value(now))
+    )
+    if not updated:
+        DataVersion.objects.get_or_create(
+            scope=scope, defaults={"version": now}
+        )
+
+
+def bump_user(user_id):
+    bump(user_scope(user_id))
+
+
+def bump_catalog():
+    bump(CATALOG)
+
+
+def data_version(user_id, using=None):
+    """The versions of the user's diary and of the shared catalog, in the
+    `using` database if given."""
+    versions = dict(
+        DataVersion.objects.using(using)
+        .filter(scope__in=[user_scope(user_id), CATALOG])
+        .values_list("scope", "version")
+    )
+    return versions.get(user_scope(user_id), 0), versions.get(CATALOG, 0)
+
+
+def catalog_version():
+    return (
+        DataVersion.objects.filter(scope=CATALOG)
+        .values_list("version", flat=True)
+        .first()
+        or 0
+    )
@@ -1,17 +1,60 @@
-from .ranker import Ranker
+import io
+import json
+from dataclasses import asdict
+from inspect import iscoroutine
+from itertools import groupby
+from operator import attrgetter
+from .diary_io import (
+    COLUMNS,
+    EXPORT_FORMATS,
+    RANKING_COLUMNS,
+    diary_format,
+    diary_rows,
+    export_lines,
+    import_diary,
+    ranking_rows,
+    read_rows,
+    save_batch,
+)
+from .forms import DiaryImportForm, MealForm, RecipeComponentForm
+from .fragments import cached_fragments, fragment_stats
+from .jobs import background_ranking, latest_ranking
+from .lookup import lookup_recipes, recent_recipes
+from .pagination import keyset_page
+from .pool import RankerBusy, run_ranker
+from .profiling import profile_ranking
+from .queries import query_budget
+from .ranker import get_ranker
+from .replicas import replica_for, replica_reads
+from .search import SEARCH_MODELS, search, tokens
+from .shards import current_shard
+from .versions import data_version
+from django.conf import settings
+from django.core.exceptions import BadRequest, PermissionDenied
 from django.db.utils import IntegrityError
+from asgiref.sync import sync_to_async
+from django.http import (
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from datetime import date
+from django.template.loader import get_template, render_to_string
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from .models import (
     Allergen,
     Ingredient,
     IngredientAllergen,
     Recipe,
+    RecipeComponent,
     RecipeIngredient,
     Meal,
     Reaction,
 )
 from django.contrib.auth.forms import UserCreationForm
-from django.views.generic import TemplateView, ListView
+from django.views.generic import TemplateView, ListView, View
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import (
     CreateView,
@@ -33,35 +76,60 @@ class SignupView(FormView):
         return super().form_valid(form)
 
 
-class DashboardView(LoginRequiredMixin, TemplateView):
-    template_name = "dashboard.html"
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    """LoginRequiredMixin for views with async handlers.
 
-        today = timezone.now().date()
-        meals = Meal.objects.filter(user=self.request.user, date=today)
+    The user is loaded off the event loop before it is checked. A ranking
+    that does not fit in the ranker pool is answered with a 503.
+    """
 
+    async def dispatch(self, request, *args, **kwargs):
+        await sync_to_async(lambda: request.user.is_authenticated)()
         try:
-            reaction = Reaction.objects.get(
-                user=self.request.user, date=today
+            response = super().dispatch(request, *args, **kwargs)
+            if iscoroutine(response):
+                response = await response
+        except RankerBusy:
+            response = HttpResponse(
+                "Too many rankings at once, try again shortly.",
+                status=503,
+                headers={"Retry-After": "5"},
             )
-        except Reaction.DoesNotExist:
-            reaction = None
+        return response
 
-        context["meals"] = meals
-        context["reaction"] = reaction
-        return context
+
+@query_budget(5)
+class DashboardView(AsyncLoginRequiredMixin, TemplateView):
+    """Today's meals and reaction.
+
+    The page is a fragment cached per user and day, so the meals and the
+    reaction are only read, when the template renders, after they changed.
+    """
+
+    template_name = "dashboard.html"
+
+    async def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+
+        today = timezone.now().date()
+        context["today"] = today
+        context["meals"] = Meal.objects.filter(
+            user=request.user, date=today
+        ).select_related("food")
+        context["reaction"] = SimpleLazyObject(
+            Reaction.objects.filter(user=request.user, date=today).first
+        )
+        return self.render_to_response(context)
 
 
 class MealCreateView(LoginRequiredMixin, CreateView):
     template_name = "meal/create.html"
-    model = Meal
-    fields = [
-        "date",
-        "food",
-        "amount",
-    ]
+    form_class = MealForm
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs["user"] = self.request.user
+        return kwargs
 
     def form_valid(self, form):
         form.instance.user = self.request.user
@@ -81,30 +149,53 @@ class MealDeleteView(LoginRequiredMixin, DeleteView):
         return reverse("dashboard")
 
 
+@query_budget(3)
 class MealAllView(LoginRequiredMixin, TemplateView):
+    """The user's meals newest first, grouped by day, a page at a time."""
+
     template_name = "meal/all.html"
+    paginate_by = 50
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        meals = Meal.objects.filter(user=self.request.user).order_by("-date")
+        meals, older, newer = keyset_page(
+            Meal.objects.filter(user=self.request.user).select_related(
+                "food"
+            ),
+            self.paginate_by,
+            before=self.request.GET.get("before"),
+            after=self.request.GET.get("after"),
+        )
 
-        days = {}
-        for meal in meals:
-            key = meal.date
-            if key not in days.keys():
-                days[key] = [meal]
-            else:
-                days[key].append(meal)
+        context["daylist"] = [
+            [day, list(day_meals)]
+            for day, day_meals in groupby(meals, key=attrgetter("date"))
+        ]
+        context["older"] = older
+        context["newer"] = newer
+        return context
 
-        daylist = []
-        for key in days.keys():
-            daylist.append([key, days[key]])
 
-        context["daylist"] = daylist
-        return context
+class DiaryImportView(LoginRequiredMixin, FormView):
+    """Import meals and reactions from an uploaded diary file."""
 
+    template_name = "meal/import.html"
+    form_class = DiaryImportForm
 
+    def form_valid(self, form):
+        upload = form.cleaned_data["diary"]
+        diary = io.TextIOWrapper(upload.file, encoding="utf-8-sig")
+        format = form.cleaned_data["format"] or diary_format(
+            diary, upload.name
+        )
+        report = import_diary(self.request.user, read_rows(diary, format))
+        return self.render_to_response(
+            self.get_context_data(form=form, report=report)
+        )
+
+
+@query_budget(3)
 class ReactionAllView(LoginRequiredMixin, ListView):
     template_name = "reaction/all.html"
     model = Reaction
@@ -168,6 +259,7 @@ class IngredientCreateView(LoginRequiredMixin, CreateView):
     fields = ["name"]
 
 
+@query_budget(4)
 class IngredientUpdateView(LoginRequiredMixin, UpdateView):
     template_name = "ingredient/update.html"
     model = Ingredient
@@ -176,8 +268,10 @@ class IngredientUpdateView(LoginRequiredMixin, UpdateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        ingredient = Ingredient.objects.get(id=self.kwargs["pk"])
-        allergens = ingredient.ingredientallergen_set.all()
+        ingredient = self.object
+        allergens = ingredient.ingredientallergen_set.select_related(
+            "allergen"
+        )
         context["ingredient"] = ingredient
         context["allergens"] = allergens
         return context
@@ -191,6 +285,7 @@ class IngredientDeleteView(LoginRequiredMixin, DeleteView):
         return reverse("ingredient:list")
 
 
+@query_budget(4)
 class IngredientListView(LoginRequiredMixin, ListView):
     template_name = "ingredient/list.html"
     model = Ingredient
@@ -199,11 +294,12 @@ class IngredientListView(LoginRequiredMixin, ListView):
         query = self.request.GET.get("ingredient")
 
         if query:
-            return Ingredient.objects.filter(name__icontains=query)
+            return search(Ingredient, query)
         else:
             return Ingredient.objects.all()
 
 
+@query_budget(4)
 class IngredientDetailView(LoginRequiredMixin, DetailView):
     template_name = "ingredient/detail.html"
     model = Ingredient
@@ -211,8 +307,9 @@ class IngredientDetailView(LoginRequiredMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        ingredient = Ingredient.objects.get(id=self.kwargs["pk"])
-        allergens = ingredient.ingredientallergen_set.all()
+        allergens = self.object.ingredientallergen_set.select_related(
+            "allergen"
+        )
         context["allergens"] = allergens
         return context
 
@@ -277,6 +374,7 @@ class RecipeCreateView(LoginRequiredMixin, CreateView):
     fields = ["name"]
 
 
+@query_budget(5)
 class RecipeUpdateView(LoginRequiredMixin, UpdateView):
     template_name = "recipe/update.html"
     model = Recipe
@@ -285,10 +383,12 @@ class RecipeUpdateView(LoginRequiredMixin, UpdateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        recipe = Recipe.objects.get(id=self.kwargs["pk"])
-        ingredients = recipe.recipeingredient_set.all()
+        recipe = self.object
+        ingredients = recipe.recipeingredient_set.select_related("ingredient")
+        components = recipe.components.select_related("component")
         context["recipe"] = recipe
         context["ingredients"] = ingredients
+        context["components"] = components
         return context
 
 
@@ -300,6 +400,7 @@ class RecipeDeleteView(LoginRequiredMixin, DeleteView):
         return reverse("recipe:list")
 
 
+@query_budget(4)
 class RecipeListView(LoginRequiredMixin, ListView):
     template_name = "recipe/list.html"
     model = Recipe
@@ -308,11 +409,44 @@ class RecipeListView(LoginRequiredMixin, ListView):
         query = self.request.GET.get("recipe")
 
         if query:
-            return Recipe.objects.filter(name__icontains=query)
+            return search(Recipe, query)
         else:
             return Recipe.objects.all()
 
 
+@query_budget(5)
+class RecipeLookupView(LoginRequiredMixin, View):
+    """Recipes for the meal form's picker, a page of ?q matches at a time.
+
+    Without a query it returns the user's recent recipes.
+    """
+
+    size = 10
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get("q", "")
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+        except ValueError:
+            raise BadRequest("Invalid page")
+
+        if tokens(query):
+            recipes, has_more = lookup_recipes(query, page, self.size)
+        else:
+            recipes, has_more = recent_recipes(request.user.id), False
+        return JsonResponse(
+            {
+                "results": [
+                    {"id": recipe_id, "name": name}
+                    for recipe_id, name in recipes
+                ],
+                "page": page,
+                "has_more": has_more,
+            }
+        )
+
+
+@query_budget(5)
 class RecipeDetailView(LoginRequiredMixin, DetailView):
     template_name = "recipe/detail.html"
     model = Recipe
@@ -320,10 +454,12 @@ class RecipeDetailView(LoginRequiredMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        recipe = Recipe.objects.get(id=self.kwargs["pk"])
-        ingredients = recipe.recipeingredient_set.all()
+        recipe = self.object
+        ingredients = recipe.recipeingredient_set.select_related("ingredient")
+        components = recipe.components.select_related("component")
         context["recipe"] = recipe
         context["ingredients"] = ingredients
+        context["components"] = components
         return context
 
 
@@ -381,81 +517,341 @@ class RecipeIngredientDeleteView(LoginRequiredMixin, DeleteView):
         )
 
 
-class RankingView(LoginRequiredMixin, TemplateView):
-    template_name = "ranking.html"
+class RecipeComponentCreateView(LoginRequiredMixin, CreateView):
+    template_name = "recipe_component/create.html"
+    form_class = RecipeComponentForm
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        user = self.request.user
+    def get_form_kwargs(self):
+        # The recipe is needed to validate that it does not become part of
+        # itself.
+        kwargs = super().get_form_kwargs()
+        kwargs["instance"] = RecipeComponent(
+            recipe=Recipe.objects.get(id=self.kwargs["recipe_pk"])
+        )
+        return kwargs
 
-        context["ranking"] = Ranker(user).get_ranking()
-        return context
+    def form_valid(self, form):
+        recipe = form.instance.recipe
+        percent = form.instance.percent
+
+        if recipe.is_percent_possible(percent):
+            return super().form_valid(form)
+        else:
+            total = recipe.get_sum_ingredients() + percent
+            form.add_error(
+                "percent",
+                f"The ingredients in the recipe would add up to {total}%",
+            )
+            return self.form_invalid(form)
+
+
+class RecipeComponentDeleteView(LoginRequiredMixin, DeleteView):
+    template_name = "recipe_component/delete.html"
+    model = RecipeComponent
 
+    def get_success_url(self):
+        return reverse(
+            "recipe:update", kwargs={"pk": self.kwargs["recipe_pk"]}
+        )
 
-SUCCESS = "success"
-WARNING = "warning"
-INFO = "info"
-DANGER = "danger"
 
+def rank(user, profiling=False):
+    """The user's ranking, and its profile when profiling."""
+    with replica_reads(user.id):
+        if not profiling:
+            return get_ranker(user).get_ranking(), None
+        with profile_ranking(f"user {user.id}") as profile:
+            ranking = get_ranker(user).get_ranking()
+    return ranking, profile.as_dict()
 
-def panel(type, title, body=None, footer=None):
-    p = f"""<div class="panel panel-{type}">
-    <div class="panel-heading">{title}</div>"""
-    if body:
-        p += f"""<div class="panel-body">{body}</div>"""
-    if footer:
-        p += f"""<div class="panel-footer">{footer}</div>"""
-    p += "</div>"
-    return p
 
+@query_budget(6)
+class RankingView(AsyncLoginRequiredMixin, TemplateView):
+    """The user's ranking.
 
-def list(items):
-    l = "<ul>"
-    for item in items:
-        l += f"<li>{item}</li>"
-    l += "</ul>"
-    return l
+    With RANKING_IN_BACKGROUND it is the last ranking the workers stored,
+    marked as refreshing while a newer one is queued. Profiling always
+    ranks in the request.
+    """
 
+    template_name = "ranking.html"
 
-def rows(items):
-    r = ""
-    for item in items:
-        r += f"""
-        <div class="row">
-            <div class="col-sm-1"></div>
-            <div class="col-sm-10">
-                {item}
-            </div>
-            <div class="col-xs-1"></div>
-        </div>"""
-    return r
+    def profiling(self):
+        """Profile always with RANKER_PROFILING, or when debugging asks."""
+        if getattr(settings, "RANKER_PROFILING", False):
+            return True
+        return "profile" in self.request.GET and (
+            settings.DEBUG or self.request.user.is_staff
+        )
 
+    async def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+        profiling = self.profiling()
+        if background_ranking() and not profiling:
+            (
+                context["ranking"],
+                context["computed_at"],
+                context["refreshing"],
+            ) = await sync_to_async(latest_ranking)(request.user)
+            return self.render_to_response(context)
+
+        context["ranking"], profile = await run_ranker(
+            rank, request.user, profiling
+        )
+        if profile is not None:
+            context["profile"] = profile
+        return self.render_to_response(context)
+
+
+def get_suspect(ranker, name):
+    try:
+        return ranker.suspects[name]
+    except KeyError:
+        raise Http404(f"{name} is not among your suspects")
+
+
+def suspect_history(user, name):
+    """The user's suspect and its (reaction, amount) series."""
+    with replica_reads(user.id):
+        ranker = get_ranker(user)
+        suspect = get_suspect(ranker, name)
+        return suspect, list(ranker.exposure_series(suspect.name))
+
+
+class StreamingResponse(StreamingHttpResponse):
+    """Stream the chunks of a synchronous iterator under WSGI and ASGI.
+
+    Under ASGI, StreamingHttpResponse reads a synchronous iterator to the
+    end before it sends anything. Here each chunk is read and sent on its
+    own, in the thread the request's other synchronous code runs in, so
+    the database cursors it reads from stay on their connection.
+    """
+
+    async def __aiter__(self):
+        chunks = iter(self.streaming_content)
+        read = sync_to_async(next, thread_sensitive=True)
+        while (chunk := await read(chunks, None)) is not None:
+            yield chunk
+
+
+def reaction_fragments(user, suspect, series):
+    """The history fragment of each (reaction, amount), cached per data
+    version."""
+    version = data_version(user.id)
+    template = get_template(FoodHistoryView.fragment_template_name)
+    return cached_fragments(
+        "history-reaction",
+        series,
+        lambda item: [item[0].id, *version, suspect.name],
+        lambda item: template.render(
+            {"reaction": item[0], "amount": item[1], "suspect": suspect}
+        ),
+    )
+
+
+@query_budget(3)
+class FoodHistoryView(AsyncLoginRequiredMixin, TemplateView):
+    """The amount of a suspect eaten before each reaction, newest first.
+
+    A page holds the reactions of a date range, `paginate_by` of them at
+    most, and ?before gives the page of the reactions before a day. The
+    page is streamed: the top of the page goes out first, then the
+    reactions `chunk_size` at a time from the fragment cache.
+    """
 
-class FoodHistoryView(LoginRequiredMixin, TemplateView):
     template_name = "food/history.html"
+    fragment_template_name = "food/reaction.html"
+    paginate_by = 100
+    chunk_size = 25
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        ranker = Ranker(self.request.user)
-
-        suspect = None
-        for key, sus in ranker.suspects.items():
-            if sus.name == self.kwargs["suspect"]:
-                suspect = sus
-
-        panels = []
-        amount_in_reactions = ranker.suspect_amount_per_reaction(suspect.name)
-        for reaction in ranker.reactions:
-            type = DANGER if reaction.reaction else SUCCESS
-            panels.append(
-                panel(
-                    type,
-                    f"{reaction.date}",
-                    body=f"{reaction.diary}",
-                    footer=f"Amount of {suspect.name} consumed: {amount_in_reactions[reaction]}",
+    async def get(self, request, *args, **kwargs):
+        before = request.GET.get("before")
+        try:
+            before = date.fromisoformat(before) if before else None
+        except ValueError:
+            raise BadRequest(f"Invalid date {before!r}")
+
+        suspect, series = await run_ranker(
+            suspect_history, request.user, self.kwargs["suspect"]
+        )
+        if before is not None:
+            series = [item for item in series if item[0].date < before]
+        page = series[: self.paginate_by]
+
+        context = self.get_context_data(**kwargs)
+        context["suspect"] = suspect
+        if page:
+            context["newest"], context["oldest"] = page[0][0], page[-1][0]
+        if len(series) > len(page):
+            context["older"] = context["oldest"].date.isoformat()
+        # The reactions go between the top and the bottom of the page.
+        context["reactions"] = slot = f"<!-- reactions {id(self)} -->"
+        html = await sync_to_async(render_to_string)(
+            self.template_name, context, request
+        )
+        top, bottom = html.split(slot)
+
+        def content():
+            yield top
+            for start in range(0, len(page), self.chunk_size):
+                chunk = page[start : start + self.chunk_size]
+                yield "".join(
+                    reaction_fragments(request.user, suspect, chunk)
                 )
-            )
+            yield bottom
 
-        context["title"] = f"<h1>{suspect.name}</h1>"
-        context["panels"] = panels
-        return context
+        return StreamingResponse(content())
+
+
+@query_budget(3)
+class SuspectSeriesView(AsyncLoginRequiredMixin, View):
+    async def get(self, request, *args, **kwargs):
+        suspect, series = await run_ranker(
+            suspect_history, request.user, self.kwargs["suspect"]
+        )
+
+        return JsonResponse(
+            {
+                **asdict(suspect),
+                "series": [
+                    {
+                        "date": reaction.date,
+                        "reaction": reaction.reaction,
+                        "amount": amount,
+                    }
+                    for reaction, amount in series
+                ],
+            }
+        )
+
+
+class ExportView(LoginRequiredMixin, View):
+    """Stream rows as a CSV or NDJSON download, as they are read."""
+
+    columns = None
+
+    def rows(self):
+        raise NotImplementedError
+
+    def filename(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        format = self.kwargs["format"]
+        if format not in EXPORT_FORMATS:
+            raise Http404(f"Unknown export format {format!r}")
+
+        response = StreamingResponse(
+            export_lines(self.rows(), format, self.columns),
+            content_type=EXPORT_FORMATS[format],
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="{self.filename()}.{format}"'
+        )
+        return response
+
+
+class DiaryExportView(ExportView):
+    """The user's meals and reactions, oldest first, in the import format.
+
+    ?since and ?until limit the export to a date range, so an interrupted
+    download can be resumed from the last day it got.
+    """
+
+    columns = COLUMNS
+
+    def date_param(self, name):
+        value = self.request.GET.get(name)
+        if not value:
+            return None
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise BadRequest(f"Invalid date {value!r}")
+
+    def rows(self):
+        return diary_rows(
+            self.request.user,
+            since=self.date_param("since"),
+            until=self.date_param("until"),
+            using=current_shard() or replica_for(self.request.user.id),
+        )
+
+    def filename(self):
+        days = [self.request.GET.get(name) for name in ["since", "until"]]
+        return "-".join(["diary", *filter(None, days)])
+
+
+class RankingExportView(ExportView):
+    columns = RANKING_COLUMNS
+
+    def rows(self):
+        with replica_reads(self.request.user.id):
+            ranking = get_ranker(self.request.user).get_ranking()
+        return ranking_rows(ranking)
+
+    def filename(self):
+        return "ranking"
+
+
+@query_budget(6)
+class SearchView(LoginRequiredMixin, View):
+    """Autocomplete: the best matches for ?q, of one ?kind or every kind."""
+
+    limit = 10
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get("q", "")
+        kinds = request.GET.getlist("kind") or SEARCH_MODELS.keys()
+        if not set(kinds) <= set(SEARCH_MODELS):
+            raise Http404(f"Cannot search {', '.join(kinds)}")
+
+        results = []
+        for kind in kinds:
+            for match in search(SEARCH_MODELS[kind], query, self.limit):
+                results.append(
+                    {
+                        "kind": kind,
+                        "id": match.id,
+                        "name": match.name,
+                        "url": reverse(f"{kind}:detail", args=[match.id]),
+                    }
+                )
+        return JsonResponse({"query": query, "results": results})
+
+
+@query_budget(9)
+class BatchView(LoginRequiredMixin, View):
+    """Log a JSON array of meals or reactions in one request.
+
+    Meals are {"date", "recipe" or "food", "amount"} objects, the recipe by
+    name or by id, and reactions {"date", "reaction", "diary"} objects, a
+    reaction replacing the one already logged that day. The valid items
+    are saved together and the response has a result per item, in order.
+    """
+
+    raise_exception = True
+    kind = None
+    max_items = 1000
+
+    def post(self, request, *args, **kwargs):
+        try:
+            items = json.loads(request.body)
+        except ValueError:
+            raise BadRequest("The body is not JSON")
+        if not isinstance(items, list):
+            raise BadRequest(f"Expected an array of {self.kind}s")
+        if len(items) > self.max_items:
+            raise BadRequest(f"At most {self.max_items} items per request")
+
+        results = save_batch(request.user, self.kind, items)
+        return JsonResponse({"results": results})
+
+
+class FragmentStatsView(LoginRequiredMixin, View):
+    """Hits and misses of the cached template fragments, for staff."""
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            raise PermissionDenied
+        return JsonResponse(fragment_stats())
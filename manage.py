@@ -6,7 +6,12 @@ import sys
 
 def main():
     """Run administrative tasks."""
-    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "food.settings")
+    # The tests run with a second database to shard diaries to.
+    testing = sys.argv[1:2] == ["test"]
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE",
+        "food.test_settings" if testing else "food.settings",
+    )
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc: